@@ -0,0 +1,96 @@
+#!/bin/python3
+
+"""
+
+Copyright (C) 2018 MonaIzquierda (mona.izquierda@gmail.com)
+
+This file is part of PraxisBot.
+
+PraxisBot is free software: you can redistribute it and/or  modify
+it under the terms of the GNU Affero General Public License, version 3,
+as published by the Free Software Foundation.
+
+PraxisBot is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with PraxisBot.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import sys
+import os
+import time
+import asyncio
+import tempfile
+import sqlite3
+import praxisbot
+
+########################################################################
+# Benchmark of the event loop latency under concurrent database writes
+#
+# A ticker task sleeps 1 ms in a loop and records how late it wakes up,
+# while writer tasks insert rows. The writers use either the connection
+# of the event loop (old behavior) or the Database writer thread.
+
+numWriters = 20
+numWrites = 200
+if len(sys.argv) >= 2:
+	numWriters = int(sys.argv[1])
+if len(sys.argv) >= 3:
+	numWrites = int(sys.argv[2])
+
+createQuery = "CREATE TABLE IF NOT EXISTS pb_bench (id INTEGER PRIMARY KEY, discord_sid INTEGER, value TEXT)"
+insertQuery = "INSERT INTO pb_bench (discord_sid, value) VALUES (?, ?)"
+selectQuery = "SELECT COUNT(id) FROM pb_bench WHERE discord_sid = ?"
+
+async def ticker(delays, stop):
+	while not stop.is_set():
+		startTime = time.perf_counter()
+		await asyncio.sleep(0.001)
+		delays.append(time.perf_counter()-startTime-0.001)
+
+async def sync_writer(dbcon, sid):
+	for i in range(numWrites):
+		with dbcon:
+			dbcon.execute(insertQuery, [sid, "value "+str(i)])
+		dbcon.execute(selectQuery, [sid]).fetchone()
+		await asyncio.sleep(0)
+
+async def async_writer(db, sid):
+	for i in range(numWrites):
+		await db.execute(insertQuery, [sid, "value "+str(i)])
+		await db.fetchone(selectQuery, [sid])
+
+async def run(name, writer, target):
+	delays = []
+	stop = asyncio.Event()
+	tick = asyncio.ensure_future(ticker(delays, stop))
+	startTime = time.perf_counter()
+	await asyncio.gather(*[writer(target, sid) for sid in range(numWriters)])
+	duration = time.perf_counter()-startTime
+	stop.set()
+	await tick
+
+	delays.sort()
+	p99 = delays[int(len(delays)*0.99)]
+	print(name+": "+str(numWriters*numWrites)+" writes in "+str(int(duration*1000))+" ms, loop latency p50 "+str(round(delays[len(delays)//2]*1000, 2))+" ms, p99 "+str(round(p99*1000, 2))+" ms, max "+str(round(delays[-1]*1000, 2))+" ms")
+
+def main():
+	folder = tempfile.mkdtemp()
+	loop = asyncio.get_event_loop()
+
+	filename = os.path.join(folder, "sync.db")
+	dbcon = sqlite3.connect(filename)
+	dbcon.execute(createQuery)
+	loop.run_until_complete(run("Event loop connection", sync_writer, dbcon))
+	dbcon.close()
+
+	db = praxisbot.Database(os.path.join(folder, "async.db"))
+	db.connection.execute(createQuery)
+	loop.run_until_complete(run("Database threads", async_writer, db))
+	db.close()
+
+main()
@@ -0,0 +1,177 @@
+#!/bin/python3
+
+"""
+
+Copyright (C) 2018 MonaIzquierda (mona.izquierda@gmail.com)
+
+This file is part of PraxisBot.
+
+PraxisBot is free software: you can redistribute it and/or  modify
+it under the terms of the GNU Affero General Public License, version 3,
+as published by the Free Software Foundation.
+
+PraxisBot is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with PraxisBot.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import sys
+import re
+import random
+import datetime
+import timeit
+import praxisbot
+from pytz import timezone
+
+########################################################################
+# Benchmark of format_text
+#
+# Renders a welcome message with 5 tags and a literal argument, with the
+# regex and if/elif implementation of format_text used before templates
+# were compiled (before), and with ExecutionScope.format_text (after).
+
+numRenders = 100000
+if len(sys.argv) >= 2:
+	numRenders = int(sys.argv[1])
+
+class Entity:
+	def __init__(self, **kwargs):
+		self.__dict__.update(kwargs)
+
+welcomeText = "Welcome {{@user}}! You are in {{#channel}} on {{server}}. Points: {{points}}{{n}}Roles: {{,roles}}"
+literalText = "just a literal argument"
+
+def create_scope():
+	member = Entity(id="9", name="bob", discriminator="0001", display_name="Bob", mention="<@9>")
+	channel = Entity(id="5", name="general", mention="<#5>")
+	server = Entity(id="1", name="PraxisBot", channels=[channel], members=[member], roles=[], emojis=[])
+	server.get_member = lambda id: member if id == member.id else None
+	server.get_channel = lambda id: channel if id == channel.id else None
+
+	shell = praxisbot.Shell(None, None, "pb_", None)
+	scope = praxisbot.ExecutionScope(shell, server, [""])
+	scope.user = member
+	scope.channel = channel
+	scope.vars = {"points": "12", "roles": "Member\nArtist\nModerator"}
+	return scope
+
+def format_text_before(self, text):
+	if not text:
+		return ""
+
+	p = re.compile(r"\{\{([^\}]+)\}\}")
+
+	formatedText = ""
+	textIter = 0
+	mi = p.finditer(text)
+	for m in mi:
+		formatedText = formatedText + text[textIter:m.start()]
+		textIter = m.end()
+
+		#Process tag
+		tag = m.group(1).strip()
+		tagOutput = m.group()
+
+		if tag.find('|') >= 0:
+			tag = random.choice(tag.split("|"))
+			tagOutput = tag
+
+		u = self.user
+		user_chk = re.fullmatch('([*@#]?user(?:_time|_avatar)?)=(.*)', tag)
+		if user_chk:
+			subUser = user_chk.group(2).strip()
+			if subUser in self.vars:
+				subUser = self.vars[subUser].strip()
+			u = self.shell.find_member(subUser, self.server)
+			tag = user_chk.group(1)
+
+		c = self.channel
+		channel_chk = re.fullmatch('([*#]?channel)=(.*)', tag)
+		if channel_chk:
+			subChan = channel_chk.group(2).strip()
+			if subChan in self.vars:
+				subChan = self.vars[subChan]
+			c = self.shell.find_channel(subChan, self.server)
+			tag = channel_chk.group(1)
+
+		r = None
+		role_chk = re.fullmatch('([*@]?role)=(.*)', tag)
+		if role_chk:
+			subRole = role_chk.group(2).strip()
+			if subRole in self.vars:
+				subRole = self.vars[subRole]
+			r = self.shell.find_role(subRole, self.server)
+			tag = role_chk.group(1)
+
+		if tag.lower() == "server" and self.server:
+			tagOutput = self.server.name
+		elif tag.lower() == "*server" and self.server:
+			tagOutput = self.server.id
+		elif tag.lower() == "n":
+			tagOutput = "\n"
+		elif tag.lower() == "now":
+			d = datetime.datetime.now(timezone('Europe/Paris'))
+			tagOutput = d.strftime("%Y-%m-%d %H:%M:%S")
+		elif tag.lower() == "channel" and c:
+			tagOutput = c.name
+		elif tag.lower() == "#channel" and c:
+			tagOutput = c.mention
+		elif tag.lower() == "*channel" and c:
+			tagOutput = c.id
+		elif tag.lower() == "role" and r:
+			tagOutput = r.name
+		elif tag.lower() == "@role" and r:
+			tagOutput = r.mention
+		elif tag.lower() == "*role" and r:
+			tagOutput = r.id
+		elif tag.lower() == "#user" and u:
+			tagOutput = u.name+"#"+u.discriminator
+		elif tag.lower() == "@user" and u:
+			tagOutput = u.mention
+		elif tag.lower() == "*user" and u:
+			tagOutput = u.id
+		elif tag.lower() == "user" and u:
+			tagOutput = u.display_name
+		elif tag.lower() == "user_time" and u:
+			tagOutput = str(u.created_at)
+		elif tag.lower() == "user_avatar" and u:
+			tagOutput = str(u.avatar_url.replace(".webp", ".png"))
+		elif tag[0] == "*" and tag[1:] in self.vars:
+			if len(self.vars[tag[1:]].strip()) == 0:
+				tagOutput = 0
+			else:
+				s = self.vars[tag[1:]].split("\n")
+				tagOutput = str(len(s))
+		elif tag[0] == "," and tag[1:] in self.vars:
+			s = self.vars[tag[1:]].split("\n")
+			tagOutput = ", ".join(s)
+		elif tag in self.vars:
+			tagOutput = self.vars[tag]
+		else:
+			tagOutput = tag
+		formatedText = formatedText + str(tagOutput)
+
+	formatedText = formatedText + text[textIter:]
+
+	return formatedText
+
+def measure(name, scope, text):
+	if format_text_before(scope, text) != scope.format_text(text):
+		print(name+": different outputs")
+		return
+
+	before = timeit.timeit(lambda: format_text_before(scope, text), number=numRenders)/numRenders*1000000
+	after = timeit.timeit(lambda: scope.format_text(text), number=numRenders)/numRenders*1000000
+	print(name+": before "+str(round(before, 2))+" us/render, after "+str(round(after, 2))+" us/render, "+str(round(before/after, 1))+"x faster")
+
+def main():
+	scope = create_scope()
+	measure("Welcome message", scope, welcomeText)
+	measure("Literal argument", scope, literalText)
+
+main()
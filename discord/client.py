@@ -2884,6 +2884,49 @@ class Client:
         payload = [{"id": z[0], "position": z[1]} for z in zip(roles, change_range)]
         yield from self.http.move_role_position(server.id, payload)
 
+    @asyncio.coroutine
+    def move_roles(self, server, positions):
+        """|coro|
+
+        Moves several roles of a server in a single request.
+
+        Unlike :meth:`move_role`, the other roles are not shifted: each
+        role is sent with its new position, so ``positions`` should
+        describe a permutation of the positions currently used by
+        these roles.
+
+        You must have the proper permissions to change role positions.
+
+        Parameters
+        -----------
+        server : :class:`Server`
+            The server the roles belong to.
+        positions : dict
+            A dict mapping each :class:`Role` to move to its new position.
+
+        Raises
+        -------
+        InvalidArgument
+            If a position is 0, or a role is server.default_role
+        Forbidden
+            You do not have permissions to change role order.
+        HTTPException
+            If moving the roles failed, or you are of too low rank to move a role.
+        """
+
+        payload = []
+        for role, position in positions.items():
+            if position == 0:
+                raise InvalidArgument("Cannot move role to position 0")
+            if role == server.default_role:
+                raise InvalidArgument("Cannot move default role")
+            payload.append({"id": role.id, "position": position})
+
+        if len(payload) == 0:
+            return
+
+        yield from self.http.move_role_position(server.id, payload)
+
     @asyncio.coroutine
     def edit_role(self, server, role, **fields):
         """|coro|
@@ -260,9 +260,11 @@ class ConnectionState:
             self.dispatch('message_edit', older_message, message)
 
     def parse_message_reaction_add(self, data):
+        emoji = self._get_reaction_emoji(**data.pop('emoji'))
+        self.dispatch('raw_reaction_add', emoji, data['message_id'], data['channel_id'], data['user_id'])
+
         message = self._get_message(data['message_id'])
         if message is not None:
-            emoji = self._get_reaction_emoji(**data.pop('emoji'))
             reaction = utils.get(message.reactions, emoji=emoji)
 
             is_me = data['user_id'] == self.user.id
@@ -18,7 +18,6 @@ along with PraxisBot.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
-import shlex
 import argparse
 import re
 import discord
@@ -26,7 +25,6 @@ import traceback
 import datetime
 from pytz import timezone
 from dateutil.relativedelta import relativedelta
-import io
 import praxisbot
 
 class ActivityPlugin(praxisbot.Plugin):
@@ -88,8 +86,7 @@ class ActivityPlugin(praxisbot.Plugin):
 		Display server activity during the last month.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return scope
 
@@ -115,8 +112,7 @@ class ActivityPlugin(praxisbot.Plugin):
 		Display server activity during the last month.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return scope
 
@@ -142,8 +138,7 @@ class ActivityPlugin(praxisbot.Plugin):
 		Display server activity during the last year.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return scope
 
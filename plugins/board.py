@@ -18,13 +18,11 @@ along with PraxisBot.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
-import shlex
 import argparse
 import re
 import discord
 import traceback
 import praxisbot
-from io import StringIO
 
 class BoardPlugin(praxisbot.Plugin):
 	"""
@@ -38,7 +36,7 @@ class BoardPlugin(praxisbot.Plugin):
 
 		self.boardname_regex = re.compile('[a-zA-Z0-9_-]+')
 
-		self.shell.create_sql_table("boards", ["id INTEGER PRIMARY KEY", "name TEXT", "discord_sid INTEGER", "discord_cid INTEGER", "discord_mid INTEGER"])
+		self.shell.migrate_sql_schema(self.name, [self.create_tables])
 
 		self.add_command("create_board", self.execute_create_board)
 		self.add_command("edit_board", self.execute_edit_board)
@@ -46,6 +44,9 @@ class BoardPlugin(praxisbot.Plugin):
 		self.add_command("show_board", self.execute_show_board)
 		self.add_command("boards", self.execute_boards)
 
+	def create_tables(self):
+		self.shell.create_sql_table("boards", ["id INTEGER PRIMARY KEY", "name TEXT", "discord_sid INTEGER", "discord_cid INTEGER", "discord_mid INTEGER"], [["discord_sid", "name"]])
+
 	def create_embed(self, boardname, author):
 		e = discord.Embed();
 		e.type = "rich"
@@ -53,17 +54,16 @@ class BoardPlugin(praxisbot.Plugin):
 		return e
 
 	@praxisbot.command
+	@praxisbot.argument('boardname', help='Name of the board')
+	@praxisbot.argument('--channel', '-c', help='Channel where the board will be.')
+	@praxisbot.argument('--content', help='Channel where the board will be.')
+	@praxisbot.argument('--format', action='store_true', help='Apply PraxisBot text formating.')
 	async def execute_create_board(self, scope, command, options, lines, **kwargs):
 		"""
 		Create a new board.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('boardname', help='Name of the board')
-		parser.add_argument('--channel', '-c', help='Channel where the board will be.')
-		parser.add_argument('--content', help='Channel where the board will be.')
-		parser.add_argument('--format', action='store_true', help='Apply PraxisBot text formating.')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -83,7 +83,7 @@ class BoardPlugin(praxisbot.Plugin):
 			await scope.shell.print_permission(scope, "You don't have write permission in this channel.")
 			return
 
-		boardId = scope.shell.get_sql_data("boards", ["id"], {"discord_sid": int(scope.server.id), "name": str(boardname)})
+		boardId = await scope.shell.get_sql_data_async("boards", ["id"], {"discord_sid": int(scope.server.id), "name": str(boardname)})
 		if boardId:
 			await scope.shell.print_error(scope, "The board `"+boardname+"` already exists.")
 			return
@@ -100,24 +100,23 @@ class BoardPlugin(praxisbot.Plugin):
 
 		e = self.create_embed(boardname, scope.user);
 		m = await scope.shell.client.send_message(chan, content, embed=e)
-		scope.shell.set_sql_data("boards", {"discord_cid": int(m.channel.id), "discord_mid": int(m.id)}, {"discord_sid": int(m.server.id), "name": str(boardname)})
+		await scope.shell.set_sql_data_async("boards", {"discord_cid": int(m.channel.id), "discord_mid": int(m.id)}, {"discord_sid": int(m.server.id), "name": str(boardname)})
 
 	@praxisbot.command
+	@praxisbot.argument('boardname', help='Name of the board')
 	async def execute_delete_board(self, scope, command, options, lines, **kwargs):
 		"""
 		Make a board no longer editable.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('boardname', help='Name of the board')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
 		boardname = scope.format_text(args.boardname)
 		self.ensure_object_name("Board name", boardname)
 
-		board = scope.shell.get_sql_data("boards", ["id", "discord_cid", "discord_mid"], {"discord_sid": int(scope.server.id), "name": str(boardname)})
+		board = await scope.shell.get_sql_data_async("boards", ["id", "discord_cid", "discord_mid"], {"discord_sid": int(scope.server.id), "name": str(boardname)})
 		if not board:
 			await scope.shell.print_error(scope, "Board `"+boardname+"` not found.")
 			return
@@ -127,28 +126,27 @@ class BoardPlugin(praxisbot.Plugin):
 			await scope.shell.print_permission(scope, "You don't have write permission in this channel.")
 			return
 
-		scope.shell.delete_sql_data("boards", {"id": board[0]})
+		await scope.shell.delete_sql_data_async("boards", {"id": board[0]})
 
 		await scope.shell.print_success(scope, "Board `"+boardname+"` deleted.")
 
 	@praxisbot.command
+	@praxisbot.argument('boardname', help='Name of the board')
+	@praxisbot.argument('--content', help='Channel where the board will be.')
+	@praxisbot.argument('--format', action='store_true', help='Apply PraxisBot text formating.')
 	async def execute_edit_board(self, scope, command, options, lines, **kwargs):
 		"""
 		Edit a board. Content of the board must be written in the second line, or with the parameter --content.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('boardname', help='Name of the board')
-		parser.add_argument('--content', help='Channel where the board will be.')
-		parser.add_argument('--format', action='store_true', help='Apply PraxisBot text formating.')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
 		boardname = scope.format_text(args.boardname)
 		self.ensure_object_name("Board name", boardname)
 
-		board = scope.shell.get_sql_data("boards", ["id", "discord_cid", "discord_mid"], {"discord_sid": int(scope.server.id), "name": str(boardname)})
+		board = await scope.shell.get_sql_data_async("boards", ["id", "discord_cid", "discord_mid"], {"discord_sid": int(scope.server.id), "name": str(boardname)})
 		if not board:
 			await scope.shell.print_error(scope, "Board `"+boardname+"` not found.")
 			return
@@ -186,21 +184,20 @@ class BoardPlugin(praxisbot.Plugin):
 		await scope.shell.print_success(scope, "Board `"+boardname+"` edited.")
 
 	@praxisbot.command
+	@praxisbot.argument('boardname', help='Name of the board')
 	async def execute_show_board(self, scope, command, options, lines, **kwargs):
 		"""
 		Show the source code of a board.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('boardname', help='Name of the board')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
 		boardname = scope.format_text(args.boardname)
 		self.ensure_object_name("Board name", boardname)
 
-		board = scope.shell.get_sql_data("boards", ["id", "discord_cid", "discord_mid"], {"discord_sid": int(scope.server.id), "name": str(boardname)})
+		board = await scope.shell.get_sql_data_async("boards", ["id", "discord_cid", "discord_mid"], {"discord_sid": int(scope.server.id), "name": str(boardname)})
 		if not board:
 			await scope.shell.print_error(scope, "Board `"+boardname+"` not found.")
 			return
@@ -230,23 +227,20 @@ class BoardPlugin(praxisbot.Plugin):
 		List all boards.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
 		stream = praxisbot.MessageStream(scope)
 		await stream.send("**List of boards**\n")
 
-		with scope.shell.dbcon:
-			c = scope.shell.dbcon.cursor()
-			for row in c.execute("SELECT name, discord_cid FROM "+scope.shell.dbtable("boards")+" WHERE discord_sid = ? ORDER BY name", [int(scope.server.id)]):
+		for row in await scope.shell.db.fetchall("SELECT name, discord_cid FROM "+scope.shell.dbtable("boards")+" WHERE discord_sid = ? ORDER BY name", [int(scope.server.id)]):
 
-				chan = scope.shell.find_channel(str(row[1]), scope.server)
-				if not chan:
-					continue
-				if scope.permission < praxisbot.UserPermission.Script and not chan.permissions_for(scope.user).read_messages:
-					continue
-				await stream.send("\n - `"+row[0]+"` in "+chan.mention)
+			chan = scope.shell.find_channel(str(row[1]), scope.server)
+			if not chan:
+				continue
+			if scope.permission < praxisbot.UserPermission.Script and not chan.permissions_for(scope.user).read_messages:
+				continue
+			await stream.send("\n - `"+row[0]+"` in "+chan.mention)
 
 		await stream.finish()
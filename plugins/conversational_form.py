@@ -18,12 +18,10 @@ along with PraxisBot.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
-import shlex
 import argparse
 import re
 import requests
 import traceback
-import io
 import datetime
 from pytz import timezone
 from dateutil.relativedelta import relativedelta
@@ -42,6 +40,58 @@ class Session:
 		self.start_time = datetime.datetime.now()
 		self.last_time = self.start_time
 
+class Link:
+	def __init__(self, node_end, script, type, value, priority):
+		self.node_end = node_end
+		self.script = script
+		self.type = type
+		self.value = value
+		self.priority = priority
+		self.regex = None
+		if type == LinkType.UserRegex:
+			try:
+				self.regex = re.compile(value)
+			except re.error:
+				pass
+
+	def match_message(self, text):
+		return self.regex != None and self.regex.search(text) != None
+
+	def match_reaction(self, emoji):
+		return str(emoji).startswith(self.value)
+
+class Graph:
+	"""
+	Nodes and links of a server, with the links of each node sorted by priority
+	"""
+	def __init__(self):
+		self.nodes = {}
+		self.links = {}
+		self.sorted_links = {}
+
+	def set_node(self, name, script):
+		self.nodes[name] = script
+
+	def delete_node(self, name):
+		self.nodes.pop(name, None)
+
+	def set_link(self, node_start, link):
+		self.links.setdefault(node_start, {})[link.node_end] = link
+		self.sorted_links.pop(node_start, None)
+
+	def delete_link(self, node_start, node_end):
+		self.links.get(node_start, {}).pop(node_end, None)
+		self.sorted_links.pop(node_start, None)
+
+	def get_links(self, node_start, type):
+		if node_start not in self.sorted_links:
+			links = sorted(self.links.get(node_start, {}).values(), key=lambda l: (-l.priority, l.node_end))
+			sortedLinks = {}
+			for l in links:
+				sortedLinks.setdefault(l.type, []).append(l)
+			self.sorted_links[node_start] = sortedLinks
+		return self.sorted_links[node_start].get(type, [])
+
 class ConversationalFormPlugin(praxisbot.Plugin):
 	"""
 	ConversationalForm commands
@@ -52,10 +102,10 @@ class ConversationalFormPlugin(praxisbot.Plugin):
 	def __init__(self, shell):
 		super().__init__(shell)
 
-		self.shell.create_sql_table("cf_nodes", ["id INTEGER PRIMARY KEY", "name TEXT", "discord_sid INTEGER", "script TEXT"])
-		self.shell.create_sql_table("cf_links", ["id INTEGER PRIMARY KEY", "node_start TEXT", "node_end TEXT", "discord_sid INTEGER", "script TEXT", "type INTEGER", "value TEXT", "priority INTEGER"])
+		self.shell.migrate_sql_schema(self.name, [self.create_tables, self.create_indexes])
 
 		self.sessions = {}
+		self.graphs = {}
 
 		self.add_command("create_cf_node", self.execute_create_cf_node)
 		self.add_command("create_cf_link", self.execute_create_cf_link)
@@ -66,14 +116,46 @@ class ConversationalFormPlugin(praxisbot.Plugin):
 		self.add_command("end_cf_session", self.execute_end_cf_session)
 		self.add_command("cf_sessions", self.execute_cf_sessions)
 
+	def create_tables(self):
+		self.shell.create_sql_table("cf_nodes", ["id INTEGER PRIMARY KEY", "name TEXT", "discord_sid INTEGER", "script TEXT"], [["discord_sid", "name"]])
+		self.shell.create_sql_table("cf_links", ["id INTEGER PRIMARY KEY", "node_start TEXT", "node_end TEXT", "discord_sid INTEGER", "script TEXT", "type INTEGER", "value TEXT", "priority INTEGER"], [["discord_sid", "node_start", "node_end"]])
+
+	def create_indexes(self):
+		self.shell.create_sql_index("cf_links", ["discord_sid", "node_start", "type"])
+		self.shell.create_sql_index("cf_links", ["discord_sid", "node_end"])
+
 	def start_session(self, user, channel, server, node_start, timeout):
 		key = (user.id, channel.id, server.id)
 		self.sessions[key] = Session(node_start, timeout)
+		self.schedule_expiration(key)
 
 	def end_session(self, user, channel, server):
 		key = (user.id, channel.id, server.id)
+		self.remove_session(key)
+
+	def remove_session(self, key):
 		if key in self.sessions:
 			del(self.sessions[key])
+		self.shell.scheduler.cancel(("cf_session", key))
+
+	def schedule_expiration(self, key):
+		"""
+		Expire the session after its timeout. Scheduling it again when the session is used replaces the previous expiration.
+		"""
+		session = self.sessions[key]
+		timeout_time = session.last_time + session.timeout_duration
+		self.shell.scheduler.schedule(("cf_session", key), timeout_time.timestamp(), self.expire_session, key)
+
+	async def expire_session(self, key):
+		if key not in self.sessions:
+			return
+
+		timeout_time = self.sessions[key].last_time + self.sessions[key].timeout_duration
+		if timeout_time > datetime.datetime.now():
+			self.schedule_expiration(key)
+			return
+
+		del(self.sessions[key])
 
 	def get_session(self, user, channel, server):
 		key = (user.id, channel.id, server.id)
@@ -82,6 +164,22 @@ class ConversationalFormPlugin(praxisbot.Plugin):
 		else:
 			return None
 
+	async def get_graph(self, scope):
+		"""
+		Return the graph of the server, loaded from the database on first use
+		"""
+		if scope.server.id in self.graphs:
+			return self.graphs[scope.server.id]
+
+		graph = Graph()
+		for row in await scope.shell.db.fetchall("SELECT name, script FROM "+scope.shell.dbtable("cf_nodes")+" WHERE discord_sid = ?", [int(scope.server.id)]):
+			graph.set_node(row[0], row[1])
+		for row in await scope.shell.db.fetchall("SELECT node_start, node_end, script, type, value, priority FROM "+scope.shell.dbtable("cf_links")+" WHERE discord_sid = ?", [int(scope.server.id)]):
+			graph.set_link(row[0], Link(row[1], row[2], row[3], row[4], row[5]))
+
+		self.graphs[scope.server.id] = graph
+		return graph
+
 	async def execute_session_script(self, user, channel, server, scope, script):
 		key = (user.id, channel.id, server.id)
 		if key not in self.sessions:
@@ -106,30 +204,20 @@ class ConversationalFormPlugin(praxisbot.Plugin):
 		for v in subScope.session_vars:
 			self.sessions[key].vars[v] = subScope.session_vars[v]
 		self.sessions[key].last_time = datetime.datetime.now()
+		self.schedule_expiration(key)
 
 	async def execute_session_node(self, user, channel, server, scope):
 		key = (user.id, channel.id, server.id)
 		if key not in self.sessions:
 			return
 
-		node = self.sessions[key].current_node
-		node_data = scope.shell.get_sql_data("cf_nodes", ["script"], {"discord_sid":int(scope.server.id), "name":str(node)})
-		if not node_data:
-			del(self.sessions[key])
+		graph = await self.get_graph(scope)
+		node = str(self.sessions[key].current_node)
+		if node not in graph.nodes:
+			self.remove_session(key)
 			return
 
-		await self.execute_session_script(user, channel, server, scope, node_data[0])
-
-	async def on_loop(self, scope):
-		sessions_to_delete = set()
-		for s in self.sessions:
-			timeout_time = self.sessions[s].last_time + self.sessions[s].timeout_duration
-			if timeout_time < datetime.datetime.now():
-				sessions_to_delete.add(s)
-
-		for s in sessions_to_delete:
-			if s in self.sessions:
-				del(self.sessions[s])
+		await self.execute_session_script(user, channel, server, scope, graph.nodes[node])
 
 	async def on_message(self, scope, message, command_found):
 		if command_found:
@@ -139,53 +227,41 @@ class ConversationalFormPlugin(praxisbot.Plugin):
 		if not session:
 			return
 
-		node = session.current_node
-		with scope.shell.dbcon:
-			c = scope.shell.dbcon.cursor()
-			for row in c.execute("SELECT node_end, script, value FROM "+scope.shell.dbtable("cf_links")+" WHERE discord_sid = ? AND node_start = ? AND type = ? ORDER BY priority DESC, node_start", [int(scope.server.id), str(node), int(LinkType.UserRegex)]):
-				try:
-					if not re.search(row[2], message.content):
-						continue
-				except:
-					continue
-
-				subScope = scope.create_subscope()
-				subScope.vars["message"] = message.content
-				await self.execute_session_script(scope.user, scope.channel, scope.server, subScope, row[1])
-
-				session.current_node = row[0]
-				await self.execute_session_node(scope.user, scope.channel, scope.server, scope)
-				return
+		graph = await self.get_graph(scope)
+		for link in graph.get_links(str(session.current_node), LinkType.UserRegex):
+			if not link.match_message(message.content):
+				continue
 
-	def check_emoji(self, reaction, emoji):
-		e = str(reaction.emoji)
-		return e.startswith(emoji)
+			subScope = scope.create_subscope()
+			subScope.vars["message"] = message.content
+			await self.execute_session_script(scope.user, scope.channel, scope.server, subScope, link.script)
+
+			session.current_node = link.node_end
+			await self.execute_session_node(scope.user, scope.channel, scope.server, scope)
+			return
 
 	async def on_reaction(self, scope, reaction):
 		session = self.get_session(scope.user, scope.channel, scope.server)
 		if not session:
 			return
-		node = session.current_node
-		with scope.shell.dbcon:
-			c = scope.shell.dbcon.cursor()
-			for row in c.execute("SELECT node_end, script, value FROM "+scope.shell.dbtable("cf_links")+" WHERE discord_sid = ? AND node_start = ? AND type = ? ORDER BY priority DESC, node_start", [int(scope.server.id), str(node), int(LinkType.Reaction)]):
-				if self.check_emoji(reaction, row[2]):
-					await self.execute_session_script(scope.user, scope.channel, scope.server, scope, row[1])
+		graph = await self.get_graph(scope)
+		for link in graph.get_links(str(session.current_node), LinkType.Reaction):
+			if link.match_reaction(reaction.emoji):
+				await self.execute_session_script(scope.user, scope.channel, scope.server, scope, link.script)
 
-					session.current_node = row[0]
-					await self.execute_session_node(scope.user, scope.channel, scope.server, scope)
-					return
+				session.current_node = link.node_end
+				await self.execute_session_node(scope.user, scope.channel, scope.server, scope)
+				return
 
 	@praxisbot.command
 	@praxisbot.permission_admin
+	@praxisbot.argument('name', help='Text to send')
 	async def execute_create_cf_node(self, scope, command, options, lines, **kwargs):
 		"""
 		Create a new node.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('name', help='Text to send')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -196,23 +272,24 @@ class ConversationalFormPlugin(praxisbot.Plugin):
 		#	await scope.shell.print_error(scope, "Node `"+args.name+"` already exists.")
 		#	return
 
-		scope.shell.set_sql_data("cf_nodes", {"script": "\n".join(lines)}, {"discord_sid":int(scope.server.id), "name":str(args.name)})
+		await scope.shell.set_sql_data_async("cf_nodes", {"script": "\n".join(lines)}, {"discord_sid":int(scope.server.id), "name":str(args.name)})
+		if scope.server.id in self.graphs:
+			self.graphs[scope.server.id].set_node(str(args.name), "\n".join(lines))
 		await scope.shell.print_success(scope, "Node `"+args.name+"` created.")
 
 	@praxisbot.command
 	@praxisbot.permission_admin
+	@praxisbot.argument('start', help='Name of the starting node')
+	@praxisbot.argument('end', help='Name of the final node')
+	@praxisbot.argument('--message', help='Link activated if a message match a regular expression.')
+	@praxisbot.argument('--reaction', help='Link activated if a reaction is added in this channel.')
+	@praxisbot.argument('--priority', help='Priority of the link')
 	async def execute_create_cf_link(self, scope, command, options, lines, **kwargs):
 		"""
 		Create a link between two nodes.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('start', help='Name of the starting node')
-		parser.add_argument('end', help='Name of the final node')
-		parser.add_argument('--message', help='Link activated if a message match a regular expression.')
-		parser.add_argument('--reaction', help='Link activated if a reaction is added in this channel.')
-		parser.add_argument('--priority', help='Priority of the link')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -227,73 +304,79 @@ class ConversationalFormPlugin(praxisbot.Plugin):
 				await scope.shell.print_error(scope, "Priority must be a positive integer.")
 				return
 
-		node_start = scope.shell.get_sql_data("cf_nodes", ["id"], {"discord_sid":int(scope.server.id), "name":str(args.start)})
+		node_start = await scope.shell.get_sql_data_async("cf_nodes", ["id"], {"discord_sid":int(scope.server.id), "name":str(args.start)})
 		if not node_start:
 			await scope.shell.print_error(scope, "Node `"+args.start+"` not found.")
 			return
 
-		node_end = scope.shell.get_sql_data("cf_nodes", ["id"], {"discord_sid":int(scope.server.id), "name":str(args.end)})
+		node_end = await scope.shell.get_sql_data_async("cf_nodes", ["id"], {"discord_sid":int(scope.server.id), "name":str(args.end)})
 		if not node_end:
 			await scope.shell.print_error(scope, "Node `"+args.end+"` not found.")
 			return
 
 		if args.message:
 			self.ensure_regex(args.message)
-			scope.shell.set_sql_data("cf_links", {"script": "\n".join(lines), "type": LinkType.UserRegex, "value": args.message, "priority":int(priority)}, {"discord_sid":int(scope.server.id), "node_start":str(args.start), "node_end":str(args.end)})
+			link = Link(str(args.end), "\n".join(lines), LinkType.UserRegex, args.message, int(priority))
 		elif args.reaction:
-			scope.shell.set_sql_data("cf_links", {"script": "\n".join(lines), "type": LinkType.Reaction, "value": args.reaction, "priority":int(priority)}, {"discord_sid":int(scope.server.id), "node_start":str(args.start), "node_end":str(args.end)})
+			link = Link(str(args.end), "\n".join(lines), LinkType.Reaction, args.reaction, int(priority))
 		else:
 			await scope.shell.print_error(scope, "Missing type of link. Please use --message option.")
 			return
 
+		await scope.shell.set_sql_data_async("cf_links", {"script": link.script, "type": link.type, "value": link.value, "priority":link.priority}, {"discord_sid":int(scope.server.id), "node_start":str(args.start), "node_end":str(args.end)})
+		if scope.server.id in self.graphs:
+			self.graphs[scope.server.id].set_link(str(args.start), link)
+
 		await scope.shell.print_success(scope, "Link between `"+args.start+"` and `"+args.end+"` created.")
 
 	@praxisbot.command
 	@praxisbot.permission_admin
+	@praxisbot.argument('name', help='Text to send')
 	async def execute_delete_cf_node(self, scope, command, options, lines, **kwargs):
 		"""
 		Delete a node.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('name', help='Text to send')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
 		self.ensure_object_name("Node name", args.name)
 
-		node = scope.shell.get_sql_data("cf_nodes", ["id"], {"discord_sid":int(scope.server.id), "name":str(args.name)})
+		node = await scope.shell.get_sql_data_async("cf_nodes", ["id"], {"discord_sid":int(scope.server.id), "name":str(args.name)})
 		if not node:
 			await scope.shell.print_error(scope, "Node `"+args.name+"` not found.")
 			return
 
-		scope.shell.delete_sql_data("cf_nodes", {"discord_sid":int(scope.server.id), "name":str(args.name)})
+		await scope.shell.delete_sql_data_async("cf_nodes", {"discord_sid":int(scope.server.id), "name":str(args.name)})
+		if scope.server.id in self.graphs:
+			self.graphs[scope.server.id].delete_node(str(args.name))
 		await scope.shell.print_success(scope, "Node `"+args.name+"` delete.")
 
 	@praxisbot.command
 	@praxisbot.permission_admin
+	@praxisbot.argument('start', help='Name of the starting node')
+	@praxisbot.argument('end', help='Name of the final node')
 	async def execute_delete_cf_link(self, scope, command, options, lines, **kwargs):
 		"""
 		Delete a link between two nodes.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('start', help='Name of the starting node')
-		parser.add_argument('end', help='Name of the final node')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
 		self.ensure_object_name("Node name", args.start)
 		self.ensure_object_name("Node name", args.end)
 
-		link = scope.shell.get_sql_data("cf_links", ["id"], {"discord_sid":int(scope.server.id), "node_start":str(args.start), "node_end":str(args.end)})
+		link = await scope.shell.get_sql_data_async("cf_links", ["id"], {"discord_sid":int(scope.server.id), "node_start":str(args.start), "node_end":str(args.end)})
 		if not link:
 			await scope.shell.print_error(scope, "Link `"+args.start+" → "+args.end+"` not found.")
 			return
 
-		scope.shell.delete_sql_data("cf_links", {"discord_sid":int(scope.server.id), "node_start":str(args.start), "node_end":str(args.end)})
+		await scope.shell.delete_sql_data_async("cf_links", {"discord_sid":int(scope.server.id), "node_start":str(args.start), "node_end":str(args.end)})
+		if scope.server.id in self.graphs:
+			self.graphs[scope.server.id].delete_link(str(args.start), str(args.end))
 		await scope.shell.print_success(scope, "Link `"+args.start+" → "+args.end+"` delete.")
 
 	@praxisbot.command
@@ -303,62 +386,57 @@ class ConversationalFormPlugin(praxisbot.Plugin):
 		List all nodes and links
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
 		stream = praxisbot.MessageStream(scope)
 
-		with scope.shell.dbcon:
-			c0 = scope.shell.dbcon.cursor()
-			c1 = scope.shell.dbcon.cursor()
-
-			await stream.send("__**List of nodes**__")
-			for row in c0.execute("SELECT name, script FROM "+scope.shell.dbtable("cf_nodes")+" WHERE discord_sid = ? ORDER BY name", [int(scope.server.id)]):
-				await stream.send("\n\n:triangular_flag_on_post: **"+row[0]+"**")
-				for link in c1.execute("SELECT node_start, script FROM "+scope.shell.dbtable("cf_links")+" WHERE discord_sid = ? AND node_start = ? AND node_end == node_start ORDER BY node_start, priority DESC", [int(scope.server.id), str(row[0])]):
-					await stream.send("\n - Self link: **"+str(row[0])+"** → **"+str(row[0])+"**")
-				for link in c1.execute("SELECT node_start, script FROM "+scope.shell.dbtable("cf_links")+" WHERE discord_sid = ? AND node_end = ? AND node_end != node_start ORDER BY node_start, priority DESC", [int(scope.server.id), str(row[0])]):
-					await stream.send("\n - Incoming link: "+link[0]+" → **"+str(row[0])+"**")
-				for link in c1.execute("SELECT node_end, script FROM "+scope.shell.dbtable("cf_links")+" WHERE discord_sid = ? AND node_start = ? AND node_end != node_start ORDER BY node_end, priority DESC", [int(scope.server.id), str(row[0])]):
-					await stream.send("\n - Outcoming link: **"+str(row[0])+"** → "+link[0])
-				if len(row[1]) > 0:
-					await stream.send("\n - Script:")
-					await stream.send("\n```\n"+row[1]+"\n```")
-
-			await stream.send("\n\n__**List of links**__")
-			for row in c0.execute("SELECT node_start, node_end, script, type, value, priority FROM "+scope.shell.dbtable("cf_links")+" WHERE discord_sid = ? ORDER BY node_start, node_end", [int(scope.server.id)]):
-				await stream.send("\n\n:link: **"+row[0]+" → "+row[1]+"**")
-				await stream.send("\n - Priority: "+str(row[5]))
-				if row[3] == LinkType.UserRegex:
-					await stream.send("\n - Condition: user message match `"+row[4]+"`")
-				elif row[3] == LinkType.Timeout:
-					await stream.send("\n - Condition: timeout of "+row[4]+"")
-				elif row[3] == LinkType.Reaction:
-					await stream.send("\n - Condition: reaction added "+row[4]+"")
-				if len(row[2]) > 0:
-					await stream.send("\n - Script:")
-					await stream.send("\n```\n"+row[2]+"\n```")
+
+		await stream.send("__**List of nodes**__")
+		for row in await scope.shell.db.fetchall("SELECT name, script FROM "+scope.shell.dbtable("cf_nodes")+" WHERE discord_sid = ? ORDER BY name", [int(scope.server.id)]):
+			await stream.send("\n\n:triangular_flag_on_post: **"+row[0]+"**")
+			for link in await scope.shell.db.fetchall("SELECT node_start, script FROM "+scope.shell.dbtable("cf_links")+" WHERE discord_sid = ? AND node_start = ? AND node_end == node_start ORDER BY node_start, priority DESC", [int(scope.server.id), str(row[0])]):
+				await stream.send("\n - Self link: **"+str(row[0])+"** → **"+str(row[0])+"**")
+			for link in await scope.shell.db.fetchall("SELECT node_start, script FROM "+scope.shell.dbtable("cf_links")+" WHERE discord_sid = ? AND node_end = ? AND node_end != node_start ORDER BY node_start, priority DESC", [int(scope.server.id), str(row[0])]):
+				await stream.send("\n - Incoming link: "+link[0]+" → **"+str(row[0])+"**")
+			for link in await scope.shell.db.fetchall("SELECT node_end, script FROM "+scope.shell.dbtable("cf_links")+" WHERE discord_sid = ? AND node_start = ? AND node_end != node_start ORDER BY node_end, priority DESC", [int(scope.server.id), str(row[0])]):
+				await stream.send("\n - Outcoming link: **"+str(row[0])+"** → "+link[0])
+			if len(row[1]) > 0:
+				await stream.send("\n - Script:")
+				await stream.send("\n```\n"+row[1]+"\n```")
+
+		await stream.send("\n\n__**List of links**__")
+		for row in await scope.shell.db.fetchall("SELECT node_start, node_end, script, type, value, priority FROM "+scope.shell.dbtable("cf_links")+" WHERE discord_sid = ? ORDER BY node_start, node_end", [int(scope.server.id)]):
+			await stream.send("\n\n:link: **"+row[0]+" → "+row[1]+"**")
+			await stream.send("\n - Priority: "+str(row[5]))
+			if row[3] == LinkType.UserRegex:
+				await stream.send("\n - Condition: user message match `"+row[4]+"`")
+			elif row[3] == LinkType.Timeout:
+				await stream.send("\n - Condition: timeout of "+row[4]+"")
+			elif row[3] == LinkType.Reaction:
+				await stream.send("\n - Condition: reaction added "+row[4]+"")
+			if len(row[2]) > 0:
+				await stream.send("\n - Script:")
+				await stream.send("\n```\n"+row[2]+"\n```")
 
 		await stream.finish()
 
 	@praxisbot.command
 	@praxisbot.permission_script
+	@praxisbot.argument('node', help='Name of the starting node')
+	@praxisbot.argument('--timeout', help='Timeout after no response from users.')
 	async def execute_start_cf_session(self, scope, command, options, lines, **kwargs):
 		"""
 		Start a conversational session
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('node', help='Name of the starting node')
-		parser.add_argument('--timeout', help='Timeout after no response from users.')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
 		self.ensure_object_name("Node name", args.node)
-		node_start = scope.shell.get_sql_data("cf_nodes", ["id"], {"discord_sid":int(scope.server.id), "name":str(args.node)})
+		node_start = await scope.shell.get_sql_data_async("cf_nodes", ["id"], {"discord_sid":int(scope.server.id), "name":str(args.node)})
 		if not node_start:
 			await scope.shell.print_error(scope, "Node `"+args.node+"` not found.")
 			return
@@ -387,8 +465,7 @@ class ConversationalFormPlugin(praxisbot.Plugin):
 		End a conversational session
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -405,8 +482,7 @@ class ConversationalFormPlugin(praxisbot.Plugin):
 		List active conversational sessions
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
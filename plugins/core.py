@@ -18,7 +18,6 @@ along with PraxisBot.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
-import shlex
 import argparse
 import re
 import discord
@@ -28,7 +27,7 @@ import datetime
 from pytz import timezone
 from dateutil.relativedelta import relativedelta
 import praxisbot
-from io import StringIO
+from io import BytesIO
 
 class CorePlugin(praxisbot.Plugin):
 	"""
@@ -40,7 +39,7 @@ class CorePlugin(praxisbot.Plugin):
 	def __init__(self, shell):
 		super().__init__(shell)
 
-		self.shell.create_sql_table("variables", ["id INTEGER PRIMARY KEY", "discord_sid INTEGER", "name TEXT", "value TEXT"])
+		self.shell.migrate_sql_schema(self.name, [self.create_tables])
 
 		self.add_command("help", self.execute_help)
 		self.add_command("say", self.execute_say)
@@ -49,6 +48,9 @@ class CorePlugin(praxisbot.Plugin):
 		self.add_command("variables", self.execute_variables)
 		self.add_command("change_roles", self.execute_change_roles)
 		self.add_command("set_command_prefix", self.execute_set_command_prefix)
+		self.add_command("script_limits", self.execute_script_limits)
+		self.add_command("profile", self.execute_profile)
+		self.add_command("event_queues", self.execute_event_queues)
 		self.add_command("script", self.execute_script)
 		self.add_command("exit", self.execute_exit)
 		self.add_command("for", self.execute_for)
@@ -59,6 +61,10 @@ class CorePlugin(praxisbot.Plugin):
 		self.add_command("silent", self.execute_silent)
 		self.add_command("cite", self.execute_cite)
 
+	def create_tables(self):
+		self.shell.create_sql_table("variables", ["id INTEGER PRIMARY KEY", "discord_sid INTEGER", "name TEXT", "value TEXT"], [["discord_sid", "name"]])
+		self.shell.create_sql_table("servers", ["discord_sid INTEGER PRIMARY KEY", "command_prefix TEXT", "script_instructions INTEGER", "script_duration INTEGER", "script_output INTEGER", "script_api_calls INTEGER"])
+
 	@praxisbot.command
 	async def execute_help(self, scope, command, options, lines, **kwargs):
 		"""
@@ -66,14 +72,8 @@ class CorePlugin(praxisbot.Plugin):
 		"""
 
 		stream = praxisbot.MessageStream(scope)
-		for p in scope.shell.plugins:
-			await stream.send("\n**"+p.name+"**\n\n")
-			for c in p.cmds:
-				desc =	inspect.getdoc(p.cmds[c])
-				if desc:
-					await stream.send(" - `"+c+"` : "+desc+"\n")
-				else:
-					await stream.send(" - `"+c+"`\n")
+		for line in scope.shell.get_help():
+			await stream.send(line)
 
 		await stream.finish()
 
@@ -83,8 +83,7 @@ class CorePlugin(praxisbot.Plugin):
 		Execute a list of commands.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -105,8 +104,7 @@ class CorePlugin(praxisbot.Plugin):
 		Stop the execution of the current script.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -114,26 +112,25 @@ class CorePlugin(praxisbot.Plugin):
 		return scope
 
 	@praxisbot.command
+	@praxisbot.argument('firstvar', help='First values', metavar='VALUE')
+	@praxisbot.argument('--equal', help='Test if A = B', metavar='VALUE')
+	@praxisbot.argument('--hasroles', nargs='+', help='Test if a member has one of the listed roles', metavar='ROLE')
+	@praxisbot.argument('--ismember', action='store_true', help='Test if a parameter is a valid member')
+	@praxisbot.argument('--iswritable', action='store_true', help='Test if a parameter is a writable text channel')
+	@praxisbot.argument('--isrole', action='store_true', help='Test if a parameter is a valid role')
+	@praxisbot.argument('--isdate', action='store_true', help='Test if a parameter is a valid date')
+	@praxisbot.argument('--not', dest='inverse', action='store_true', help='Inverse the result of the test')
+	@praxisbot.argument('--find', help='Return truc if an occurence of B is found in A (case insensitive)')
+	@praxisbot.argument('--inset', help='Return truc if B is in the set A')
+	@praxisbot.argument('--regex', help='Return true if A match the regular expression B')
+	@praxisbot.argument('--inf', help='Return true if A is inferior to B')
+	@praxisbot.argument('--sup', help='Return true if A is superior to B')
 	async def execute_if(self, scope, command, options, lines, **kwargs):
 		"""
 		Check conditions. Used with `else` and `endif`.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('firstvar', help='First values', metavar='VALUE')
-		parser.add_argument('--equal', help='Test if A = B', metavar='VALUE')
-		parser.add_argument('--hasroles', nargs='+', help='Test if a member has one of the listed roles', metavar='ROLE')
-		parser.add_argument('--ismember', action='store_true', help='Test if a parameter is a valid member')
-		parser.add_argument('--iswritable', action='store_true', help='Test if a parameter is a writable text channel')
-		parser.add_argument('--isrole', action='store_true', help='Test if a parameter is a valid role')
-		parser.add_argument('--isdate', action='store_true', help='Test if a parameter is a valid date')
-		parser.add_argument('--not', dest='inverse', action='store_true', help='Inverse the result of the test')
-		parser.add_argument('--find', help='Return truc if an occurence of B is found in A (case insensitive)')
-		parser.add_argument('--inset', help='Return truc if B is in the set A')
-		parser.add_argument('--regex', help='Return true if A match the regular expression B')
-		parser.add_argument('--inf', help='Return true if A is inferior to B')
-		parser.add_argument('--sup', help='Return true if A is superior to B')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -219,6 +216,9 @@ class CorePlugin(praxisbot.Plugin):
 		scope.blocks.append(praxisbot.ExecutionBlockIf(res))
 
 	@praxisbot.command
+	@praxisbot.argument('name', help='Name of the iterator', metavar='VALUE')
+	@praxisbot.argument('--in', dest="list", nargs='+', help='List of elements', metavar='ELEMENT')
+	@praxisbot.argument('--inset', help='Name of a variable containing a set', metavar='VARIABLE')
 	async def execute_for(self, scope, command, options, lines, **kwargs):
 		"""
 		Execute commands until condition. Used with `endfor`.
@@ -230,11 +230,7 @@ class CorePlugin(praxisbot.Plugin):
 				scope.abort = True
 				return
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('name', help='Name of the iterator', metavar='VALUE')
-		parser.add_argument('--in', dest="list", nargs='+', help='List of elements', metavar='ELEMENT')
-		parser.add_argument('--inset', help='Name of a variable containing a set', metavar='VARIABLE')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -252,23 +248,22 @@ class CorePlugin(praxisbot.Plugin):
 		scope.blocks.append(praxisbot.ExecutionBlockFor(var, list))
 
 	@praxisbot.command
+	@praxisbot.argument('name', help='Variable name')
+	@praxisbot.argument('value', nargs='?', help='Variable value')
+	@praxisbot.argument('--global', dest='glob', action='store_true', help='Set the variable for all commands on this server')
+	@praxisbot.argument('--session', action='store_true', help='Set the variable for an user session')
+	@praxisbot.argument('--dateadd', help='Add a duration to a date. YYYY-MM-DD HH:MM:SS')
+	@praxisbot.argument('--intadd', help='Add the integer value to the variable')
+	@praxisbot.argument('--intremove', help='Remove the integer value from the variable')
+	@praxisbot.argument('--setadd', nargs='+', help='Add elements in the set')
+	@praxisbot.argument('--setremove', nargs='+', help='Remove elements from the set')
+	@praxisbot.argument('--members', nargs='*', help='Get all members that are at least in one of the listed groups')
 	async def execute_set_variable(self, scope, command, options, lines, **kwargs):
 		"""
 		Update local and global variables.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('name', help='Variable name')
-		parser.add_argument('value', nargs='?', help='Variable value')
-		parser.add_argument('--global', dest='glob', action='store_true', help='Set the variable for all commands on this server')
-		parser.add_argument('--session', action='store_true', help='Set the variable for an user session')
-		parser.add_argument('--dateadd', help='Add a duration to a date. YYYY-MM-DD HH:MM:SS')
-		parser.add_argument('--intadd', help='Add the integer value to the variable')
-		parser.add_argument('--intremove', help='Remove the integer value from the variable')
-		parser.add_argument('--setadd', nargs='+', help='Add elements in the set')
-		parser.add_argument('--setremove', nargs='+', help='Remove elements from the set')
-		parser.add_argument('--members', nargs='*', help='Get all members that are at least in one of the listed groups')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -375,7 +370,7 @@ class CorePlugin(praxisbot.Plugin):
 			scope.session_vars[var] = val
 
 		if args.glob:
-			scope.shell.set_sql_data("variables", {"value":str(val)}, {"discord_sid": int(scope.server.id), "name": str(var)})
+			scope.shell.set_global_variable(scope.server, str(var), str(val))
 
 		await scope.shell.print_success(scope, "`"+str(var)+"` is now equal to:\n```\n"+str(val)+"```")
 
@@ -386,8 +381,7 @@ class CorePlugin(praxisbot.Plugin):
 		List all current variables.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -402,26 +396,25 @@ class CorePlugin(praxisbot.Plugin):
 
 
 	@praxisbot.command
+	@praxisbot.argument('message', nargs="?", help='Text to send')
+	@praxisbot.argument('--channel', '-c', help='Channel where to send the message')
+	@praxisbot.argument('--title', '-t', help='Embed title')
+	@praxisbot.argument('--description', '-d', help='Embed description')
+	@praxisbot.argument('--footer', '-f', help='Embed footer')
+	@praxisbot.argument('--footerimage', help='Embed footer image')
+	@praxisbot.argument('--image', '-i', help='Embed image')
+	@praxisbot.argument('--thumbnail', '-m', help='Embed thumbnail')
+	@praxisbot.argument('--author', '-a', help='Embed author name')
+	@praxisbot.argument('--authorimage', help='Embed author image')
+	@praxisbot.argument('--authorurl', help='Embed author URL')
+	@praxisbot.argument('--fields', nargs="+", help='List of key/value')
+	@praxisbot.argument('--reactions', nargs='+', help='Name of a variable containing a set', metavar='EMOJI')
 	async def execute_say(self, scope, command, options, lines, **kwargs):
 		"""
 		Send a message.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('message', nargs="?", help='Text to send')
-		parser.add_argument('--channel', '-c', help='Channel where to send the message')
-		parser.add_argument('--title', '-t', help='Embed title')
-		parser.add_argument('--description', '-d', help='Embed description')
-		parser.add_argument('--footer', '-f', help='Embed footer')
-		parser.add_argument('--footerimage', help='Embed footer image')
-		parser.add_argument('--image', '-i', help='Embed image')
-		parser.add_argument('--thumbnail', '-m', help='Embed thumbnail')
-		parser.add_argument('--author', '-a', help='Embed author name')
-		parser.add_argument('--authorimage', help='Embed author image')
-		parser.add_argument('--authorurl', help='Embed author URL')
-		parser.add_argument('--fields', nargs="+", help='List of key/value')
-		parser.add_argument('--reactions', nargs='+', help='Name of a variable containing a set', metavar='EMOJI')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -487,6 +480,7 @@ class CorePlugin(praxisbot.Plugin):
 						field_key = None
 
 		if e or len(formatedText) > 0:
+			scope.budget.use_output(formatedText)
 			msg = await scope.shell.send_message(subScope.channel, formatedText, e)
 			if args.reactions:
 				for emoji in args.reactions:
@@ -497,16 +491,15 @@ class CorePlugin(praxisbot.Plugin):
 
 	@praxisbot.command
 	@praxisbot.permission_script
+	@praxisbot.argument('user', help='User name')
+	@praxisbot.argument('--add', nargs='*', help='A list of roles to add', default=[])
+	@praxisbot.argument('--remove', nargs='*', help='A list of roles to remove', default=[])
 	async def execute_change_roles(self, scope, command, options, lines, **kwargs):
 		"""
 		Change roles of a member.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('user', help='User name')
-		parser.add_argument('--add', nargs='*', help='A list of roles to add', default=[])
-		parser.add_argument('--remove', nargs='*', help='A list of roles to remove', default=[])
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -542,32 +535,150 @@ class CorePlugin(praxisbot.Plugin):
 
 	@praxisbot.command
 	@praxisbot.permission_admin
+	@praxisbot.argument('prefix', help='Prefix')
 	async def execute_set_command_prefix(self, scope, command, options, lines, **kwargs):
 		"""
 		Set the prefix used to send commands.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('prefix', help='Prefix')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
-		scope.shell.set_sql_data("servers", {"command_prefix": str(args.prefix)}, {"discord_sid": int(scope.server.id)}, "discord_sid")
+		await scope.shell.set_command_prefix(scope.server, str(args.prefix))
 		await scope.shell.print_success(scope, "Command prefix changed to ``"+args.prefix+"``.")
 
 	@praxisbot.command
+	@praxisbot.permission_admin
+	@praxisbot.argument('--instructions', help='Maximum number of commands executed by a script')
+	@praxisbot.argument('--duration', help='Maximum execution time of a script in seconds')
+	@praxisbot.argument('--output', help='Maximum number of characters sent by a script')
+	@praxisbot.argument('--apicalls', help='Maximum number of Discord requests made by a script')
+	@praxisbot.argument('--reset', action='store_true', help='Use default limits')
+	async def execute_script_limits(self, scope, command, options, lines, **kwargs):
+		"""
+		Show or change the resources that scripts can use.
+		"""
+
+		args = await self.parse_options(scope, kwargs["parser"], options)
+		if not args:
+			return
+
+		limits = scope.shell.get_server_settings(scope.server).limits
+		if args.reset or args.instructions or args.duration or args.output or args.apicalls:
+			if args.reset:
+				newLimits = praxisbot.ScriptLimits()
+			else:
+				newLimits = praxisbot.ScriptLimits(limits.instructions, limits.duration, limits.output, limits.api_calls)
+
+			if args.instructions:
+				self.ensure_integer("Instructions", args.instructions)
+				newLimits.instructions = int(args.instructions)
+			if args.duration:
+				self.ensure_integer("Duration", args.duration)
+				newLimits.duration = int(args.duration)
+			if args.output:
+				self.ensure_integer("Output", args.output)
+				newLimits.output = int(args.output)
+			if args.apicalls:
+				self.ensure_integer("API calls", args.apicalls)
+				newLimits.api_calls = int(args.apicalls)
+
+			await scope.shell.set_script_limits(scope.server, newLimits)
+			limits = newLimits
+
+		text = "Script limits:"
+		text = text+"\n - Commands: "+str(limits.get("instructions"))
+		text = text+"\n - Duration: "+str(limits.get("duration"))+" seconds"
+		text = text+"\n - Output: "+str(limits.get("output"))+" characters"
+		text = text+"\n - Discord requests: "+str(limits.get("api_calls"))
+		await scope.shell.print_info(scope, text)
+
+	@praxisbot.command
+	@praxisbot.permission_admin
+	@praxisbot.argument('--sort', '-s', choices=['total', 'average', 'count', 'p95', 'db', 'http'], default='total', help='Sort order')
+	@praxisbot.argument('--limit', '-l', default='20', help='Number of commands and scripts to show')
+	@praxisbot.argument('--dump', action='store_true', help='Send all measures as a JSON file')
+	@praxisbot.argument('--reset', action='store_true', help='Delete all measures of this server')
+	async def execute_profile(self, scope, command, options, lines, **kwargs):
+		"""
+		Show the execution time of commands and triggers.
+		"""
+
+		args = await self.parse_options(scope, kwargs["parser"], options)
+		if not args:
+			return
+
+		profiler = scope.shell.profiler
+
+		if args.reset:
+			profiler.reset(scope.server.id)
+			await scope.shell.print_success(scope, "Profile deleted.")
+			return
+
+		if args.dump:
+			f = BytesIO(profiler.to_json(scope.server.id).encode('UTF-8'))
+			await scope.shell.client.send_file(scope.channel, f, filename="profile-"+scope.server.id+".json")
+			return
+
+		self.ensure_integer("Limit", args.limit)
+
+		sortKeys = {
+			"total": lambda e: e[2].total,
+			"average": lambda e: e[2].total/e[2].count,
+			"count": lambda e: e[2].count,
+			"p95": lambda e: e[2].percentile(95),
+			"db": lambda e: e[2].db_time,
+			"http": lambda e: e[2].http_time
+		}
+		entries = profiler.get_server_stats(scope.server.id)
+		entries.sort(key=sortKeys[args.sort], reverse=True)
+
+		stream = praxisbot.MessageStream(scope)
+		await stream.send("__**Profile**__\n")
+		for e in entries[0:int(args.limit)]:
+			s = e[2]
+			text = "\n**"+e[1]+"** ("+e[0]+"): "+str(s.count)+" calls, total "+str(int(s.total*1000))+" ms, avg "+str(int(s.total*1000/s.count))+" ms"
+			text = text+", p50 "+str(s.percentile(50))+" ms, p95 "+str(s.percentile(95))+" ms, p99 "+str(s.percentile(99))+" ms, max "+str(int(s.max*1000))+" ms"
+			text = text+", DB "+str(int(s.db_time*1000))+" ms, HTTP "+str(int(s.http_time*1000))+" ms"
+			await stream.send(text)
+		await stream.finish()
+
+	@praxisbot.command
+	@praxisbot.permission_admin
+	async def execute_event_queues(self, scope, command, options, lines, **kwargs):
+		"""
+		Show the events waiting to be processed and the events dropped because the queue was full.
+		"""
+
+		args = await self.parse_options(scope, kwargs["parser"], options)
+		if not args:
+			return
+
+		eventQueues = getattr(scope.shell.client, "event_queues", None)
+		if not eventQueues:
+			await scope.shell.print_error(scope, "Events are not queued.")
+			return
+
+		serverStats = eventQueues.get_server_stats(scope.server.id)
+		stats = eventQueues.get_stats()
+		text = "Event queues:"
+		text = text+"\n - This server: "+str(serverStats["pending"])+" pending, "+str(serverStats["dropped"])+" dropped"
+		text = text+"\n - All servers: "+str(stats["pending"])+" pending in "+str(stats["servers"])+" queues, "+str(stats["dropped"])+" dropped, "+str(stats["processed"])+" processed"
+		text = text+"\n - Longest queue: "+str(stats["max_length"])+" events (limit "+str(eventQueues.max_queue_size)+")"
+		await scope.shell.print_info(scope, text)
+
+	@praxisbot.command
+	@praxisbot.argument('regex', help='Regular expression')
+	@praxisbot.argument('data', help='Target string')
+	@praxisbot.argument('--var', help='Variable that will contains the result')
+	@praxisbot.argument('--output', help='Format of the output. Use {{result}}, {{result0}}, {{result1}}, ....', default="{{result}}")
 	async def execute_regex(self, scope, command, options, lines, **kwargs):
 		"""
 		Extract data from a string using regular expression.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('regex', help='Regular expression')
-		parser.add_argument('data', help='Target string')
-		parser.add_argument('--var', help='Variable that will contains the result')
-		parser.add_argument('--output', help='Format of the output. Use {{result}}, {{result0}}, {{result1}}, ....', default="{{result}}")
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -595,15 +706,14 @@ class CorePlugin(praxisbot.Plugin):
 			return
 
 	@praxisbot.command
+	@praxisbot.argument('user', help='An user')
+	@praxisbot.argument('--channel', '-c', help='Channel where to send the message')
 	async def execute_whois(self, scope, command, options, lines, **kwargs):
 		"""
 		Get all available informations about an user.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('user', help='An user')
-		parser.add_argument('--channel', '-c', help='Channel where to send the message')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -695,8 +805,7 @@ class CorePlugin(praxisbot.Plugin):
 		Delete the message that trigger the current execution.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -708,8 +817,7 @@ class CorePlugin(praxisbot.Plugin):
 		Print all messages.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -721,24 +829,22 @@ class CorePlugin(praxisbot.Plugin):
 		Don't print any feedback during execution.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
 		scope.verbose = 0
 
 	@praxisbot.command
+	@praxisbot.argument('messageid', help='Message ID or URL to cite')
+	@praxisbot.argument('--channel', help='Channel where the cited message is')
+	@praxisbot.argument('--server', help='Server where the cited message is')
 	async def execute_cite(self, scope, command, options, lines, **kwargs):
 		"""
 		Cite a message.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('messageid', help='Message ID or URL to cite')
-		parser.add_argument('--channel', help='Channel where the cited message is')
-		parser.add_argument('--server', help='Server where the cited message is')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
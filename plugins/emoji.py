@@ -18,13 +18,11 @@ along with PraxisBot.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
-import shlex
 import argparse
 import re
 import discord
 import traceback
 import datetime
-import io
 import requests
 import praxisbot
 
@@ -45,15 +43,14 @@ class EmojiPlugin(praxisbot.Plugin):
 
 	@praxisbot.command
 	@praxisbot.permission_admin
+	@praxisbot.argument('name', help='Name of the emoji')
+	@praxisbot.argument('url', help='URL of the emoji')
 	async def execute_create_emoji(self, scope, command, options, lines, **kwargs):
 		"""
 		Create a custom emoji on the server.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('name', help='Name of the emoji')
-		parser.add_argument('url', help='URL of the emoji')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -73,14 +70,13 @@ class EmojiPlugin(praxisbot.Plugin):
 
 	@praxisbot.command
 	@praxisbot.permission_admin
+	@praxisbot.argument('name', help='Name of the emoji')
 	async def execute_delete_emoji(self, scope, command, options, lines, **kwargs):
 		"""
 		Delete a custom emoji from the server.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('name', help='Name of the emoji')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -93,14 +89,13 @@ class EmojiPlugin(praxisbot.Plugin):
 		await scope.shell.print_success(scope, "Emoji `:"+emoji.name+":` deleted.")
 
 	@praxisbot.command
+	@praxisbot.argument('name', help='Name of the emoji')
 	async def execute_test_emoji(self, scope, command, options, lines, **kwargs):
 		"""
 		Display a custom emoji in all sizes.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('name', help='Name of the emoji')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -120,8 +115,7 @@ class EmojiPlugin(praxisbot.Plugin):
 		List of all custom emojis
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
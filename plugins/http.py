@@ -18,7 +18,6 @@ along with PraxisBot.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
-import shlex
 import argparse
 import re
 import requests
@@ -38,7 +37,7 @@ class HTTPPlugin(praxisbot.Plugin):
 
 		self.cookiename_regex = re.compile('[a-zA-Z0-9_-]+')
 
-		self.shell.create_sql_table("cookies", ["id INTEGER PRIMARY KEY", "nameid TEXT", "discord_sid INTEGER", "name TEXT", "content TEXT", "filter TEXT"])
+		self.shell.migrate_sql_schema(self.name, [self.create_tables])
 
 		self.add_command("if_http", self.execute_if_http)
 		self.add_command("create_cookie", self.execute_create_cookie)
@@ -46,7 +45,13 @@ class HTTPPlugin(praxisbot.Plugin):
 		self.add_command("download", self.execute_download)
 		self.add_command("upload", self.execute_upload)
 
+	def create_tables(self):
+		self.shell.create_sql_table("cookies", ["id INTEGER PRIMARY KEY", "nameid TEXT", "discord_sid INTEGER", "name TEXT", "content TEXT", "filter TEXT"], [["discord_sid", "nameid"]])
+
 	@praxisbot.command
+	@praxisbot.argument('id', help='ID of the cookie. This ID is used to delete the cookie.')
+	@praxisbot.argument('name', help='Name of the cookie.')
+	@praxisbot.argument('filter', help='Regular expression that restrict usage of the cookie.')
 	async def execute_create_cookie(self, scope, command, options, lines, **kwargs):
 		"""
 		Create a cookie for HTTP requests.
@@ -54,11 +59,7 @@ class HTTPPlugin(praxisbot.Plugin):
 
 		scope.deletecmd = True
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('id', help='ID of the cookie. This ID is used to delete the cookie.')
-		parser.add_argument('name', help='Name of the cookie.')
-		parser.add_argument('filter', help='Regular expression that restrict usage of the cookie.')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -68,12 +69,12 @@ class HTTPPlugin(praxisbot.Plugin):
 
 		self.ensure_object_name("Cookie ID", args.id)
 
-		cookieID = scope.shell.get_sql_data("cookies", ["id"], {"discord_sid": int(scope.server.id), "nameid": str(args.id)})
+		cookieID = await scope.shell.get_sql_data_async("cookies", ["id"], {"discord_sid": int(scope.server.id), "nameid": str(args.id)})
 		if cookieID:
 			await scope.shell.print_error(scope, "The cookie `"+str(args.id)+"` already exists.")
 			return
 
-		scope.shell.set_sql_data("cookies", {"name": str(args.name), "content": str("\n".join(lines)), "filter": str(args.filter)}, {"discord_sid": int(scope.server.id), "nameid": str(args.id)})
+		await scope.shell.set_sql_data_async("cookies", {"name": str(args.name), "content": str("\n".join(lines)), "filter": str(args.filter)}, {"discord_sid": int(scope.server.id), "nameid": str(args.id)})
 		await scope.shell.print_success(scope, "Cookie `"+str(args.id)+"` added.")
 
 	@praxisbot.command
@@ -83,33 +84,29 @@ class HTTPPlugin(praxisbot.Plugin):
 		List all cookies.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
 		stream = praxisbot.MessageStream(scope)
 		await stream.send("**List of HTTP cookies**\n")
 
-		with scope.shell.dbcon:
-			c = scope.shell.dbcon.cursor()
-			for row in c.execute("SELECT nameid, filter FROM "+scope.shell.dbtable("cookies")+" WHERE discord_sid = ? ORDER BY name", [int(scope.server.id)]):
-				await stream.send("\n - "+row[0]+": `"+row[1]+"`")
+		for row in await scope.shell.db.fetchall("SELECT nameid, filter FROM "+scope.shell.dbtable("cookies")+" WHERE discord_sid = ? ORDER BY name", [int(scope.server.id)]):
+			await stream.send("\n - "+row[0]+": `"+row[1]+"`")
 
 		await stream.finish()
 
 	@praxisbot.command
 	@praxisbot.permission_script
+	@praxisbot.argument('url', help='First values', metavar='VALUE')
+	@praxisbot.argument('--valid', action='store_true', help='Test if the URL is valid.')
+	@praxisbot.argument('--not', dest='inverse', action='store_true', help='Inverse the result of the test')
 	async def execute_if_http(self, scope, command, options, lines, **kwargs):
 		"""
 		Perform tests on URLs. Used with `endif`.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('url', help='First values', metavar='VALUE')
-		parser.add_argument('--valid', action='store_true', help='Test if the URL is valid.')
-		parser.add_argument('--not', dest='inverse', action='store_true', help='Inverse the result of the test')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -117,7 +114,8 @@ class HTTPPlugin(praxisbot.Plugin):
 		res = False
 		if args.valid:
 			url = scope.format_text(args.url)
-			httpResult = requests.head(url, allow_redirects=True)
+			scope.budget.use_api_call()
+			httpResult = requests.head(url, allow_redirects=True, timeout=scope.budget.remaining_time())
 			res = httpResult.ok
 
 		if args.inverse:
@@ -127,17 +125,16 @@ class HTTPPlugin(praxisbot.Plugin):
 
 	@praxisbot.command
 	@praxisbot.permission_script
+	@praxisbot.argument('url', help='URL to download')
+	@praxisbot.argument('--filename', help='Filename sent in Discord')
+	@praxisbot.argument('--var', help='Variable that will contains the file')
+	@praxisbot.argument('--cookie', help='Name of a cookie to send with the request.')
 	async def execute_download(self, scope, command, options, lines, **kwargs):
 		"""
 		Download from an URL.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('url', help='URL to download')
-		parser.add_argument('--filename', help='Filename sent in Discord')
-		parser.add_argument('--var', help='Variable that will contains the file')
-		parser.add_argument('--cookie', help='Name of a cookie to send with the request.')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -145,7 +142,7 @@ class HTTPPlugin(praxisbot.Plugin):
 		result = None
 		cookies = {}
 		if args.cookie:
-			cookieData = scope.shell.get_sql_data("cookies", ["name", "content", "filter"], {"discord_sid": int(scope.server.id), "nameid": str(args.cookie)})
+			cookieData = await scope.shell.get_sql_data_async("cookies", ["name", "content", "filter"], {"discord_sid": int(scope.server.id), "nameid": str(args.cookie)})
 			if not cookieData:
 				await scope.shell.print_error(scope, "Cookie `"+args.cookie+"` not found.")
 				return
@@ -155,8 +152,9 @@ class HTTPPlugin(praxisbot.Plugin):
 
 			cookies[cookieData[0]] = cookieData[1]
 
+		scope.budget.use_api_call()
 		try:
-			result = requests.get(url, allow_redirects=True, cookies=cookies, stream=True)
+			result = requests.get(url, allow_redirects=True, cookies=cookies, stream=True, timeout=scope.budget.remaining_time())
 			if not result.ok:
 				result = None
 
@@ -178,15 +176,14 @@ class HTTPPlugin(praxisbot.Plugin):
 
 
 	@praxisbot.command
+	@praxisbot.argument('data', help='Data that will be contains in the file')
+	@praxisbot.argument('filename', help='Name of the file that will be uploaded')
 	async def execute_upload(self, scope, command, options, lines, **kwargs):
 		"""
 		Upload files on Discord.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('data', help='Data that will be contains in the file')
-		parser.add_argument('filename', help='Name of the file that will be uploaded')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -37,7 +37,6 @@ import numpy as np
 from scipy import interpolate, signal
 import matplotlib.font_manager as fm
 
-import shlex
 import argparse
 import discord
 import traceback
@@ -361,20 +360,19 @@ $
 			return
 
 	@praxisbot.command
+	@praxisbot.argument('--title', help='Plot title')
+	@praxisbot.argument('--xlabel', help='X axis label')
+	@praxisbot.argument('--ylabel', help='Y axis label')
+	@praxisbot.argument('--bluecurve', nargs='+', help='Plot a blue curve', metavar='VALUE')
+	@praxisbot.argument('--redcurve', nargs='+', help='Plot a red curve', metavar='VALUE')
+	@praxisbot.argument('--orangecurve', nargs='+', help='Plot a orange curve', metavar='VALUE')
+	@praxisbot.argument('--greencurve', nargs='+', help='Plot a green curve', metavar='VALUE')
 	async def execute_xkcd_plot(self, scope, command, options, lines, **kwargs):
 		"""
 		Plot curves with xkcd style.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('--title', help='Plot title')
-		parser.add_argument('--xlabel', help='X axis label')
-		parser.add_argument('--ylabel', help='Y axis label')
-		parser.add_argument('--bluecurve', nargs='+', help='Plot a blue curve', metavar='VALUE')
-		parser.add_argument('--redcurve', nargs='+', help='Plot a red curve', metavar='VALUE')
-		parser.add_argument('--orangecurve', nargs='+', help='Plot a orange curve', metavar='VALUE')
-		parser.add_argument('--greencurve', nargs='+', help='Plot a green curve', metavar='VALUE')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -18,14 +18,12 @@ along with PraxisBot.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
-import shlex
 import argparse
 import re
 import discord
 import traceback
 import datetime
 from pytz import timezone
-import io
 import sqlite3
 import praxisbot
 
@@ -44,8 +42,7 @@ class ModerationPlugin(praxisbot.Plugin):
 	def __init__(self, shell):
 		super().__init__(shell)
 
-		self.shell.create_sql_table("mod_levels", ["id INTEGER PRIMARY KEY", "discord_sid INTEGER", "name TEXT", "priority INTEGER", "type INTEGER", "value TEXT", "ban_timelimit INTEGER", "ban_prioritylimit INTEGER", "purge INTEGER"])
-		self.shell.create_sql_table("ban_time", ["id INTEGER PRIMARY KEY", "discord_sid INTEGER", "discord_uid INTEGER", "last_time DATETIME"])
+		self.shell.migrate_sql_schema(self.name, [self.create_tables, self.convert_times_to_epoch, self.create_indexes])
 
 		self.add_command("ban", self.execute_ban)
 		self.add_command("last_bans", self.execute_last_bans)
@@ -58,19 +55,32 @@ class ModerationPlugin(praxisbot.Plugin):
 		self.add_command("set_mod_options", self.execute_set_mod_options)
 		self.add_command("purge", self.execute_purge)
 
-	def get_mod_level(self, member):
-		if not member:
-			return {
-				"name":"",
-				"priority":-1,
-				"ban_timelimit":0,
-				"ban_prioritylimit":-1,
-				"purge":False
-			}
+		self.mod_rules = {}
+		self.member_levels = {}
+
+	def create_tables(self):
+		self.shell.create_sql_table("mod_levels", ["id INTEGER PRIMARY KEY", "discord_sid INTEGER", "name TEXT", "priority INTEGER", "type INTEGER", "value TEXT", "ban_timelimit INTEGER", "ban_prioritylimit INTEGER", "purge INTEGER"])
+		self.shell.create_sql_table("ban_time", ["id INTEGER PRIMARY KEY", "discord_sid INTEGER", "discord_uid INTEGER", "last_time DATETIME"], [["discord_sid", "discord_uid"]])
 
+	def convert_times_to_epoch(self):
+		self.shell.rebuild_sql_table("ban_time", ["id INTEGER PRIMARY KEY", "discord_sid INTEGER", "discord_uid INTEGER", "last_time INTEGER"], {"last_time": self.shell.sql_epoch("last_time")})
+		self.shell.create_sql_unique_index("ban_time", ["discord_sid", "discord_uid"])
+
+	def create_indexes(self):
+		self.shell.create_sql_index("mod_levels", ["discord_sid", "priority"])
+		self.shell.create_sql_index("mod_levels", ["discord_sid", "name"])
+
+	def get_mod_rules(self, server):
+		"""
+		Return the mod levels of a server compiled into maps of user and role ids to levels, and a list of channel levels sorted by priority
+		"""
+		if server.id in self.mod_rules:
+			return self.mod_rules[server.id]
+
+		rules = {"users":{}, "roles":{}, "channels":[]}
 		with self.shell.dbcon:
 			c = self.shell.dbcon.cursor()
-			for row in c.execute("SELECT type, value, name, priority, ban_timelimit, ban_prioritylimit, purge FROM "+self.shell.dbtable("mod_levels")+" WHERE discord_sid = ? ORDER BY priority DESC", [int(member.server.id)]):
+			for row in c.execute("SELECT type, value, name, priority, ban_timelimit, ban_prioritylimit, purge FROM "+self.shell.dbtable("mod_levels")+" WHERE discord_sid = ? ORDER BY priority DESC", [int(server.id)]):
 				res = {
 					"name":row[2],
 					"priority":row[3],
@@ -90,17 +100,58 @@ class ModerationPlugin(praxisbot.Plugin):
 				else:
 					res["purge"] = 0
 
+				#Rows are sorted by priority: the first level of a user or a role is kept
 				if row[0] == ModLevelType.User:
-					if row[1] == member.id:
-						return res
-				if row[0] == ModLevelType.Role:
-					for r in member.roles:
-						if r.id == row[1]:
-							return res
-				if row[0] == ModLevelType.Channel:
-					chan = self.shell.find_channel("<#"+row[1]+">", member.server)
-					if chan and chan.permissions_for(member).send_messages:
-						return res
+					rules["users"].setdefault(row[1], res)
+				elif row[0] == ModLevelType.Role:
+					rules["roles"].setdefault(row[1], res)
+				elif row[0] == ModLevelType.Channel:
+					rules["channels"].append((row[1], res))
+
+		self.mod_rules[server.id] = rules
+		return rules
+
+	def invalidate_mod_levels(self, server):
+		self.mod_rules.pop(server.id, None)
+		self.member_levels = {k: v for k, v in self.member_levels.items() if k[0] != server.id}
+
+	def get_mod_level(self, member):
+		if not member:
+			return {
+				"name":"",
+				"priority":-1,
+				"ban_timelimit":0,
+				"ban_prioritylimit":-1,
+				"purge":False
+			}
+
+		rules = self.get_mod_rules(member.server)
+
+		#Levels given by user and roles are kept with the roles they were computed from, and computed again
+		#as soon as the roles of the member differ (role update, deleted role, member joining again...)
+		key = (member.server.id, member.id)
+		roleIds = frozenset(r.id for r in member.roles)
+		cached = self.member_levels.get(key)
+		if cached and cached[0] == roleIds:
+			level = cached[1]
+		else:
+			level = rules["users"].get(member.id)
+			for r in member.roles:
+				roleLevel = rules["roles"].get(r.id)
+				if roleLevel and (not level or roleLevel["priority"] > level["priority"]):
+					level = roleLevel
+			self.member_levels[key] = (roleIds, level)
+
+		#Channel permissions can change at any time: only checked when they can give a higher level
+		for rule in rules["channels"]:
+			if level and rule[1]["priority"] <= level["priority"]:
+				break
+			chan = member.server.get_channel(rule[0])
+			if chan and chan.permissions_for(member).send_messages:
+				return rule[1]
+
+		if level:
+			return level
 
 		return {
 			"name":"",
@@ -113,43 +164,40 @@ class ModerationPlugin(praxisbot.Plugin):
 	async def dump(self, server):
 		text = []
 
-		with self.shell.dbcon:
-			c = self.shell.dbcon.cursor()
-			for row in c.execute("SELECT name, priority, type, value, ban_timelimit, ban_prioritylimit, purge FROM "+self.ctx.dbprefix+"mod_levels WHERE discord_sid = ? ORDER BY priority DESC", [int(server.id)]):
-				option = ""
-				if row[2] == ModLevelType.User:
-					option = " --user <@"+row[3]+">"
-				elif row[2] == ModLevelType.Role:
-					r = self.shell.find_role(row[3], server)
-					if r:
-						option = " --role \""+r.name+"\""
-					else:
-						option = " --role <@&"+row[3]+">"
-				elif row[2] == ModLevelType.Channel:
-					c = self.shell.find_channel(row[3], server)
-					if c:
-						option = " --channel \""+c.name+"\""
-					else:
-						option = " --channel <#"+row[3]+">"
-				text.append("create_mod_level \""+row[0]+"\" "+str(row[1])+option)
-
-				if row[6] and row[6] != 0:
-					purge = 1
+		for row in await self.shell.db.fetchall("SELECT name, priority, type, value, ban_timelimit, ban_prioritylimit, purge FROM "+self.shell.dbtable("mod_levels")+" WHERE discord_sid = ? ORDER BY priority DESC", [int(server.id)]):
+			option = ""
+			if row[2] == ModLevelType.User:
+				option = " --user <@"+row[3]+">"
+			elif row[2] == ModLevelType.Role:
+				r = self.shell.find_role(row[3], server)
+				if r:
+					option = " --role \""+r.name+"\""
+				else:
+					option = " --role <@&"+row[3]+">"
+			elif row[2] == ModLevelType.Channel:
+				c = self.shell.find_channel(row[3], server)
+				if c:
+					option = " --channel \""+c.name+"\""
 				else:
-					purge = 0
-				text.append("set_mod_options \""+row[0]+"\" --banpriority "+str(row[4])+" --bantime "+str(row[5])+" --purge "+str(purge))
+					option = " --channel <#"+row[3]+">"
+			text.append("create_mod_level \""+row[0]+"\" "+str(row[1])+option)
+
+			if row[6] and row[6] != 0:
+				purge = 1
+			else:
+				purge = 0
+			text.append("set_mod_options \""+row[0]+"\" --banpriority "+str(row[4])+" --bantime "+str(row[5])+" --purge "+str(purge))
 
 		return text
 
 	@praxisbot.command
+	@praxisbot.argument('--user', help='List channels from the point of view of this user.')
 	async def execute_list_channels(self, scope, command, options, lines, **kwargs):
 		"""
 		List all channels of the server.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('--user', help='List channels from the point of view of this user.')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -194,18 +242,17 @@ class ModerationPlugin(praxisbot.Plugin):
 
 	@praxisbot.command
 	@praxisbot.permission_admin
+	@praxisbot.argument('name', help='Name of the moderator level.')
+	@praxisbot.argument('priority', help='Priority of the moderator level.')
+	@praxisbot.argument('--channel', help='All members that can write in this channel.')
+	@praxisbot.argument('--role', help='All members of this role.')
+	@praxisbot.argument('--user', help='A specific user.')
 	async def execute_create_mod_level(self, scope, command, options, lines, **kwargs):
 		"""
 		Create a moderator level.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('name', help='Name of the moderator level.')
-		parser.add_argument('priority', help='Priority of the moderator level.')
-		parser.add_argument('--channel', help='All members that can write in this channel.')
-		parser.add_argument('--role', help='All members of this role.')
-		parser.add_argument('--user', help='A specific user.')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -221,7 +268,7 @@ class ModerationPlugin(praxisbot.Plugin):
 			await scope.shell.print_error(scope, "You must use one and only one of this options: --role, --channel, --user.")
 			return
 
-		modData = scope.shell.get_sql_data("mod_levels", ["id"], {"discord_sid": int(scope.server.id), "name": str(args.name)})
+		modData = await scope.shell.get_sql_data_async("mod_levels", ["id"], {"discord_sid": int(scope.server.id), "name": str(args.name)})
 		if modData:
 			await scope.shell.print_error(scope, "The moderator level `"+args.name+"` already exists.")
 			return
@@ -232,7 +279,7 @@ class ModerationPlugin(praxisbot.Plugin):
 				await scope.shell.print_error(scope, "Channel not found.")
 				return
 
-			scope.shell.add_sql_data("mod_levels", {"name": str(args.name), "discord_sid": int(scope.server.id), "type": ModLevelType.Channel, "value": int(chan.id), "priority": int(args.priority), "ban_timelimit": 0, "ban_prioritylimit": -1, "purge": 0, })
+			await scope.shell.add_sql_data_async("mod_levels", {"name": str(args.name), "discord_sid": int(scope.server.id), "type": ModLevelType.Channel, "value": int(chan.id), "priority": int(args.priority), "ban_timelimit": 0, "ban_prioritylimit": -1, "purge": 0, })
 
 		elif args.role:
 			role = scope.shell.find_role(args.role, scope.server)
@@ -240,7 +287,7 @@ class ModerationPlugin(praxisbot.Plugin):
 				await scope.shell.print_error(scope, "Role not found.")
 				return
 
-			scope.shell.add_sql_data("mod_levels", {"name": str(args.name), "discord_sid": int(scope.server.id), "type": ModLevelType.Role, "value": int(role.id), "priority": int(args.priority), "ban_timelimit": 0, "ban_prioritylimit": -1, "purge": 0, })
+			await scope.shell.add_sql_data_async("mod_levels", {"name": str(args.name), "discord_sid": int(scope.server.id), "type": ModLevelType.Role, "value": int(role.id), "priority": int(args.priority), "ban_timelimit": 0, "ban_prioritylimit": -1, "purge": 0, })
 
 		elif args.user:
 			user = scope.shell.find_member(args.user, scope.server)
@@ -248,29 +295,30 @@ class ModerationPlugin(praxisbot.Plugin):
 				await scope.shell.print_error(scope, "User not found.")
 				return
 
-			scope.shell.add_sql_data("mod_levels", {"name": str(args.name), "discord_sid": int(scope.server.id), "type": ModLevelType.User, "value": int(user.id), "priority": int(args.priority), "ban_timelimit": 0, "ban_prioritylimit": -1, "purge": 0, })
+			await scope.shell.add_sql_data_async("mod_levels", {"name": str(args.name), "discord_sid": int(scope.server.id), "type": ModLevelType.User, "value": int(user.id), "priority": int(args.priority), "ban_timelimit": 0, "ban_prioritylimit": -1, "purge": 0, })
 
+		self.invalidate_mod_levels(scope.server)
 		await scope.shell.print_success(scope, "Moderator level created.")
 
 	@praxisbot.command
 	@praxisbot.permission_admin
+	@praxisbot.argument('name', help='Name of the moderator level.')
 	async def execute_delete_mod_level(self, scope, command, options, lines, **kwargs):
 		"""
 		Delete a moderator level.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('name', help='Name of the moderator level.')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
-		modData = scope.shell.get_sql_data("mod_levels", ["id"], {"discord_sid": int(scope.server.id), "name": str(args.name)})
+		modData = await scope.shell.get_sql_data_async("mod_levels", ["id"], {"discord_sid": int(scope.server.id), "name": str(args.name)})
 		if not modData:
 			await scope.shell.print_error(scope, "Moderator level `"+args.name+"` not found.")
 			return
 
-		scope.shell.delete_sql_data("mod_levels", {"id": modData[0]})
+		await scope.shell.delete_sql_data_async("mod_levels", {"id": modData[0]})
+		self.invalidate_mod_levels(scope.server)
 		await scope.shell.print_success(scope, "Moderator level deleted.")
 
 	@praxisbot.command
@@ -279,46 +327,42 @@ class ModerationPlugin(praxisbot.Plugin):
 		List all moderator levels.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return scope
 
 		stream = praxisbot.MessageStream(scope)
 		await stream.send("**__List of moderator levels__**\n")
 
-		with scope.shell.dbcon:
-			c = scope.shell.dbcon.cursor()
-			for row in c.execute("SELECT name, priority, ban_timelimit, ban_prioritylimit, purge FROM "+scope.shell.dbtable("mod_levels")+" WHERE discord_sid = ? ORDER BY priority DESC", [int(scope.server.id)]):
-				await stream.send("\n:label: **"+row[0]+"**")
-				await stream.send("\n   - Priority: "+str(row[1]))
-				if not row[2] or row[2] < 0:
-					tlimit = 0
-				else:
-					tlimit = row[2]
-				await stream.send("\n   - Duration bewteen two bans: "+str(tlimit)+"h")
-				if not row[3] or row[3] < 0:
-					plimit = row[1]-1
-				else:
-					plimit = min(row[3], row[1])
-				await stream.send("\n   - Maximum priority that can be banned: "+str(plimit))
-				if not row[4] or row[4] <= 0:
-					purge = "Can't use purge command"
-				else:
-					purge = "Can use purge command"
-				await stream.send("\n   - "+purge)
+		for row in await scope.shell.db.fetchall("SELECT name, priority, ban_timelimit, ban_prioritylimit, purge FROM "+scope.shell.dbtable("mod_levels")+" WHERE discord_sid = ? ORDER BY priority DESC", [int(scope.server.id)]):
+			await stream.send("\n:label: **"+row[0]+"**")
+			await stream.send("\n   - Priority: "+str(row[1]))
+			if not row[2] or row[2] < 0:
+				tlimit = 0
+			else:
+				tlimit = row[2]
+			await stream.send("\n   - Duration bewteen two bans: "+str(tlimit)+"h")
+			if not row[3] or row[3] < 0:
+				plimit = row[1]-1
+			else:
+				plimit = min(row[3], row[1])
+			await stream.send("\n   - Maximum priority that can be banned: "+str(plimit))
+			if not row[4] or row[4] <= 0:
+				purge = "Can't use purge command"
+			else:
+				purge = "Can use purge command"
+			await stream.send("\n   - "+purge)
 
 		await stream.finish()
 
 	@praxisbot.command
+	@praxisbot.argument('member', help='A member of the server.')
 	async def execute_get_mod_level(self, scope, command, options, lines, **kwargs):
 		"""
 		Give the highest moderator level of a member.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('member', help='A member of the server.')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -334,10 +378,7 @@ class ModerationPlugin(praxisbot.Plugin):
 	async def execute_kick_or_ban(self, scope, command, options, lines, **kwargs):
 		action_name = kwargs["action_name"]
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('member', help='Name of the member to '+action_name+'.')
-		parser.add_argument('--reason', help='Reason for the '+action_name+'.')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -357,10 +398,10 @@ class ModerationPlugin(praxisbot.Plugin):
 			await scope.shell.print_error(scope, "You can't "+action_name+" "+u.display_name+" with your level.")
 			return
 
-		banData = scope.shell.get_sql_data("ban_time", ["id", "last_time as 'last_time_ [timestamp]'"], {"discord_sid": int(scope.server.id), "discord_uid": int(scope.user.id)})
+		banData = await scope.shell.get_sql_data_async("ban_time", ["id", "last_time"], {"discord_sid": int(scope.server.id), "discord_uid": int(scope.user.id)})
 		if banData:
 
-			last_time = timezone('UTC').localize(banData[1])
+			last_time = datetime.datetime.fromtimestamp(banData[1], timezone('UTC'))
 			now_time = datetime.datetime.now(timezone('UTC'))
 
 			end_time = last_time + datetime.timedelta(hours=userLevel["ban_timelimit"])
@@ -385,7 +426,7 @@ class ModerationPlugin(praxisbot.Plugin):
 
 		last_time = datetime.datetime.now(timezone('UTC'))
 
-		scope.shell.set_sql_data("ban_time", {"last_time": str(last_time)}, {"discord_sid": int(scope.server.id), "discord_uid": int(scope.user.id)})
+		await scope.shell.set_sql_data_async("ban_time", {"last_time": int(last_time.timestamp())}, {"discord_sid": int(scope.server.id), "discord_uid": int(scope.user.id)})
 		if action_name == "ban":
 			await scope.shell.print_success(scope, ""+u.display_name+" banned.")
 		else:
@@ -393,6 +434,8 @@ class ModerationPlugin(praxisbot.Plugin):
 		scope.deletecmd = True
 
 	@praxisbot.command
+	@praxisbot.argument('member', help='Name of the member to ban.')
+	@praxisbot.argument('--reason', help='Reason for the ban.')
 	async def execute_ban(self, scope, command, options, lines, **kwargs):
 		"""
 		Ban a member.
@@ -401,6 +444,8 @@ class ModerationPlugin(praxisbot.Plugin):
 		await self.execute_kick_or_ban(scope, command, options, lines, action_name="ban", **kwargs)
 
 	@praxisbot.command
+	@praxisbot.argument('member', help='Name of the member to kick.')
+	@praxisbot.argument('--reason', help='Reason for the kick.')
 	async def execute_kick(self, scope, command, options, lines, **kwargs):
 		"""
 		Kick a member.
@@ -415,15 +460,14 @@ class ModerationPlugin(praxisbot.Plugin):
 		List last bans.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return scope
 
 		stream = praxisbot.MessageStream(scope)
 		await stream.send("**__Last bans__**")
 
-		bans = await scope.shell.client.get_ban_logs(scope.server, limit=5)
+		bans = await scope.shell.ban_logs.get_last_bans(scope.server, 5)
 		for b in bans:
 			author = b.author
 			target = b.target
@@ -446,21 +490,20 @@ class ModerationPlugin(praxisbot.Plugin):
 		await stream.finish()
 
 	@praxisbot.command
+	@praxisbot.argument('name', help='Name of moderation level.')
+	@praxisbot.argument('--bantime', help='Minimum duration between two bans in hours.')
+	@praxisbot.argument('--banpriority', help='Maximum level priority than can be banned.')
+	@praxisbot.argument('--purge', help='Enable or disable purge command.')
 	async def execute_set_mod_options(self, scope, command, options, lines, **kwargs):
 		"""
 		Configure options for a moderation level.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('name', help='Name of moderation level.')
-		parser.add_argument('--bantime', help='Minimum duration between two bans in hours.')
-		parser.add_argument('--banpriority', help='Maximum level priority than can be banned.')
-		parser.add_argument('--purge', help='Enable or disable purge command.')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
-		modLevel = scope.shell.get_sql_data("mod_levels", ["id", "ban_timelimit", "ban_prioritylimit", "purge"], {"discord_sid":int(scope.server.id), "name": str(args.name)})
+		modLevel = await scope.shell.get_sql_data_async("mod_levels", ["id", "ban_timelimit", "ban_prioritylimit", "purge"], {"discord_sid":int(scope.server.id), "name": str(args.name)})
 		if not modLevel:
 			scope.shell.print_error(scope, "Mod level `"+str(args.name)+"` not found.")
 			return
@@ -477,9 +520,10 @@ class ModerationPlugin(praxisbot.Plugin):
 		if args.purge:
 			newPurge = int(args.purge)
 
-		scope.shell.set_sql_data("mod_levels", {"ban_timelimit": newBanTime, "ban_prioritylimit": newBanPriority, "purge": newPurge}, {"id":modLevel[0]})
+		await scope.shell.set_sql_data_async("mod_levels", {"ban_timelimit": newBanTime, "ban_prioritylimit": newBanPriority, "purge": newPurge}, {"id":modLevel[0]})
+		self.invalidate_mod_levels(scope.server)
 
-		row = scope.shell.get_sql_data("mod_levels", ["name", "priority", "ban_timelimit", "ban_prioritylimit", "purge"], {"id":modLevel[0]})
+		row = await scope.shell.get_sql_data_async("mod_levels", ["name", "priority", "ban_timelimit", "ban_prioritylimit", "purge"], {"id":modLevel[0]})
 
 		text = "Mod level `"+str(args.name)+"` edited."
 		text = text+"\n:label: **"+row[0]+"**"
@@ -503,6 +547,11 @@ class ModerationPlugin(praxisbot.Plugin):
 		await scope.shell.print_success(scope, text)
 
 	@praxisbot.command
+	@praxisbot.argument('num', help='Number of messages to purge.')
+	@praxisbot.argument('--all', action='store_true', help='Remove all messages, including pinned messages.')
+	@praxisbot.argument('--before', help='Remove only messages before a specific message.')
+	@praxisbot.argument('--after', help='Remove only messages after a specific message.')
+	@praxisbot.argument('--onebyone', action='store_true', help='Remove messages one by one. Useful to bypass Discord limitations.')
 	async def execute_purge(self, scope, command, options, lines, **kwargs):
 		"""
 		Purge last messages in a channel.
@@ -514,13 +563,7 @@ class ModerationPlugin(praxisbot.Plugin):
 				await scope.shell.print_permission(scope, "You can't purge messages with your level.")
 				return
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('num', help='Number of messages to purge.')
-		parser.add_argument('--all', action='store_true', help='Remove all messages, including pinned messages.')
-		parser.add_argument('--before', help='Remove only messages before a specific message.')
-		parser.add_argument('--after', help='Remove only messages after a specific message.')
-		parser.add_argument('--onebyone', action='store_true', help='Remove messages one by one. Useful to bypass Discord limitations.')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -18,13 +18,12 @@ along with PraxisBot.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
-import shlex
 import argparse
 import re
 import discord
 import traceback
 import datetime
-import io
+import time
 import sqlite3
 from pytz import timezone
 import praxisbot
@@ -44,128 +43,323 @@ class PollPlugin(praxisbot.Plugin):
 	def __init__(self, shell):
 		super().__init__(shell)
 
-		self.shell.create_sql_table("polls", ["id INTEGER PRIMARY KEY", "discord_sid INTEGER", "discord_cid INTEGER", "discord_mid INTEGER", "end_time DATETIME", "description TEXT", "type INTEGER"])
-		self.shell.create_sql_table("poll_choices", ["id INTEGER PRIMARY KEY", "poll INTEGER", "emoji TEXT", "description TEXT"])
-		self.shell.create_sql_table("votes", ["id INTEGER PRIMARY KEY", "poll INTEGER", "discord_uid INTEGER", "choice INTEGER", "vote_time DATETIME"])
+		self.shell.migrate_sql_schema(self.name, [self.create_tables, self.convert_times_to_epoch, self.create_indexes, self.add_unique_votes])
 
 		self.add_command("start_poll", self.execute_start_poll)
 		self.add_command("close_poll", self.execute_close_poll)
 		self.add_command("polls", self.execute_polls)
 
-	def check_emoji(self, reaction, emoji):
-		e = str(reaction.emoji)
-		return e.startswith(emoji)
+		self.polls = {}
+		self.poll_ids = {}
+		self.poll_messages = {}
+		self.reconciled_servers = set()
+		self.choices = {}
+		self.votes = {}
+		self.tallies = {}
+		self.pending_edits = set()
+		self.last_edits = {}
+		self.edit_delay = 5
+		with self.shell.dbcon:
+			c = self.shell.dbcon.cursor()
+			for row in c.execute("SELECT id, discord_cid, discord_mid, description, end_time, type, discord_sid FROM "+self.shell.dbtable("polls")+" ORDER BY id"):
+				self.add_poll(str(row[6]), tuple(row[0:6]))
+
+		self.add_periodic_job("update_polls", 5, self.update_polls, self.has_polls)
+
+	def create_tables(self):
+		self.shell.create_sql_table("polls", ["id INTEGER PRIMARY KEY", "discord_sid INTEGER", "discord_cid INTEGER", "discord_mid INTEGER", "end_time DATETIME", "description TEXT", "type INTEGER"])
+		self.shell.create_sql_table("poll_choices", ["id INTEGER PRIMARY KEY", "poll INTEGER", "emoji TEXT", "description TEXT"])
+		self.shell.create_sql_table("votes", ["id INTEGER PRIMARY KEY", "poll INTEGER", "discord_uid INTEGER", "choice INTEGER", "vote_time DATETIME"])
+
+	def convert_times_to_epoch(self):
+		self.shell.rebuild_sql_table("polls", ["id INTEGER PRIMARY KEY", "discord_sid INTEGER", "discord_cid INTEGER", "discord_mid INTEGER", "end_time INTEGER", "description TEXT", "type INTEGER"], {"end_time": self.shell.sql_epoch("end_time")})
+		self.shell.rebuild_sql_table("votes", ["id INTEGER PRIMARY KEY", "poll INTEGER", "discord_uid INTEGER", "choice INTEGER", "vote_time INTEGER"], {"vote_time": self.shell.sql_epoch("vote_time")})
+
+	def create_indexes(self):
+		self.shell.create_sql_index("polls", ["discord_sid", "end_time"])
+		self.shell.create_sql_index("poll_choices", ["poll"])
+		self.shell.create_sql_index("votes", ["poll", "discord_uid"])
+		self.shell.create_sql_index("votes", ["poll", "choice"])
+
+	def add_unique_votes(self):
+		self.shell.dbcon.execute("DROP INDEX IF EXISTS "+self.shell.dbtable("votes")+"_poll_discord_uid_index")
+		self.shell.create_sql_unique_index("votes", ["poll", "discord_uid"])
+
+	def check_emoji(self, emoji, choice_emoji):
+		e = str(emoji)
+		return e.startswith(choice_emoji)
+
+	def find_choice(self, choices, emoji):
+		for c in choices:
+			if self.check_emoji(emoji, choices[c]):
+				return c
+		return None
+
+	def has_polls(self, server):
+		return len(self.polls.get(server.id, {})) > 0
+
+	def add_poll(self, sid, poll):
+		"""
+		Keep a poll in memory. A poll is a tuple (id, discord_cid, discord_mid, description, end_time, type)
+		"""
+		self.polls.setdefault(sid, {})[poll[0]] = poll
+		self.poll_ids[str(poll[2])] = poll[0]
+
+	async def on_ready(self):
+		#Votes added while disconnected are only visible on the messages
+		self.reconciled_servers.clear()
+		self.poll_messages.clear()
+
+	async def get_poll_message(self, scope, poll):
+		"""
+		Return the message of a poll. It is fetched once, then kept in memory.
+		"""
+		mid = str(poll[2])
+		if self.poll_messages.get(mid):
+			return self.poll_messages[mid]
+
+		chan = scope.shell.find_channel(str(poll[1]), scope.server)
+		if not chan:
+			return None
+
+		try:
+			msg = await scope.shell.client.get_message(chan, mid)
+		except:
+			return None
+
+		self.poll_messages[mid] = msg
+		return msg
+
+	async def get_poll_choices(self, scope, poll_id):
+		"""
+		Return the id, emoji and description of each choice of a poll. Choices never change, so they are kept in memory.
+		"""
+		if poll_id not in self.choices:
+			self.choices[poll_id] = await scope.shell.db.fetchall("SELECT id, emoji, description FROM "+scope.shell.dbtable("poll_choices")+" WHERE poll = ?", [poll_id])
+		return self.choices[poll_id]
+
+	async def get_choices(self, scope, poll_id):
+		choices = {}
+		for choice in await self.get_poll_choices(scope, poll_id):
+			choices[choice[0]] = choice[1]
+		return choices
+
+	async def get_votes(self, scope, poll_id):
+		"""
+		Return the choice of each user of a poll. Votes are read once, then kept up to date in memory,
+		so voting only queues writes.
+		"""
+		if poll_id not in self.votes:
+			votes = {}
+			tally = {}
+			for row in await scope.shell.db.fetchall("SELECT discord_uid, choice FROM "+scope.shell.dbtable("votes")+" WHERE poll = ?", [poll_id]):
+				votes[str(row[0])] = row[1]
+				tally[row[1]] = tally.get(row[1], 0)+1
+			self.votes[poll_id] = votes
+			self.tallies[poll_id] = tally
+		return self.votes[poll_id]
+
+	async def get_tally(self, scope, poll_id):
+		"""
+		Return the number of votes of each choice of a poll
+		"""
+		await self.get_votes(scope, poll_id)
+		return self.tallies[poll_id]
+
+	def forget_poll(self, scope, poll):
+		self.polls.get(scope.server.id, {}).pop(poll[0], None)
+		self.poll_ids.pop(str(poll[2]), None)
+		self.poll_messages.pop(str(poll[2]), None)
+		self.choices.pop(poll[0], None)
+		self.votes.pop(poll[0], None)
+		self.tallies.pop(poll[0], None)
+		self.pending_edits.discard(poll[0])
+		self.last_edits.pop(poll[0], None)
+		scope.shell.scheduler.cancel(("poll_edit", poll[0]))
+
+	async def get_reaction_users(self, scope, reaction):
+		"""
+		Return all users of a reaction, by pages of 100
+		"""
+		users = []
+		after = None
+		while True:
+			page = await scope.shell.client.get_reaction_users(reaction, 100, after)
+			users.extend(page)
+			if len(page) < 100:
+				return users
+			after = page[-1]
+
+	async def record_vote(self, scope, poll, choices, user, choice):
+		"""
+		Save the vote of a user and confirm it by private message. Return True if the results changed.
+		"""
+		try:
+			vote_time = datetime.datetime.now(timezone('UTC'))
+			votes = await self.get_votes(scope, poll[0])
+			vote = votes.get(user.id)
+			if vote == choice:
+				scope.shell.notifications.notify(user, "Your vote on the server \""+scope.server.name+"\" is confirmed.", ("poll", poll[0]))
+				return False
+
+			tally = self.tallies[poll[0]]
+			scope.shell.queue_set_sql_data("votes", {"choice":choice, "vote_time":int(vote_time.timestamp())}, {"poll": poll[0], "discord_uid": int(user.id)})
+			votes[user.id] = choice
+			tally[choice] = tally.get(choice, 0)+1
+
+			if vote == None:
+				scope.shell.notifications.notify(user, "Your vote on the server \""+scope.server.name+"\" is confirmed.\n - Vote added: "+choices[choice], ("poll", poll[0]))
+			else:
+				tally[vote] = tally.get(vote, 0)-1
+				scope.shell.notifications.notify(user, "Your vote on the server \""+scope.server.name+"\" is confirmed.\n - Vote removed: "+choices.get(vote, "?")+"\n - Vote added: "+choices[choice], ("poll", poll[0]))
+			return True
+		except:
+			print(traceback.format_exc())
+			scope.shell.notifications.notify(user, ":no_entry: Your vote on the server \""+scope.server.name+"\" was lost due to a technical problem.", ("poll", poll[0]))
+		return False
+
+	async def update_poll_message(self, scope, poll, msg):
+		end_time_readable = datetime.datetime.fromtimestamp(poll[4], timezone('Europe/Paris'))
+
+		text = poll[3]
+		if poll[5] != PollType.Short:
+			text = text+"\n\n**Poll closing at "+end_time_readable.strftime("%Y-%m-%d %H:%M:%S")+".\nTo vote, please click on one of the following reactions:**"
+
+		tally = await self.get_tally(scope, poll[0])
+		for choice in await self.get_poll_choices(scope, poll[0]):
+			if poll[5] != PollType.Short:
+				text = text+"\n\n"+choice[1]+" : "+str(choice[2])
+			if poll[5] == PollType.Live:
+				text = text+" ("+str(tally.get(choice[0], 0))+")"
+
+		if poll[5] != PollType.Short:
+			text = text+"\n\nVoters: "+str(sum(tally.values()))
+
+		await scope.shell.client.edit_message(msg, text)
+
+	def schedule_poll_edit(self, scope, poll, msg):
+		"""
+		Update the message of a poll after votes, at most once every edit_delay seconds
+		"""
+		if poll[5] == PollType.Short or poll[0] in self.pending_edits:
+			return
+
+		self.pending_edits.add(poll[0])
+		when = max(time.time(), self.last_edits.get(poll[0], 0)+self.edit_delay)
+		scope.shell.scheduler.schedule(("poll_edit", poll[0]), when, self.edit_poll_message, scope, poll, msg)
+
+	async def edit_poll_message(self, scope, poll, msg):
+		self.pending_edits.discard(poll[0])
+		if str(poll[2]) not in self.poll_ids:
+			return
+
+		self.last_edits[poll[0]] = time.time()
+		await self.update_poll_message(scope, poll, msg)
+
+	async def on_raw_reaction(self, scope, message_id, emoji):
+		if message_id not in self.poll_ids:
+			return False
+
+		poll = self.polls.get(scope.server.id, {}).get(self.poll_ids[message_id])
+		if not poll:
+			return False
+
+		msg = await self.get_poll_message(scope, poll)
+		if not msg:
+			return False
+
+		#Votes are secret: the reaction of the user is removed
+		try:
+			await scope.shell.client.remove_reaction(msg, emoji, scope.user)
+		except:
+			pass
+
+		choices = await self.get_choices(scope, poll[0])
+		choice = self.find_choice(choices, emoji)
+		if choice == None:
+			return True
+
+		if await self.record_vote(scope, poll, choices, scope.user, choice):
+			self.schedule_poll_edit(scope, poll, msg)
+		return True
+
+	async def reconcile_poll(self, scope, poll, msg):
+		"""
+		Count the votes left as reactions on the message, when reaction events were missed
+		"""
+		changes = False
+		choices = await self.get_choices(scope, poll[0])
+		reaction_already_added = []
+
+		for r in msg.reactions:
+			current_choice = self.find_choice(choices, r.emoji)
+			for ru in await self.get_reaction_users(scope, r):
+				if ru.id == scope.shell.client.user.id:
+					if current_choice != None:
+						reaction_already_added.append(choices[current_choice])
+					continue
 
-	async def on_loop(self, scope):
-		with scope.shell.dbcon:
-			c0 = scope.shell.dbcon.cursor()
-			c1 = scope.shell.dbcon.cursor()
-			for poll in c0.execute("SELECT id, discord_cid, discord_mid, description, end_time as 'end_time_ [timestamp]', type FROM "+scope.shell.dbtable("polls")+" WHERE discord_sid = ?", [int(scope.server.id)]):
 				try:
-					chan = scope.shell.find_channel(str(poll[1]), scope.server)
-					msg = None
-					if chan:
-						try:
-							msg = await scope.shell.client.get_message(chan, str(poll[2]))
-						except:
-							pass
-
-					end_time = timezone('UTC').localize(poll[4])
-					end_time_readable = end_time.astimezone(timezone('Europe/Paris'))
-					current_time = datetime.datetime.now(timezone('UTC'))
-					if end_time < current_time:
-						if msg:
-							text = poll[3]+"\n\n**Results:**"
-							for choice in c1.execute("SELECT id, emoji FROM "+scope.shell.dbtable("poll_choices")+" WHERE poll = ?", [poll[0]]):
-								counter = scope.shell.get_sql_data("votes", ["COUNT(id)"], {"poll": poll[0], "choice": choice[0]})
-								text = text+"\n\n"+choice[1]+" : "+str(counter[0])
-
-							await scope.shell.client.edit_message(msg, text)
-							await scope.shell.client.clear_reactions(msg)
-
-						scope.shell.delete_sql_data("votes", {"poll": poll[0]})
-						scope.shell.delete_sql_data("poll_choices", {"poll": poll[0]})
-						scope.shell.delete_sql_data("polls", {"id": poll[0]})
-
-					elif msg:
-						changes = False
-						choices = {}
-						reaction_already_added = []
-
-						for choice in c1.execute("SELECT id, emoji, description FROM "+scope.shell.dbtable("poll_choices")+" WHERE poll = ?", [poll[0]]):
-							choices[choice[0]] = choice[1]
-
-						for r in msg.reactions:
-							current_choice = None
-							for c in choices:
-								if self.check_emoji(r, choices[c]):
-									current_choice = c
-									break
-
-							reaction_users = await scope.shell.client.get_reaction_users(r)
-							for ru in reaction_users:
-								if not current_choice:
-									await scope.shell.client.remove_reaction(msg, r.emoji, ru)
-								elif ru.id == scope.shell.client.user.id:
-									reaction_already_added.append(choices[current_choice])
-								else:
-									try:
-										await scope.shell.client.remove_reaction(msg, r.emoji, ru)
-										vote_time = datetime.datetime.now(timezone('UTC'))
-										vote = scope.shell.get_sql_data("votes", ["id", "choice"], {"poll": poll[0], "discord_uid": int(ru.id)})
-										if not vote:
-											scope.shell.add_sql_data("votes", {"poll": poll[0], "discord_uid": int(ru.id), "choice":current_choice, "vote_time":str(vote_time)})
-											await scope.shell.client.send_message(ru, "Your vote on the server \""+scope.server.name+"\" is confirmed.\n - Vote added: "+choices[current_choice])
-											changes = True
-										elif choices[current_choice] != choices[vote[1]]:
-											scope.shell.update_sql_data("votes", {"choice":current_choice}, {"id": vote[0]})
-											await scope.shell.client.send_message(ru, "Your vote on the server \""+scope.server.name+"\" is confirmed.\n - Vote removed: "+choices[vote[1]]+"\n - Vote added: "+choices[current_choice])
-											changes = True
-										else:
-											await scope.shell.client.send_message(ru, "Your vote on the server \""+scope.server.name+"\" is confirmed.")
-									except:
-										print(traceback.format_exc())
-										await scope.shell.client.send_message(ru, ":no_entry: Your vote on the server \""+scope.server.name+"\" was lost due to a technical problem.")
-
-						for c in choices:
-							if choices[c] not in reaction_already_added:
-								await scope.shell.client.add_reaction(msg, choices[c])
-
-						if changes:
-
-							text = poll[3]
-							if poll[5] != PollType.Short:
-								text = text+"\n\n**Poll closing at "+end_time_readable.strftime("%Y-%m-%d %H:%M:%S")+".\nTo vote, please click on one of the following reactions:**"
-
-							for choice in c1.execute("SELECT id, emoji, description FROM "+scope.shell.dbtable("poll_choices")+" WHERE poll = ?", [poll[0]]):
-								if poll[5] != PollType.Short:
-									text = text+"\n\n"+choice[1]+" : "+str(choice[2])
-								if poll[5] == PollType.Live:
-									counter = scope.shell.get_sql_data("votes", ["COUNT(id)"], {"poll": poll[0], "choice": choice[0]})
-									text = text+" ("+str(counter[0])+")"
-
-							if poll[5] != PollType.Short:
-								counter = scope.shell.get_sql_data("votes", ["COUNT(id)"], {"poll": poll[0]})
-								text = text+"\n\nVoters: "+str(counter[0])
-
-							await scope.shell.client.edit_message(msg, text)
+					await scope.shell.client.remove_reaction(msg, r.emoji, ru)
 				except:
 					pass
 
+				if current_choice != None and await self.record_vote(scope, poll, choices, ru, current_choice):
+					changes = True
+
+		for c in choices:
+			if choices[c] not in reaction_already_added:
+				await scope.shell.client.add_reaction(msg, choices[c])
+
+		if changes:
+			self.schedule_poll_edit(scope, poll, msg)
+
+	async def update_polls(self, scope):
+		polls = list(self.polls.get(scope.server.id, {}).values())
+
+		reconcile = scope.server.id not in self.reconciled_servers
+		self.reconciled_servers.add(scope.server.id)
+
+		current_time = datetime.datetime.now(timezone('UTC'))
+		for poll in polls:
+			try:
+				end_time = datetime.datetime.fromtimestamp(poll[4], timezone('UTC'))
+				if end_time < current_time:
+					msg = await self.get_poll_message(scope, poll)
+					if msg:
+						text = poll[3]+"\n\n**Results:**"
+						tally = await self.get_tally(scope, poll[0])
+						for choice in await self.get_poll_choices(scope, poll[0]):
+							text = text+"\n\n"+choice[1]+" : "+str(tally.get(choice[0], 0))
+
+						await scope.shell.client.edit_message(msg, text)
+						await scope.shell.client.clear_reactions(msg)
+
+					await scope.shell.delete_sql_data_async("votes", {"poll": poll[0]})
+					await scope.shell.delete_sql_data_async("poll_choices", {"poll": poll[0]})
+					await scope.shell.delete_sql_data_async("polls", {"id": poll[0]})
+					self.forget_poll(scope, poll)
+
+				elif reconcile:
+					msg = await self.get_poll_message(scope, poll)
+					if msg:
+						await self.reconcile_poll(scope, poll, msg)
+			except:
+				pass
+
 	@praxisbot.command
+	@praxisbot.argument('--duration', help='Duration of the poll in hours.')
+	@praxisbot.argument('--description', help='Description of the poll.')
+	@praxisbot.argument('--channel', help='Channel where the poll will be created.')
+	@praxisbot.argument('--short', action='store_true', help='Remove all explanations except the description.')
+	@praxisbot.argument('--live', action='store_true', help='Display results in real time.')
+	@praxisbot.argument('--choices', nargs='*', help='List of emoji and decriptions. Ex: `👎 "No" 🤷 "Neutral" 👍 "Yes".`', default=["👎", "I disagree", "🤷", "Neutral", "👍", "I agree"])
 	async def execute_start_poll(self, scope, command, options, lines, **kwargs):
 		"""
 		Start a poll.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('--duration', help='Duration of the poll in hours.')
-		parser.add_argument('--description', help='Description of the poll.')
-		parser.add_argument('--channel', help='Channel where the poll will be created.')
-		parser.add_argument('--short', action='store_true', help='Remove all explanations except the description.')
-		parser.add_argument('--live', action='store_true', help='Display results in real time.')
-		parser.add_argument('--choices', nargs='*', help='List of emoji and decriptions. Ex: `👎 "No" 🤷 "Neutral" 👍 "Yes".`', default=["👎", "I disagree", "🤷", "Neutral", "👍", "I agree"])
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -233,33 +427,35 @@ class PollPlugin(praxisbot.Plugin):
 				await scope.shell.print_error(scope, "\""+c["emoji"]+"\" is not a valid emoji.")
 				return
 
-		poll_id = scope.shell.add_sql_data("polls", {"discord_sid": int(msg.server.id), "discord_cid": int(chan.id), "discord_mid": int(msg.id), "description": description, "end_time": str(end_time), "type":int(poll_type)})
+		poll_id = await scope.shell.add_sql_data_async("polls", {"discord_sid": int(msg.server.id), "discord_cid": int(chan.id), "discord_mid": int(msg.id), "description": description, "end_time": int(end_time.timestamp()), "type":int(poll_type)})
+		await scope.shell.add_sql_data_many_async("poll_choices", ["poll", "emoji", "description"], [[poll_id, c["emoji"], c["description"]] for c in choices])
 
-		for c in choices:
-			scope.shell.add_sql_data("poll_choices", {"poll": poll_id, "emoji": c["emoji"], "description": c["description"]})
+		#Registered once its choices are saved, so votes can't see a poll without choices
+		self.poll_messages[msg.id] = msg
+		self.add_poll(msg.server.id, (poll_id, int(chan.id), int(msg.id), description, int(end_time.timestamp()), int(poll_type)))
 
 	@praxisbot.command
+	@praxisbot.argument('poll', help='ID of the poll to close.')
 	async def execute_close_poll(self, scope, command, options, lines, **kwargs):
 		"""
 		Close a poll.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('poll', help='ID of the poll to close.')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
 		self.ensure_object_id("Poll ID", args.poll)
 
-		poll = scope.shell.get_sql_data("polls", ["id"], {"discord_sid":int(scope.server.id), "id":int(args.poll)})
+		poll = self.polls.get(scope.server.id, {}).get(int(args.poll))
 		if not poll:
 			await scope.shell.print_error(scope, "Poll #"+args.poll+"not found.")
 			return
 
 		end_time = datetime.datetime.now(timezone('UTC'))
 
-		scope.shell.update_sql_data("polls", {"end_time":end_time.strftime("%Y-%m-%d %H:%M:%S")}, {"discord_sid":int(scope.server.id), "id":int(args.poll)})
+		await scope.shell.update_sql_data_async("polls", {"end_time":int(end_time.timestamp())}, {"discord_sid":int(scope.server.id), "id":int(args.poll)})
+		self.add_poll(scope.server.id, poll[0:4]+(int(end_time.timestamp()),)+poll[5:])
 		await scope.shell.print_success(scope, "Poll closed.")
 
 	@praxisbot.command
@@ -268,36 +464,31 @@ class PollPlugin(praxisbot.Plugin):
 		List all current polls.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
 		stream = praxisbot.MessageStream(scope)
 		await stream.send("__**List of polls**__")
 
-		with scope.shell.dbcon:
-			c0 = scope.shell.dbcon.cursor()
-			c1 = scope.shell.dbcon.cursor()
-			for row in c0.execute("SELECT id, description, discord_cid, end_time as 'end_time_ [timestamp]' FROM "+scope.shell.dbtable("polls")+" WHERE discord_sid = ? ORDER BY end_time", [int(scope.server.id)]):
-				chan = scope.shell.find_channel(str(row[2]), scope.server)
-				chan_name = "an unknown channel"
-				if chan:
-					chan_name = chan.mention
-
-				end_time = timezone('UTC').localize(row[3])
-				end_time = end_time.astimezone(timezone('Europe/Paris'))
-
-				counter = scope.shell.get_sql_data("votes", ["COUNT(id)"], {"poll": row[0]})
-
-				await stream.send("\n\n:bar_chart: **Poll #"+str(row[0])+" in "+chan_name+"**")
-				await stream.send("\n - Closing time: "+end_time.strftime("%Y-%m-%d %H:%M:%S"))
-				choices = []
-				for choice in c1.execute("SELECT emoji, description FROM "+scope.shell.dbtable("poll_choices")+" WHERE poll = ?", [row[0]]):
-					choices.append(choice[0]+" "+choice[1])
-				await stream.send("\n - Voters: "+str(counter[0]))
-				await stream.send("\n - Choices: "+", ".join(choices))
-				if len(row[1]) > 0:
-					description = "```\n"+row[1]+"\n```"
+		for row in await scope.shell.db.fetchall("SELECT id, description, discord_cid, end_time FROM "+scope.shell.dbtable("polls")+" WHERE discord_sid = ? ORDER BY end_time", [int(scope.server.id)]):
+			chan = scope.shell.find_channel(str(row[2]), scope.server)
+			chan_name = "an unknown channel"
+			if chan:
+				chan_name = chan.mention
+
+			end_time = datetime.datetime.fromtimestamp(row[3], timezone('Europe/Paris'))
+
+			tally = await self.get_tally(scope, row[0])
+
+			await stream.send("\n\n:bar_chart: **Poll #"+str(row[0])+" in "+chan_name+"**")
+			await stream.send("\n - Closing time: "+end_time.strftime("%Y-%m-%d %H:%M:%S"))
+			choices = []
+			for choice in await self.get_poll_choices(scope, row[0]):
+				choices.append(choice[1]+" "+choice[2])
+			await stream.send("\n - Voters: "+str(sum(tally.values())))
+			await stream.send("\n - Choices: "+", ".join(choices))
+			if len(row[1]) > 0:
+				description = "```\n"+row[1]+"\n```"
 
 		await stream.finish()
@@ -18,13 +18,11 @@ along with PraxisBot.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
-import shlex
 import argparse
 import re
 import discord
 import traceback
 import datetime
-import io
 import requests
 import praxisbot
 
@@ -42,14 +40,31 @@ class RoleListPlugin(praxisbot.Plugin):
 	def __init__(self, shell):
 		super().__init__(shell)
 
-		self.shell.create_sql_table("role_options", ["id INTEGER PRIMARY KEY", "discord_sid INTEGER", "discord_rid INTEGER", "description TEXT", "type INTEGER", "autosort INTEGER", "autosync INTEGER"])
+		self.shell.migrate_sql_schema(self.name, [self.create_tables])
 
 		self.add_command("edit_role", self.execute_edit_role)
 		self.add_command("role_info", self.execute_role_info)
 		self.add_command("role_members", self.execute_role_members)
 		self.add_command("roles", self.execute_roles)
 
-	async def on_loop(self, scope):
+		self.auto_servers = set()
+		with self.shell.dbcon:
+			c = self.shell.dbcon.cursor()
+			for row in c.execute("SELECT DISTINCT discord_sid FROM "+self.shell.dbtable("role_options")+" WHERE type = ? AND (autosort = 1 OR autosync = 1)", [RoleType.Separator]):
+				self.auto_servers.add(str(row[0]))
+
+		self.add_periodic_job("update_sections", 5, self.update_sections, self.has_auto_sections)
+
+	def create_tables(self):
+		self.shell.create_sql_table("role_options", ["id INTEGER PRIMARY KEY", "discord_sid INTEGER", "discord_rid INTEGER", "description TEXT", "type INTEGER", "autosort INTEGER", "autosync INTEGER"], [["discord_sid", "discord_rid"]])
+
+	def has_auto_sections(self, server):
+		return server.id in self.auto_servers
+
+	async def update_sections(self, scope):
+		"""
+		Sort and sync the roles under separators with autosort or autosync. All moves are sent in one request, and only roles with other permissions than their separator are edited.
+		"""
 		roles = {}
 
 		for r in scope.server.roles:
@@ -66,14 +81,17 @@ class RoleListPlugin(praxisbot.Plugin):
 				"object":r
 			}
 
-		with scope.shell.dbcon:
-			c = scope.shell.dbcon.cursor()
-			for row in c.execute("SELECT discord_rid, type, autosync, autosort FROM "+scope.shell.dbtable("role_options")+" WHERE discord_sid = ?", [int(scope.server.id)]):
-				rid = str(row[0])
-				if rid in roles:
-					roles[rid]["type"] = row[1]
-					roles[rid]["autosync"] = row[2]
-					roles[rid]["autosort"] = row[3]
+		options = await scope.shell.db.fetchall("SELECT discord_rid, type, autosync, autosort FROM "+scope.shell.dbtable("role_options")+" WHERE discord_sid = ?", [int(scope.server.id)])
+		if not any(row[1] == RoleType.Separator and (row[2] == 1 or row[3] == 1) for row in options):
+			self.auto_servers.discard(scope.server.id)
+			return
+
+		for row in options:
+			rid = str(row[0])
+			if rid in roles:
+				roles[rid]["type"] = row[1]
+				roles[rid]["autosync"] = row[2]
+				roles[rid]["autosort"] = row[3]
 
 		sorted_roles = sorted(roles.values(), key=lambda a: a["position"], reverse=True)
 
@@ -86,41 +104,52 @@ class RoleListPlugin(praxisbot.Plugin):
 			else:
 				role_tree[current_block]["list"].append(r)
 
+		positions = {}
 		for b in role_tree:
 			if not b["separator"] or len(b["list"]) == 0:
 				continue
-			if b["separator"]["autosort"] != 1:
-				continue
-
-			current_position = b["list"][0]["position"]
-			sorted_subroles = sorted(b["list"], key=lambda a: a["name"])
-			i = 0
 
-			while i < len(sorted_subroles):
-				if sorted_subroles[i]["position"] != current_position:
-					await scope.shell.client.move_role(scope.server, sorted_subroles[i]["object"], current_position)
-					return #To only one modification each on_loop iteration
-				current_position = current_position-1
-				i = i+1
+			if b["separator"]["autosort"] == 1:
+				current_position = b["list"][0]["position"]
+				for r in sorted(b["list"], key=lambda a: a["name"]):
+					if r["position"] != current_position:
+						positions[r["object"]] = current_position
+					current_position = current_position-1
+
+			if b["separator"]["autosync"] == 1:
+				#Roles at or above the highest role of the bot can't be edited: skip them instead of failing on each update
+				permissions = b["separator"]["object"].permissions
+				topPosition = scope.server.me.top_role.position
+				for r in b["list"]:
+					if r["object"].position >= topPosition:
+						continue
+					if r["object"].permissions.value != permissions.value:
+						try:
+							await scope.shell.client.edit_role(scope.server, r["object"], permissions=permissions)
+						except:
+							print("Autosync of role "+r["object"].id+" failed on server "+scope.server.id)
+							print(traceback.format_exc())
+
+		if len(positions) > 0:
+			await scope.shell.client.move_roles(scope.server, positions)
 
 	@praxisbot.command
 	@praxisbot.permission_admin
+	@praxisbot.argument('role', help='Role to edit.')
+	@praxisbot.argument('--name', help='Name of the role.')
+	@praxisbot.argument('--mentionable', help='Set if the role can be mentioned. 0 or 1.')
+	@praxisbot.argument('--onlinelist', help='Set if the role must be displayed in the online list. 0 or 1.')
+	@praxisbot.argument('--description', help='Description of the role.')
+	@praxisbot.argument('--normal', action='store_true', help='Set this role as a normal role.')
+	@praxisbot.argument('--separator', action='store_true', help='Set this role as a separator.')
+	@praxisbot.argument('--autosort', help='Sort all sub-roles. For separators only. 0 or 1.')
+	@praxisbot.argument('--autosync', help='Sync permissions of all sub-roles. For separators only. 0 or 1.')
 	async def execute_edit_role(self, scope, command, options, lines, **kwargs):
 		"""
 		Edit role.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('role', help='Role to edit.')
-		parser.add_argument('--name', help='Name of the role.')
-		parser.add_argument('--mentionable', help='Set if the role can be mentioned. 0 or 1.')
-		parser.add_argument('--onlinelist', help='Set if the role must be displayed in the online list. 0 or 1.')
-		parser.add_argument('--description', help='Description of the role.')
-		parser.add_argument('--normal', action='store_true', help='Set this role as a normal role.')
-		parser.add_argument('--separator', action='store_true', help='Set this role as a separator.')
-		parser.add_argument('--autosort', help='Sort all sub-roles. For separators only. 0 or 1.')
-		parser.add_argument('--autosync', help='Sync permissions of all sub-roles. For separators only. 0 or 1.')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -157,7 +186,7 @@ class RoleListPlugin(praxisbot.Plugin):
 		autosort = 0
 		autosync = 0
 
-		options = scope.shell.get_sql_data("role_options", ["description", "type", "autosort", "autosync"], {"discord_sid": int(scope.server.id), "discord_rid":int(r.id)})
+		options = await scope.shell.get_sql_data_async("role_options", ["description", "type", "autosort", "autosync"], {"discord_sid": int(scope.server.id), "discord_rid":int(r.id)})
 		if options:
 			description = options[0]
 			type = options[1]
@@ -200,19 +229,20 @@ class RoleListPlugin(praxisbot.Plugin):
 				await scope.shell.print_error(scope, "The role "+r.name+" can't be edited.")
 				return
 
-		scope.shell.set_sql_data("role_options", {"description":description, "type":type, "autosort":autosort, "autosync":autosync}, {"discord_sid": int(scope.server.id), "discord_rid":int(r.id)})
+		await scope.shell.set_sql_data_async("role_options", {"description":description, "type":type, "autosort":autosort, "autosync":autosync}, {"discord_sid": int(scope.server.id), "discord_rid":int(r.id)})
+		if type == RoleType.Separator and (autosort == 1 or autosync == 1):
+			self.auto_servers.add(scope.server.id)
 
 		await scope.shell.print_success(scope, "Role edited.")
 
 	@praxisbot.command
+	@praxisbot.argument('role', help='Role to edit.')
 	async def execute_role_info(self, scope, command, options, lines, **kwargs):
 		"""
 		Display information about a role.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('role', help='Role to edit.')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -234,7 +264,7 @@ class RoleListPlugin(praxisbot.Plugin):
 		if role.colour.value != 0:
 			e.colour = role.colour
 
-		options = scope.shell.get_sql_data("role_options", ["description", "type", "autosort", "autosync"], {"discord_sid": int(scope.server.id), "discord_rid":int(role.id)})
+		options = await scope.shell.get_sql_data_async("role_options", ["description", "type", "autosort", "autosync"], {"discord_sid": int(scope.server.id), "discord_rid":int(role.id)})
 		if options:
 			e.description = options[0]
 
@@ -264,14 +294,13 @@ class RoleListPlugin(praxisbot.Plugin):
 		await scope.shell.client.send_message(scope.channel, "", embed=e)
 
 	@praxisbot.command
+	@praxisbot.argument('role', help='Role to edit.')
 	async def execute_role_members(self, scope, command, options, lines, **kwargs):
 		"""
 		Display members of a role.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('role', help='Role to edit.')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -302,8 +331,7 @@ class RoleListPlugin(praxisbot.Plugin):
 		List all roles.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -332,15 +360,13 @@ class RoleListPlugin(praxisbot.Plugin):
 				if r.id in roles:
 					roles[r.id]["members"] = roles[r.id]["members"]+1
 
-		with scope.shell.dbcon:
-			c = scope.shell.dbcon.cursor()
-			for row in c.execute("SELECT discord_rid, type, description, autosync, autosort FROM "+scope.shell.dbtable("role_options")+" WHERE discord_sid = ?", [int(scope.server.id)]):
-				rid = str(row[0])
-				if rid in roles:
-					roles[rid]["type"] = row[1]
-					roles[rid]["description"] = row[2]
-					roles[rid]["autosync"] = row[3]
-					roles[rid]["autosort"] = row[4]
+		for row in await scope.shell.db.fetchall("SELECT discord_rid, type, description, autosync, autosort FROM "+scope.shell.dbtable("role_options")+" WHERE discord_sid = ?", [int(scope.server.id)]):
+			rid = str(row[0])
+			if rid in roles:
+				roles[rid]["type"] = row[1]
+				roles[rid]["description"] = row[2]
+				roles[rid]["autosync"] = row[3]
+				roles[rid]["autosort"] = row[4]
 
 		sorted_roles = sorted(roles.values(), key=lambda a: a["position"], reverse=True)
 
@@ -18,16 +18,150 @@ along with PraxisBot.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
-import shlex
 import argparse
 import re
 import asyncio
 import datetime
+import time
 import copy
-import io
 from pytz import timezone
 import praxisbot
 
+class MessageTrigger:
+	"""
+	A message trigger with its regex compiled and the literal that any matching message must contain
+	"""
+	def __init__(self, shell, id, regex, script):
+		self.id = id
+		try:
+			self.regex = re.compile(regex)
+		except:
+			self.regex = None
+		self.literal = praxisbot.regex_required_literal(regex)
+		self.script = shell.compile_script(script)
+
+	def match(self, text):
+		if not self.regex:
+			return False
+		if self.literal and self.literal not in text:
+			return False
+		return self.regex.search(text) != None
+
+class CronExpression:
+	"""
+	Cron-like recurrence with five fields: minute hour day month weekday. Each field accepts *, lists, ranges and steps.
+	Weekdays are numbered from 0 (Sunday) to 6, 7 is also Sunday
+	"""
+	limits = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+	def __init__(self, text):
+		parts = text.split()
+		if len(parts) != 5:
+			raise ValueError("A recurrence must have 5 fields: minute hour day month weekday.")
+
+		self.text = " ".join(parts)
+		self.values = []
+		for i in range(5):
+			self.values.append(self.parse_field(parts[i], self.limits[i][0], self.limits[i][1]))
+		if 7 in self.values[4]:
+			self.values[4].add(0)
+
+		self.any_day = (parts[2] == "*")
+		self.any_weekday = (parts[4] == "*")
+
+	def parse_field(self, text, low, high):
+		values = set()
+		for item in text.split(","):
+			step = 1
+			if "/" in item:
+				item, step = item.split("/", 1)
+				step = int(step)
+				if step <= 0:
+					raise ValueError("Invalid step in recurrence: "+text)
+
+			if item == "*":
+				start = low
+				end = high
+			elif "-" in item:
+				start, end = item.split("-", 1)
+				start = int(start)
+				end = int(end)
+			else:
+				start = int(item)
+				end = start
+				if step > 1:
+					end = high
+
+			if start < low or end > high or start > end:
+				raise ValueError("Value out of range in recurrence: "+text)
+			values.update(range(start, end+1, step))
+		return values
+
+	def match_day(self, d):
+		day = d.day in self.values[2]
+		weekday = (d.isoweekday() % 7) in self.values[4]
+		if self.any_day:
+			return weekday
+		if self.any_weekday:
+			return day
+		return day or weekday
+
+	def next_time(self, after):
+		"""
+		Return the first naive datetime strictly after a naive datetime that matches the expression.
+		"""
+		t = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+		limit = t + datetime.timedelta(days=366*5)
+		while t < limit:
+			if t.month not in self.values[3]:
+				if t.month == 12:
+					t = t.replace(year=t.year+1, month=1, day=1, hour=0, minute=0)
+				else:
+					t = t.replace(month=t.month+1, day=1, hour=0, minute=0)
+			elif not self.match_day(t):
+				t = t.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+			elif t.hour not in self.values[1]:
+				t = t.replace(minute=0) + datetime.timedelta(hours=1)
+			elif t.minute not in self.values[0]:
+				t = t + datetime.timedelta(minutes=1)
+			else:
+				return t
+		raise ValueError("No date matches the recurrence "+self.text+".")
+
+class CatchUpPolicy:
+	"""
+	What to do with the runs of a time trigger missed while the bot was offline
+	"""
+	Skip="skip"
+	Once="once"
+	All="all"
+
+class TimeTrigger:
+	"""
+	A time trigger with its next run time, its remaining number of runs (0 for no limit) and its optional recurrence
+	"""
+	def __init__(self, shell, id, sid, script, start_time, num_iterations, recurrence, catch_up):
+		self.id = id
+		self.sid = str(sid)
+		self.script = shell.compile_script(script)
+		self.start_time = start_time
+		self.num_iterations = num_iterations or 0
+		self.recurrence = None
+		if recurrence:
+			self.recurrence = CronExpression(recurrence)
+		self.catch_up = catch_up or CatchUpPolicy.Once
+		self.retries = 0
+
+	def next_time(self, after):
+		"""
+		Return the epoch time of the next run after an epoch time, or None if the trigger doesn't repeat.
+		"""
+		if not self.recurrence:
+			return None
+		tz = timezone('Europe/Paris')
+		local = datetime.datetime.fromtimestamp(after, tz).replace(tzinfo=None)
+		return int(tz.localize(self.recurrence.next_time(local)).timestamp())
+
 class TriggerPlugin(praxisbot.Plugin):
 	"""
 	Trigger commands
@@ -39,10 +173,14 @@ class TriggerPlugin(praxisbot.Plugin):
 		super().__init__(shell)
 
 		self.time_triggers = {}
+		self.catch_up_delay = 60
+		self.max_catch_up_runs = 24
+		self.unavailable_retry_delay = 60
+		self.max_unavailable_retries = 60
+		self.triggers = {}
+		self.message_triggers = {}
 
-		self.shell.create_sql_table("triggers", ["id INTEGER PRIMARY KEY", "discord_sid INTEGER", "command TEXT", "script TEXT"])
-		self.shell.create_sql_table("time_triggers", ["id INTEGER PRIMARY KEY", "discord_sid INTEGER", "script TEXT", "start_time DATETIME", "num_iterations INTEGER"])
-		self.shell.create_sql_table("message_triggers", ["id INTEGER PRIMARY KEY", "discord_sid INTEGER", "regex TEXT", "script TEXT"])
+		self.shell.migrate_sql_schema(self.name, [self.create_tables, self.convert_times_to_epoch, self.create_indexes, self.add_recurrence])
 
 		self.add_command("create_trigger", self.execute_create_trigger)
 		self.add_command("edit_trigger", self.execute_edit_trigger)
@@ -54,49 +192,172 @@ class TriggerPlugin(praxisbot.Plugin):
 		self.add_command("create_message_trigger", self.execute_create_message_trigger)
 		self.add_command("message_triggers", self.execute_message_triggers)
 
-	async def execute_unregistered_command(self, scope, command, options, lines):
-		return await self.execute_trigger_script(scope, command, options, lines)
+		self.load_triggers()
+		self.load_time_triggers()
 
-	async def on_message(self, scope, message, command_found):
-		if command_found:
-			return
+	def create_tables(self):
+		self.shell.create_sql_table("triggers", ["id INTEGER PRIMARY KEY", "discord_sid INTEGER", "command TEXT", "script TEXT"], [["discord_sid", "command"]])
+		self.shell.create_sql_table("time_triggers", ["id INTEGER PRIMARY KEY", "discord_sid INTEGER", "script TEXT", "start_time DATETIME", "num_iterations INTEGER"])
+		self.shell.create_sql_table("message_triggers", ["id INTEGER PRIMARY KEY", "discord_sid INTEGER", "regex TEXT", "script TEXT"])
 
-		with scope.shell.dbcon:
-			c = scope.shell.dbcon.cursor()
-			for row in c.execute("SELECT regex, script FROM "+scope.shell.dbtable("message_triggers")+" WHERE discord_sid = ?", [int(scope.server.id)]):
-				try:
-					if re.search(row[0], message.content):
-						subScope = scope.create_subscope()
-						subScope.prefixes = [""]
-						subScope.user = message.author
-						subScope.channel = message.channel
-						subScope.vars["params"] = message.content
-						subScope.verbose = 1
-						await scope.shell.execute_script(subScope, row[1])
-				except:
-					pass
+	def convert_times_to_epoch(self):
+		self.shell.rebuild_sql_table("time_triggers", ["id INTEGER PRIMARY KEY", "discord_sid INTEGER", "script TEXT", "start_time INTEGER", "num_iterations INTEGER"], {"start_time": self.shell.sql_epoch("start_time")})
+
+	def create_indexes(self):
+		self.shell.create_sql_index("time_triggers", ["start_time"])
+		self.shell.create_sql_index("time_triggers", ["discord_sid", "start_time"])
+		self.shell.create_sql_index("message_triggers", ["discord_sid"])
+
+	def add_recurrence(self):
+		self.shell.create_sql_table("time_triggers", ["id INTEGER PRIMARY KEY", "discord_sid INTEGER", "script TEXT", "start_time INTEGER", "num_iterations INTEGER", "recurrence TEXT", "catch_up TEXT"])
+
+	def load_triggers(self):
+		"""
+		Load and compile the triggers of all servers, so commands are resolved without SQL queries.
+		"""
+		self.triggers = {}
+		with self.shell.dbcon:
+			c = self.shell.dbcon.cursor()
+			for row in c.execute("SELECT discord_sid, command, script FROM "+self.shell.dbtable("triggers")):
+				self.triggers.setdefault(str(row[0]), {})[row[1]] = self.shell.compile_script(row[2])
 
+	def get_message_triggers(self, server):
+		"""
+		Return the compiled message triggers of a server, in creation order.
+		"""
+		triggers = self.message_triggers.get(server.id)
+		if triggers == None:
+			triggers = []
+			with self.shell.dbcon:
+				c = self.shell.dbcon.cursor()
+				for row in c.execute("SELECT id, regex, script FROM "+self.shell.dbtable("message_triggers")+" WHERE discord_sid = ? ORDER BY id", [int(server.id)]):
+					triggers.append(MessageTrigger(self.shell, row[0], row[1], row[2]))
+			self.message_triggers[server.id] = triggers
 
-	async def on_loop(self, scope):
+		return triggers
 
-		triggersToUpdate = {}
+	def invalidate_message_triggers(self, server):
+		self.message_triggers.pop(server.id, None)
 
-		c = scope.shell.dbcon.cursor()
-		for row in c.execute("SELECT id, script, num_iterations, start_time, datetime('now') FROM "+scope.shell.dbtable("time_triggers")+" WHERE discord_sid = ? AND start_time < datetime('now')", [int(scope.server.id)]):
-			triggersToUpdate[row[0]] = row[2]
+	def get_trigger_script(self, server, command):
+		"""
+		Return the compiled script of a trigger, or None.
+		"""
+		triggers = self.triggers.get(server.id)
+		if not triggers:
+			return None
 
-			subScope = scope.create_subscope()
-			subScope.prefixes = [""]
-			await scope.shell.execute_script(subScope, row[1])
+		return triggers.get(command)
 
+	async def invalidate_trigger(self, server, command):
+		triggers = self.triggers.setdefault(server.id, {})
+
+		script = await self.shell.get_sql_data_async("triggers", ["script"], {"discord_sid":int(server.id), "command":command})
+		if script:
+			triggers[command] = self.shell.compile_script(script[0])
+		else:
+			triggers.pop(command, None)
+
+	def load_time_triggers(self):
+		"""
+		Load the time triggers of all servers and schedule them. Triggers missed while offline run according to their catch-up policy.
+		"""
+		with self.shell.dbcon:
+			c = self.shell.dbcon.cursor()
+			for row in c.execute("SELECT id, discord_sid, script, start_time, num_iterations, recurrence, catch_up FROM "+self.shell.dbtable("time_triggers")):
+				try:
+					self.schedule_time_trigger(TimeTrigger(self.shell, row[0], row[1], row[2], row[3], row[4], row[5], row[6]))
+				except ValueError:
+					print("Time trigger #"+str(row[0])+" has an invalid recurrence: "+str(row[5]))
+
+	def schedule_time_trigger(self, trigger):
+		self.time_triggers[trigger.id] = trigger
+		self.shell.scheduler.schedule(("time_trigger", trigger.id), trigger.start_time, self.run_time_trigger, trigger.id)
+
+	def unschedule_time_trigger(self, id):
+		self.time_triggers.pop(id, None)
+		self.shell.scheduler.cancel(("time_trigger", id))
+
+	async def on_server_remove(self, server):
+		#Triggers stay in the database: they are scheduled again on the next start
+		for trigger in list(self.time_triggers.values()):
+			if trigger.sid == server.id:
+				self.unschedule_time_trigger(trigger.id)
+
+	async def run_time_trigger(self, id):
+		trigger = self.time_triggers.get(id)
+		if not trigger:
+			return
 
-		for t in triggersToUpdate:
-			if triggersToUpdate[t] <= 1:
-				scope.shell.delete_sql_data("time_triggers", {"id": t})
+		#The server can be unavailable for a while (outage, reconnection): try again later. After an hour the
+		#trigger is kept in the database only, and loaded again on the next start
+		server = self.shell.find_server(trigger.sid)
+		if not server:
+			trigger.retries = trigger.retries+1
+			if trigger.retries > self.max_unavailable_retries:
+				print("Time trigger #"+str(id)+" unscheduled: server "+trigger.sid+" is unavailable")
+				self.time_triggers.pop(id, None)
 			else:
-				scope.shell.update_sql_data("time_triggers", {"num_iterations": int(triggersToUpdate[t]-1)}, {"id": t})
+				self.shell.scheduler.schedule(("time_trigger", id), time.time()+self.unavailable_retry_delay, self.run_time_trigger, id)
+			return
+		trigger.retries = 0
+
+		#Count the runs due now and find the next run
+		now = time.time()
+		runs = 1
+		nextTime = trigger.next_time(trigger.start_time)
+		missed = (now - trigger.start_time > self.catch_up_delay)
+		if missed and trigger.catch_up == CatchUpPolicy.Skip:
+			runs = 0
+		while nextTime and nextTime <= now:
+			if missed and trigger.catch_up == CatchUpPolicy.All:
+				runs = min(runs+1, self.max_catch_up_runs)
+			nextTime = trigger.next_time(nextTime)
+
+		remaining = 0
+		if trigger.num_iterations > 0:
+			runs = min(runs, trigger.num_iterations)
+			remaining = trigger.num_iterations-runs
+			if remaining == 0:
+				nextTime = None
+
+		#Save the new state before running, so a crash can't run the trigger twice
+		if nextTime:
+			trigger.start_time = nextTime
+			trigger.num_iterations = remaining
+			await self.shell.update_sql_data_async("time_triggers", {"start_time": nextTime, "num_iterations": remaining}, {"id": id})
+			self.schedule_time_trigger(trigger)
+		else:
+			self.time_triggers.pop(id, None)
+			await self.shell.delete_sql_data_async("time_triggers", {"id": id})
+
+		for i in range(runs):
+			scope = self.shell.create_scope(server, [""])
+			scope.channel = self.shell.get_default_channel(server)
+			scope.user = server.me
+			scope.permission = praxisbot.UserPermission.Script
+			await self.shell.execute_script(scope, trigger.script, "time trigger #"+str(id))
+
+	async def execute_unregistered_command(self, scope, command, options, lines):
+		return await self.execute_trigger_script(scope, command, options, lines)
+
+	async def on_message(self, scope, message, command_found):
+		if command_found:
+			return
+
+		for t in self.get_message_triggers(scope.server):
+			try:
+				if t.match(message.content):
+					subScope = scope.create_subscope()
+					subScope.prefixes = [""]
+					subScope.user = message.author
+					subScope.channel = message.channel
+					subScope.vars["params"] = message.content
+					subScope.verbose = 1
+					await scope.shell.execute_script(subScope, t.script, "message trigger #"+str(t.id))
+			except:
+				pass
 
-		return
 
 	async def on_member_join(self, scope):
 		await self.execute_trigger_script(scope, "@join", "", [])
@@ -115,7 +376,7 @@ class TriggerPlugin(praxisbot.Plugin):
 		return True
 
 	async def execute_trigger_script(self, scope, command, options, lines, **kwargs):
-		script = scope.shell.get_sql_data("triggers", ["script"], {"discord_sid":int(scope.server.id), "command":command})
+		script = self.get_trigger_script(scope.server, command)
 		if not script:
 			return False
 
@@ -124,22 +385,21 @@ class TriggerPlugin(praxisbot.Plugin):
 		subScope.vars["params"] = options.strip()
 		subScope.permission = praxisbot.UserPermission.Script
 		subScope.verbose = 1
-		await scope.shell.execute_script(subScope, script[0])
+		await scope.shell.execute_script(subScope, script, command)
 		scope.continue_from_subscope(subScope)
 		return True
 
 	@praxisbot.command
 	@praxisbot.permission_admin
+	@praxisbot.argument('command', help='Name of the trigger or ID of the message and time triggers.')
+	@praxisbot.argument('--message', '-m', action='store_true', help='Edit a message trigger.')
+	@praxisbot.argument('--time', '-t', action='store_true', help='Edit a time trigger.')
 	async def execute_edit_trigger(self, scope, command, options, lines, **kwargs):
 		"""
 		Edit the script associated to a trigger. The script must be written on the line after the command.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('command', help='Name of the trigger or ID of the message and time triggers.')
-		parser.add_argument('--message', '-m', action='store_true', help='Edit a message trigger.')
-		parser.add_argument('--time', '-t', action='store_true', help='Edit a time trigger.')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -150,100 +410,105 @@ class TriggerPlugin(praxisbot.Plugin):
 		if args.message:
 			self.ensure_object_id("Message trigger ID", args.command)
 
-			trigger = scope.shell.get_sql_data("message_triggers", ["id"], {"discord_sid":int(scope.server.id), "id":int(args.command)})
+			trigger = await scope.shell.get_sql_data_async("message_triggers", ["id"], {"discord_sid":int(scope.server.id), "id":int(args.command)})
 			if not trigger:
 				await scope.shell.print_error(scope, "Message trigger #"+args.command+" not found. Please check existing message triggers with `message_triggers`.")
 				return
 
-			scope.shell.set_sql_data("message_triggers", {"script": "\n".join(lines)}, {"id":trigger[0]})
+			await scope.shell.set_sql_data_async("message_triggers", {"script": "\n".join(lines)}, {"id":trigger[0]})
+			self.invalidate_message_triggers(scope.server)
 			await scope.shell.print_success(scope, "Message trigger #"+args.command+" edited.")
 		elif args.time:
 			self.ensure_object_id("Time trigger ID", args.command)
 
-			trigger = scope.shell.get_sql_data("time_triggers", ["id"], {"discord_sid":int(scope.server.id), "id":int(args.command)})
+			trigger = await scope.shell.get_sql_data_async("time_triggers", ["id"], {"discord_sid":int(scope.server.id), "id":int(args.command)})
 			if not trigger:
 				await scope.shell.print_error(scope, "Time trigger #"+args.command+" not found. Please check existing time triggers with `time_triggers`.")
 				return
 
-			scope.shell.set_sql_data("time_triggers", {"script": "\n".join(lines)}, {"id":trigger[0]})
+			await scope.shell.set_sql_data_async("time_triggers", {"script": "\n".join(lines)}, {"id":trigger[0]})
+			if trigger[0] in self.time_triggers:
+				self.time_triggers[trigger[0]].script = scope.shell.compile_script("\n".join(lines))
 			await scope.shell.print_success(scope, "Time trigger #"+args.command+" edited.")
 		else:
 			if args.command not in ["@join", "@leave", "@ban", "@unban"]:
 				self.ensure_object_name("Command name", args.command)
 
-			trigger = scope.shell.get_sql_data("triggers", ["id"], {"discord_sid":int(scope.server.id), "command":str(args.command)})
+			trigger = await scope.shell.get_sql_data_async("triggers", ["id"], {"discord_sid":int(scope.server.id), "command":str(args.command)})
 			if not trigger:
 				await scope.shell.print_error(scope, "Trigger `"+args.command+"` not found.")
 				return
 
-			scope.shell.set_sql_data("triggers", {"script": "\n".join(lines)}, {"id":trigger[0]})
+			await scope.shell.set_sql_data_async("triggers", {"script": "\n".join(lines)}, {"id":trigger[0]})
+			await self.invalidate_trigger(scope.server, str(args.command))
 			await scope.shell.print_success(scope, "Trigger `"+args.command+"` edited.")
 
 	@praxisbot.command
 	@praxisbot.permission_admin
+	@praxisbot.argument('command', help='Name of the trigger or ID of the message and time triggers.')
+	@praxisbot.argument('--message', '-m', action='store_true', help='Delete a message trigger.')
+	@praxisbot.argument('--time', '-t', action='store_true', help='Delete a time trigger.')
 	async def execute_delete_trigger(self, scope, command, options, lines, **kwargs):
 		"""
 		Delete a trigger.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('command', help='Name of the trigger or ID of the message and time triggers.')
-		parser.add_argument('--message', '-m', action='store_true', help='Delete a message trigger.')
-		parser.add_argument('--time', '-t', action='store_true', help='Delete a time trigger.')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
 		if args.message:
 			self.ensure_object_id("Message trigger ID", args.command)
 
-			trigger = scope.shell.get_sql_data("message_triggers", ["id"], {"discord_sid":int(scope.server.id), "id":int(args.command)})
+			trigger = await scope.shell.get_sql_data_async("message_triggers", ["id"], {"discord_sid":int(scope.server.id), "id":int(args.command)})
 			if not trigger:
 				await scope.shell.print_error(scope, "Message trigger #"+args.command+" not found. Please check existing message triggers with `message_triggers`.")
 				return
 
-			scope.shell.delete_sql_data("message_triggers", {"id":trigger[0]})
+			await scope.shell.delete_sql_data_async("message_triggers", {"id":trigger[0]})
+			self.invalidate_message_triggers(scope.server)
 			await scope.shell.print_success(scope, "Message trigger #"+args.command+" deleted.")
 		elif args.time:
 			self.ensure_object_id("Time trigger ID", args.command)
 
-			trigger = scope.shell.get_sql_data("time_triggers", ["id"], {"discord_sid":int(scope.server.id), "id":int(args.command)})
+			trigger = await scope.shell.get_sql_data_async("time_triggers", ["id"], {"discord_sid":int(scope.server.id), "id":int(args.command)})
 			if not trigger:
 				await scope.shell.print_error(scope, "Time trigger #"+args.command+" not found. Please check existing time triggers with `time_triggers`.")
 				return
 
-			scope.shell.delete_sql_data("time_triggers", {"id":trigger[0]})
+			await scope.shell.delete_sql_data_async("time_triggers", {"id":trigger[0]})
+			self.unschedule_time_trigger(trigger[0])
 			await scope.shell.print_success(scope, "Time trigger #"+args.command+" deleted.")
 		else:
 			if args.command not in ["@join", "@leave", "@ban", "@unban"]:
 				self.ensure_object_name("Command name", args.command)
 
-			trigger = scope.shell.get_sql_data("triggers", ["id"], {"discord_sid":int(scope.server.id), "command":str(args.command)})
+			trigger = await scope.shell.get_sql_data_async("triggers", ["id"], {"discord_sid":int(scope.server.id), "command":str(args.command)})
 			if not trigger:
 				await scope.shell.print_error(scope, "Trigger `"+args.command+"` not found.")
 				return
 
-			scope.shell.delete_sql_data("triggers", {"id":trigger[0]})
+			await scope.shell.delete_sql_data_async("triggers", {"id":trigger[0]})
+			await self.invalidate_trigger(scope.server, str(args.command))
 			await scope.shell.print_success(scope, "Trigger `"+args.command+"` deleted.")
 
 	@praxisbot.command
+	@praxisbot.argument('command', help='Name of the trigger or ID of the message and time triggers.')
+	@praxisbot.argument('--message', '-m', action='store_true', help='Show a message trigger.')
+	@praxisbot.argument('--time', '-t', action='store_true', help='Show a time trigger.')
 	async def execute_show_trigger(self, scope, command, options, lines, **kwargs):
 		"""
 		Show the script associated to a trigger.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('command', help='Name of the trigger or ID of the message and time triggers.')
-		parser.add_argument('--message', '-m', action='store_true', help='Show a message trigger.')
-		parser.add_argument('--time', '-t', action='store_true', help='Show a time trigger.')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
 		if args.message:
 			self.ensure_object_id("Message trigger ID", args.command)
 
-			trigger = scope.shell.get_sql_data("message_triggers", ["script"], {"discord_sid":int(scope.server.id), "id":int(args.command)})
+			trigger = await scope.shell.get_sql_data_async("message_triggers", ["script"], {"discord_sid":int(scope.server.id), "id":int(args.command)})
 			if not trigger:
 				await scope.shell.print_error(scope, "Message trigger #"+args.command+" not found. Please check existing message triggers with `message_triggers`.")
 				return
@@ -252,7 +517,7 @@ class TriggerPlugin(praxisbot.Plugin):
 		elif args.time:
 			self.ensure_object_id("Time trigger ID", args.command)
 
-			trigger = scope.shell.get_sql_data("time_triggers", ["script"], {"discord_sid":int(scope.server.id), "id":int(args.command)})
+			trigger = await scope.shell.get_sql_data_async("time_triggers", ["script"], {"discord_sid":int(scope.server.id), "id":int(args.command)})
 			if not trigger:
 				await scope.shell.print_error(scope, "Time trigger #"+args.command+" not found. Please check existing time triggers with `time_triggers`.")
 				return
@@ -262,7 +527,7 @@ class TriggerPlugin(praxisbot.Plugin):
 			if args.command not in ["@join", "@leave", "@ban", "@unban"]:
 				self.ensure_object_name("Command name", args.command)
 
-			trigger = scope.shell.get_sql_data("triggers", ["script"], {"discord_sid":int(scope.server.id), "command":str(args.command)})
+			trigger = await scope.shell.get_sql_data_async("triggers", ["script"], {"discord_sid":int(scope.server.id), "command":str(args.command)})
 			if not trigger:
 				await scope.shell.print_error(scope, "Trigger `"+args.command+"` not found.")
 				return
@@ -271,15 +536,14 @@ class TriggerPlugin(praxisbot.Plugin):
 
 	@praxisbot.command
 	@praxisbot.permission_admin
+	@praxisbot.argument('command', help='Name of the trigger')
+	@praxisbot.argument('--force', '-f', action='store_true', help='Replace the trigger if it already exists')
 	async def execute_create_trigger(self, scope, command, options, lines, **kwargs):
 		"""
 		Associate a script to a trigger. The script must be written on the line after the command.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('command', help='Name of the trigger')
-		parser.add_argument('--force', '-f', action='store_true', help='Replace the trigger if it already exists')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -290,12 +554,13 @@ class TriggerPlugin(praxisbot.Plugin):
 		if args.command not in ["@join", "@leave", "@ban", "@unban"]:
 			self.ensure_object_name("Command name", args.command)
 
-		trigger = scope.shell.get_sql_data("triggers", ["id"], {"discord_sid":int(scope.server.id), "command":str(args.command)})
+		trigger = await scope.shell.get_sql_data_async("triggers", ["id"], {"discord_sid":int(scope.server.id), "command":str(args.command)})
 		if trigger and not args.force:
 			await scope.shell.print_error(scope, "Trigger `"+args.command+"` already exists. Please use --force to replace it.")
 			return
 
-		scope.shell.set_sql_data("triggers", {"script": "\n".join(lines)}, {"discord_sid":int(scope.server.id), "command":str(args.command)})
+		await scope.shell.set_sql_data_async("triggers", {"script": "\n".join(lines)}, {"discord_sid":int(scope.server.id), "command":str(args.command)})
+		await self.invalidate_trigger(scope.server, str(args.command))
 		if trigger:
 			await scope.shell.print_success(scope, "Trigger `"+args.command+"` edited.")
 		else:
@@ -308,49 +573,72 @@ class TriggerPlugin(praxisbot.Plugin):
 		List all custom commands.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
 		stream = praxisbot.MessageStream(scope)
 		await stream.send("__**List of commands**__\n")
 
-		with scope.shell.dbcon:
-			c = scope.shell.dbcon.cursor()
-			for row in c.execute("SELECT command FROM "+scope.shell.dbtable("triggers")+" WHERE discord_sid = ? ORDER BY command", [int(scope.server.id)]):
-				if row[0].find("@") != 0:
-					await stream.send("\n - "+row[0])
+		for row in await scope.shell.db.fetchall("SELECT command FROM "+scope.shell.dbtable("triggers")+" WHERE discord_sid = ? ORDER BY command", [int(scope.server.id)]):
+			if row[0].find("@") != 0:
+				await stream.send("\n - "+row[0])
 
 		await stream.finish()
 
 	@praxisbot.command
 	@praxisbot.permission_script
+	@praxisbot.argument('time', nargs='?', help='Date and time. Must be in the format "YYYY-MM-DD HH-MM-SS".')
+	@praxisbot.argument('--command', help='Command to execute.')
+	@praxisbot.argument('--cron', help='Repeat the script following a cron-like recurrence: "minute hour day month weekday". Ex.: "0 9 * * 1" every monday at 9:00.')
+	@praxisbot.argument('--repeat', type=int, help='Number of executions. By default 1, or unlimited with --cron.')
+	@praxisbot.argument('--catchup', choices=[CatchUpPolicy.Skip, CatchUpPolicy.Once, CatchUpPolicy.All], default=CatchUpPolicy.Once, help='Executions missed while the bot was offline: skip them, execute once or execute all of them.')
 	async def execute_create_time_trigger(self, scope, command, options, lines, **kwargs):
 		"""
 		Execute a script at a specified time.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('time', nargs='?', help='Date and time. Must be in the format "YYYY-MM-DD HH-MM-SS".')
-		parser.add_argument('--command', help='Command to execute.')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
+		recurrence = None
+		if args.cron:
+			try:
+				recurrence = CronExpression(args.cron)
+			except ValueError as e:
+				await scope.shell.print_error(scope, "Invalid recurrence. "+str(e))
+				return
+
 		num_iterations = 1
-		try:
-			if args.time:
-				start_time = datetime.datetime.strptime(args.time, "%Y-%m-%d %H:%M:%S")
-				start_time = timezone('Europe/Paris').localize(start_time)
-				start_time_utc = start_time.astimezone(timezone('UTC'))
-			else:
-				start_time_utc = datetime.datetime.now(timezone('UTC'))
-				start_time = start_time_utc.astimezone(timezone('Europe/Paris'))
-		except ValueError:
-			await scope.shell.print_error(scope, "Date and time must be in the format \"yyyy-mm-dd HH:MM:SS\". Ex.: 2018-06-19 20:01:56.")
+		if args.repeat != None:
+			num_iterations = args.repeat
+		elif recurrence:
+			num_iterations = 0
+		if num_iterations < 0 or (num_iterations != 1 and not recurrence):
+			await scope.shell.print_error(scope, "A script can be executed several times only with a recurrence (--cron).")
 			return
 
+		if args.time:
+			try:
+				start_time = datetime.datetime.strptime(args.time, "%Y-%m-%d %H:%M:%S")
+			except ValueError:
+				await scope.shell.print_error(scope, "Date and time must be in the format \"yyyy-mm-dd HH:MM:SS\". Ex.: 2018-06-19 20:01:56.")
+				return
+			start_time = timezone('Europe/Paris').localize(start_time)
+			start_time_utc = start_time.astimezone(timezone('UTC'))
+		elif recurrence:
+			try:
+				start_time = recurrence.next_time(datetime.datetime.now(timezone('Europe/Paris')).replace(tzinfo=None))
+			except ValueError as e:
+				await scope.shell.print_error(scope, "Invalid recurrence. "+str(e))
+				return
+			start_time = timezone('Europe/Paris').localize(start_time)
+			start_time_utc = start_time.astimezone(timezone('UTC'))
+		else:
+			start_time_utc = datetime.datetime.now(timezone('UTC'))
+			start_time = start_time_utc.astimezone(timezone('Europe/Paris'))
+
 		if args.command:
 			script = args.command
 		elif len(lines) > 0:
@@ -359,8 +647,16 @@ class TriggerPlugin(praxisbot.Plugin):
 			await scope.shell.print_error(scope, "Missing script. Please write the script in the same message, just the line after the command. Ex.:```\ncreate_time_trigger \"2018-06-19 20:01:56\"\nsay \"Hi {{@user}}!\"\nsay \"How are you?\"```")
 			return
 
-		scope.shell.add_sql_data("time_triggers", {"discord_sid": int(scope.server.id), "script": script,  "start_time": start_time_utc.strftime("%Y-%m-%d %H:%M:%S"),  "num_iterations": num_iterations})
-		await scope.shell.print_success(scope, "The script will be executed "+str(num_iterations)+" time at "+start_time.strftime("%Y-%m-%d %H:%M:%S")+".")
+		fields = {"discord_sid": int(scope.server.id), "script": script,  "start_time": int(start_time_utc.timestamp()),  "num_iterations": num_iterations, "recurrence": args.cron, "catch_up": args.catchup}
+		id = await scope.shell.add_sql_data_async("time_triggers", fields)
+		self.schedule_time_trigger(TimeTrigger(scope.shell, id, scope.server.id, script, fields["start_time"], num_iterations, args.cron, args.catchup))
+
+		if not recurrence:
+			await scope.shell.print_success(scope, "The script will be executed at "+start_time.strftime("%Y-%m-%d %H:%M:%S")+".")
+		elif num_iterations == 0:
+			await scope.shell.print_success(scope, "The script will be executed at "+start_time.strftime("%Y-%m-%d %H:%M:%S")+", then following `"+recurrence.text+"`.")
+		else:
+			await scope.shell.print_success(scope, "The script will be executed "+str(num_iterations)+" times from "+start_time.strftime("%Y-%m-%d %H:%M:%S")+", following `"+recurrence.text+"`.")
 
 	@praxisbot.command
 	async def execute_time_triggers(self, scope, command, options, lines, **kwargs):
@@ -368,34 +664,35 @@ class TriggerPlugin(praxisbot.Plugin):
 		List all time triggers.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
 		stream = praxisbot.MessageStream(scope)
 		await stream.send("__**List of time triggers**__")
 
-		with scope.shell.dbcon:
-			c = scope.shell.dbcon.cursor()
-			for row in c.execute("SELECT id, script, start_time as 'start_time_ [timestamp]' FROM "+scope.shell.dbtable("time_triggers")+" WHERE discord_sid = ? ORDER BY start_time", [int(scope.server.id)]):
-				start_time = timezone('UTC').localize(row[2])
-				start_time = start_time.astimezone(timezone('Europe/Paris'))
+		for row in await scope.shell.db.fetchall("SELECT id, script, start_time, num_iterations, recurrence, catch_up FROM "+scope.shell.dbtable("time_triggers")+" WHERE discord_sid = ? ORDER BY start_time", [int(scope.server.id)]):
+			start_time = datetime.datetime.fromtimestamp(row[2], timezone('Europe/Paris'))
 
-				await stream.send("\n\n:timer: **Time trigger #"+str(row[0])+":** `"+start_time.strftime("%Y-%m-%d %H:%M:%S")+"`\n```\n"+row[1]+"\n```")
+			text = "\n\n:timer: **Time trigger #"+str(row[0])+":** `"+start_time.strftime("%Y-%m-%d %H:%M:%S")+"`"
+			if row[4]:
+				text = text+", repeated following `"+row[4]+"`"
+				if row[3]:
+					text = text+", "+str(row[3])+" executions left"
+				text = text+", missed executions: "+str(row[5] or CatchUpPolicy.Once)
+			await stream.send(text+"\n```\n"+row[1]+"\n```")
 
 		await stream.finish()
 
 	@praxisbot.command
 	@praxisbot.permission_admin
+	@praxisbot.argument('regex', help='Regular expression to filter messages.')
 	async def execute_create_message_trigger(self, scope, command, options, lines, **kwargs):
 		"""
 		Execute a script when a message match a regular expression.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		parser.add_argument('regex', help='Regular expression to filter messages.')
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
@@ -407,7 +704,8 @@ class TriggerPlugin(praxisbot.Plugin):
 
 		script = "\n".join(lines)
 
-		scope.shell.add_sql_data("message_triggers", {"discord_sid": int(scope.server.id), "script": script,  "regex": str(args.regex)})
+		await scope.shell.add_sql_data_async("message_triggers", {"discord_sid": int(scope.server.id), "script": script,  "regex": str(args.regex)})
+		self.invalidate_message_triggers(scope.server)
 
 		await scope.shell.print_success(scope, "Message trigger created.")
 
@@ -417,18 +715,15 @@ class TriggerPlugin(praxisbot.Plugin):
 		List all message triggers.
 		"""
 
-		parser = argparse.ArgumentParser(description=kwargs["description"], prog=command)
-		args = await self.parse_options(scope, parser, options)
+		args = await self.parse_options(scope, kwargs["parser"], options)
 		if not args:
 			return
 
 		stream = praxisbot.MessageStream(scope)
 		await stream.send("__**List of message triggers**__")
 
-		with scope.shell.dbcon:
-			c = scope.shell.dbcon.cursor()
-			for row in c.execute("SELECT id, script, regex FROM "+scope.shell.dbtable("message_triggers")+" WHERE discord_sid = ?", [int(scope.server.id)]):
+		for row in await scope.shell.db.fetchall("SELECT id, script, regex FROM "+scope.shell.dbtable("message_triggers")+" WHERE discord_sid = ?", [int(scope.server.id)]):
 
-				await stream.send("\n\n**:scroll: Message trigger #"+str(row[0])+":** `"+row[2]+"`\n```\n"+row[1]+"\n```")
+			await stream.send("\n\n**:scroll: Message trigger #"+str(row[0])+":** `"+row[2]+"`\n```\n"+row[1]+"\n```")
 
 		await stream.finish()
@@ -22,7 +22,6 @@ along with PraxisBot.  If not, see <http://www.gnu.org/licenses/>.
 
 import discord
 import sys
-import io
 import re
 import traceback
 import time
@@ -82,17 +81,60 @@ class PraxisBot(discord.Client):
 
 		self.mode = "testing"
 		self.dbprefix = "pb_"
-		self.dbcon = sqlite3.connect("databases/praxisbot-"+self.mode+".db", detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-		self.banned_members = {}
+		self.db = praxisbot.Database("databases/praxisbot-"+self.mode+".db")
+		self.dbcon = self.db.connection
+		self.banned_members = praxisbot.RecentSet(60)
 
 		with self.dbcon:
 			#Server list
 			self.dbcon.execute("CREATE TABLE IF NOT EXISTS "+self.dbprefix+"servers(discord_sid INTEGER PRIMARY KEY, command_prefix TEXT)");
 
-		self.shell = praxisbot.Shell(self, client_human, self.dbprefix, self.dbcon)
+		self.shell = praxisbot.Shell(self, client_human, self.dbprefix, self.dbcon, self.db)
+		self.http.request = self.shell.profiler.wrap_http(self.http.request)
+		self.event_queues = praxisbot.ServerEventQueues(self.loop)
 
 		self.loopstarted = False
 
+	def get_event_server(self, event, args):
+		"""
+		Return the server concerned by an event handled by plugins, or None.
+		Bans are not queued: on_member_ban waits for audit logs and would block the server queue.
+		"""
+		if event == "message":
+			return args[0].server
+		elif event == "reaction_add":
+			return args[0].message.server
+		elif event == "raw_reaction_add":
+			channel = self.get_channel(args[2])
+			if channel and not channel.is_private:
+				return channel.server
+		elif event in ["member_join", "member_remove"]:
+			return args[0].server
+		elif event == "member_unban":
+			return args[0]
+		return None
+
+	def dispatch(self, event, *args, **kwargs):
+		self.shell.resolver.handle_event(event, args)
+
+		server = self.get_event_server(event, args)
+		if not server:
+			super().dispatch(event, *args, **kwargs)
+			return
+
+		handler = "handle_"+event
+		if hasattr(self, handler):
+			getattr(self, handler)(*args, **kwargs)
+
+		method = "on_"+event
+		if hasattr(self, method):
+			self.event_queues.push(server.id, event, self._run_event, method, *args, **kwargs)
+
+	async def close(self):
+		#Commit the queued writes before the loop stops
+		await self.db.flush()
+		await super().close()
+
 	def load_all_plugins(self):
 		self.shell.load_plugin(CorePlugin)
 		self.shell.load_plugin(TriggerPlugin)
@@ -111,30 +153,26 @@ class PraxisBot(discord.Client):
 	async def on_ready(self):
 		print("Bot logged on as {0}".format(self.user))
 
-		self.load_all_plugins()
-
 		if not self.loopstarted:
 			self.loopstarted = True
-			prevTime = time.time()
-			while True:
-				currTime = time.time()
-				sleepDuration = 5 - (currTime - prevTime)
-				prevTime = currTime
-				if sleepDuration > 0:
-					await asyncio.sleep(sleepDuration)
-
-				for p in self.shell.plugins:
-					for s in self.servers:
-						scope = self.shell.create_scope(s, [""])
-						scope.channel = self.shell.get_default_channel(s)
-						scope.user = s.me
-						scope.permission = praxisbot.UserPermission.Script
-
-						try:
-							await p.on_loop(scope)
-						except:
-							print(traceback.format_exc())
-							pass
+			self.load_all_plugins()
+			self.shell.start_periodic_jobs()
+
+		for p in self.shell.plugins:
+			try:
+				await p.on_ready()
+			except:
+				print(traceback.format_exc())
+
+	async def on_server_join(self, server):
+		self.shell.schedule_server_jobs(server)
+
+	async def on_server_remove(self, server):
+		for p in self.shell.plugins:
+			try:
+				await p.on_server_remove(server)
+			except:
+				print(traceback.format_exc())
 
 	async def on_reaction_add(self, reaction, user):
 		if reaction.message.channel.is_private:
@@ -155,6 +193,27 @@ class PraxisBot(discord.Client):
 			except:
 				pass
 
+	async def on_raw_reaction_add(self, emoji, message_id, channel_id, user_id):
+		channel = self.get_channel(channel_id)
+		if not channel or channel.is_private:
+			return
+		user = channel.server.get_member(user_id)
+		if not user:
+			return
+		if user.bot:
+			return
+
+		scope = self.shell.create_scope(channel.server, [""])
+		scope.channel = channel
+		scope.user = user
+		scope.permission = praxisbot.UserPermission.Script
+
+		for p in self.shell.plugins:
+			try:
+				await p.on_raw_reaction(scope, message_id, emoji)
+			except:
+				print(traceback.format_exc())
+
 	async def on_message(self, message):
 		if message.channel.is_private:
 			return
@@ -163,13 +222,9 @@ class PraxisBot(discord.Client):
 		if message.author.bot:
 			return
 
-		prefixes = [self.user.mention+" "]
-
-		customCommandPrefix = self.shell.get_sql_data("servers", ["command_prefix"], {"discord_sid": int(message.server.id)})
-		if customCommandPrefix:
-			prefixes.append(customCommandPrefix[0])
+		settings = self.shell.get_server_settings(message.server)
 
-		scope = self.shell.create_scope(message.server, prefixes)
+		scope = self.shell.create_scope(message.server, settings.prefixes)
 		scope.channel = message.channel
 		scope.user = message.author
 		if message.author.id == message.server.owner.id:
@@ -177,7 +232,9 @@ class PraxisBot(discord.Client):
 		elif message.author.server_permissions.administrator:
 			scope.permission = praxisbot.UserPermission.Admin
 
-		command_found = await self.shell.execute_command(scope, message.content)
+		command_found = False
+		if settings.match_prefix(message.content):
+			command_found = await self.shell.execute_command(scope, message.content)
 
 		for p in self.shell.plugins:
 			await p.on_message(scope, message, command_found)
@@ -204,13 +261,18 @@ class PraxisBot(discord.Client):
 			print(traceback.format_exc())
 			pass
 
+	async def on_member_update(self, before, after):
+		for p in self.shell.plugins:
+			try:
+				await p.on_member_update(before, after)
+			except:
+				print(traceback.format_exc())
+
 	async def on_member_remove(self, member):
 		reason = "leave"
 
 		if member.id in self.banned_members:
-			accepted_time = datetime.datetime.now() - datetime.timedelta(minutes=1)
-			if self.banned_members[member.id] > accepted_time:
-				reason = "ban"
+			reason = "ban"
 
 		try:
 			scope = self.shell.create_scope(member.server, [""])
@@ -229,45 +291,32 @@ class PraxisBot(discord.Client):
 
 	async def on_member_ban(self, member):
 
-		self.banned_members[member.id] = datetime.datetime.now()
+		self.banned_members.add(member.id)
 
 		ban_author = ""
-		ban_target = ""
 		ban_reason = ""
-		ban_found_in_logs = False
 
 		try:
-			startTime = time.time()
-			while not ban_found_in_logs:
-				currTime = time.time()
-				duration = (currTime - startTime)
-				if duration > 60:
-					break
-
-				bans = await self.shell.client.get_ban_logs(member.server, limit=10)
-
-				for b in bans:
-					if b.target.id == member.id:
-						author = b.author
-						reason = b.reason
-
-						if b.author.id == self.shell.client.user.id:
-							#Try to find the true author in the reason
-							res = re.search("(.+#[0-9][0-9][0-9][0-9]) using ban command", b.reason)
-							if res:
-								u = self.shell.find_member(res.group(1), member.server)
-								if u:
-									author = u
-
-							res = re.search("using ban command:(.+)", b.reason)
-							if res:
-								reason = res.group(1).strip()
-
-						ban_author = author.name+"#"+author.discriminator
-						ban_reason = reason
-						ban_target = b.target.name+"#"+b.target.discriminator
-						ban_found_in_logs = True
-						break
+			#The entry is created when the ban is done, a bit before the event
+			b = await self.shell.ban_logs.find(member.server, member.id, time.time()-60)
+			if b:
+				author = b.author
+				reason = b.reason
+
+				if b.author.id == self.shell.client.user.id:
+					#Try to find the true author in the reason
+					res = re.search("(.+#[0-9][0-9][0-9][0-9]) using ban command", b.reason)
+					if res:
+						u = self.shell.find_member(res.group(1), member.server)
+						if u:
+							author = u
+
+					res = re.search("using ban command:(.+)", b.reason)
+					if res:
+						reason = res.group(1).strip()
+
+				ban_author = author.name+"#"+author.discriminator
+				ban_reason = reason
 		except:
 			print(traceback.format_exc())
 			pass
@@ -312,6 +361,7 @@ try:
 
 	bot = PraxisBot(human)
 	bot.run(botToken)
+	bot.db.close()
 
 except KeyboardInterrupt:
 	human.loop.run_until_complete(human.logout())
@@ -18,10 +18,8 @@ along with PraxisBot.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
-import sys
-import io
 import traceback
-import shlex
+import argparse
 import copy
 import inspect
 import re
@@ -29,23 +27,19 @@ import random
 import sqlite3
 import discord
 import datetime
+import time
+import asyncio
+import collections
+import heapq
+import json
+import threading
+import concurrent.futures
 from pytz import timezone
-from functools import wraps
-
-class RedirectOutput():
-	def __init__(self, destout, desterr):
-		self.destout = destout
-		self.desterr = desterr
-		self.old_stdout = sys.stdout
-		self.old_stderr = sys.stderr
-
-	def __enter__(self):
-		sys.stdout = self.destout
-		sys.stderr = self.desterr
-
-	def __exit__(self, *args):
-		sys.stdout = self.old_stdout
-		sys.stderr = self.old_stderr
+from functools import wraps, lru_cache
+try:
+	from re import _parser as sre_parse
+except ImportError:
+	import sre_parse
 
 ################################################################################
 # Exceptions
@@ -57,6 +51,11 @@ class Error(Exception):
 class TooLongScriptError(Error):
 	pass
 
+class TooLongExecutionError(Error):
+	def __init__(self, resource, limit):
+		self.resource = resource
+		self.limit = limit
+
 class AdminPermissionError(Error):
 	pass
 
@@ -89,18 +88,100 @@ class RegexError(Error):
 	def __init__(self, regex):
 		self.regex = regex
 
+class OptionsError(Error):
+	def __init__(self, text):
+		self.text = text
+
+class OptionsHelp(Error):
+	def __init__(self, text):
+		self.text = text
+
+################################################################################
+# Options
+################################################################################
+
+class ArgumentParser(argparse.ArgumentParser):
+	"""
+	Parser of command options. Errors and help are raised instead of being printed, so the parser can be shared.
+	"""
+
+	def error(self, message):
+		raise OptionsError(message+"\n\n"+self.format_usage())
+
+	def print_help(self, file=None):
+		raise OptionsHelp(self.format_help())
+
+	def exit(self, status=0, message=None):
+		raise OptionsError(message or "")
+
+optionsTokenRegex = re.compile(r"""([^ \t\r\n'"\\]+)|'([^']*)'|"((?:[^"\\]|\\.)*)"|\\(.)|([ \t\r\n]+)|(.)""", re.DOTALL)
+optionsEscapeRegex = re.compile(r'\\(["\\])')
+
+def split_options(options):
+	"""
+	Split an option string like shlex.split, without the overhead of shlex
+	"""
+	tokens = []
+	token = None
+	for m in optionsTokenRegex.finditer(options):
+		kind = m.lastindex
+		if kind == 5:
+			if token != None:
+				tokens.append(token)
+				token = None
+			continue
+		elif kind == 6:
+			if m.group(6) == "\\":
+				raise ValueError("No escaped character")
+			raise ValueError("No closing quotation")
+		elif kind == 3:
+			piece = optionsEscapeRegex.sub(r"\1", m.group(3))
+		else:
+			piece = m.group(kind)
+
+		if token == None:
+			token = piece
+		else:
+			token = token+piece
+
+	if token != None:
+		tokens.append(token)
+	return tokens
+
+def create_parser(name, cmd):
+	"""
+	Build the parser of a command from the arguments declared with @argument
+	"""
+	parser = ArgumentParser(description=getattr(cmd, "description", None), prog=name)
+	for a in getattr(cmd, "arguments", []):
+		parser.add_argument(*a[0], **a[1])
+	return parser
+
 ################################################################################
 # Decorators
 ################################################################################
 
 def command(func):
+	d = inspect.getdoc(func)
+
 	@wraps(func)
 	def wrapper(self, scope, command, options, lines, **kwargs):
-		d = inspect.getdoc(func)
-		return func(self, scope, command, options, lines, description=d, **kwargs)
+		return func(self, scope, command, options, lines, description=d, parser=self.parsers.get(command), **kwargs)
 
+	wrapper.description = d
 	return wrapper
 
+def argument(*args, **kwargs):
+	"""
+	Declare an option of a command, with the parameters of argparse add_argument
+	"""
+	def decorator(func):
+		if not hasattr(func, "arguments"):
+			func.arguments = []
+		func.arguments.insert(0, (args, kwargs))
+		return func
+	return decorator
+
 def permission_admin(func):
 	@wraps(func)
 	def wrapper(self, scope, command, options, lines, **kwargs):
@@ -117,6 +198,138 @@ def permission_script(func):
 		return func(self, scope, command, options, lines, **kwargs)
 	return wrapper
 
+################################################################################
+# Templates
+################################################################################
+
+def _tag_user_avatar(scope, u, c, r):
+	if u:
+		return str(u.avatar_url.replace(".webp", ".png"))
+
+def _tag_now(scope, u, c, r):
+	d = datetime.datetime.now(timezone('Europe/Paris'))
+	return d.strftime("%Y-%m-%d %H:%M:%S")
+
+#Tag name (lower case) -> function(scope, user, channel, role). A function returning None lets the tag fall back to variables.
+templateTagResolvers = {
+	"server": lambda scope, u, c, r: scope.server.name if scope.server else None,
+	"*server": lambda scope, u, c, r: scope.server.id if scope.server else None,
+	"n": lambda scope, u, c, r: "\n",
+	"now": _tag_now,
+	"channel": lambda scope, u, c, r: c.name if c else None,
+	"#channel": lambda scope, u, c, r: c.mention if c else None,
+	"*channel": lambda scope, u, c, r: c.id if c else None,
+	"role": lambda scope, u, c, r: r.name if r else None,
+	"@role": lambda scope, u, c, r: r.mention if r else None,
+	"*role": lambda scope, u, c, r: r.id if r else None,
+	"#user": lambda scope, u, c, r: u.name+"#"+u.discriminator if u else None,
+	"@user": lambda scope, u, c, r: u.mention if u else None,
+	"*user": lambda scope, u, c, r: u.id if u else None,
+	"user": lambda scope, u, c, r: u.display_name if u else None,
+	"user_time": lambda scope, u, c, r: str(u.created_at) if u else None,
+	"user_avatar": _tag_user_avatar
+}
+
+templateTagRegex = re.compile(r"\{\{([^\}]+)\}\}")
+templateUserRegex = re.compile("([*@#]?user(?:_time|_avatar)?)=(.*)")
+templateChannelRegex = re.compile("([*#]?channel)=(.*)")
+templateRoleRegex = re.compile("([*@]?role)=(.*)")
+
+class TemplateTag:
+	"""
+	A {{tag}} of a template, with its user=/channel=/role= parameter already split
+	"""
+	def __init__(self, tag):
+		self.subtype = None
+		self.subject = None
+
+		chk = templateUserRegex.fullmatch(tag)
+		if chk:
+			self.subtype = "user"
+		else:
+			chk = templateChannelRegex.fullmatch(tag)
+			if chk:
+				self.subtype = "channel"
+			else:
+				chk = templateRoleRegex.fullmatch(tag)
+				if chk:
+					self.subtype = "role"
+		if chk:
+			self.subject = chk.group(2).strip()
+			tag = chk.group(1)
+
+		self.tag = tag
+		self.resolver = templateTagResolvers.get(tag.lower())
+
+	def render(self, scope):
+		u = scope.user
+		c = scope.channel
+		r = None
+		if self.subtype == "user":
+			subUser = self.subject
+			if subUser in scope.vars:
+				subUser = scope.vars[subUser].strip()
+			u = scope.shell.find_member(subUser, scope.server)
+		elif self.subtype == "channel":
+			subChan = self.subject
+			if subChan in scope.vars:
+				subChan = scope.vars[subChan]
+			c = scope.shell.find_channel(subChan, scope.server)
+		elif self.subtype == "role":
+			subRole = self.subject
+			if subRole in scope.vars:
+				subRole = scope.vars[subRole]
+			r = scope.shell.find_role(subRole, scope.server)
+
+		if self.resolver:
+			tagOutput = self.resolver(scope, u, c, r)
+			if tagOutput != None:
+				return str(tagOutput)
+
+		tag = self.tag
+		if tag[0:1] == "*" and tag[1:] in scope.vars:
+			if len(scope.vars[tag[1:]].strip()) == 0:
+				return "0"
+			return str(len(scope.vars[tag[1:]].split("\n")))
+		elif tag[0:1] == "," and tag[1:] in scope.vars:
+			return ", ".join(scope.vars[tag[1:]].split("\n"))
+		elif tag in scope.vars:
+			return str(scope.vars[tag])
+		return tag
+
+class TemplateRandomTag:
+	"""
+	A {{a|b|c}} tag: one of the alternatives is rendered
+	"""
+	def __init__(self, tag):
+		self.choices = [TemplateTag(t) for t in tag.split("|")]
+
+	def render(self, scope):
+		return random.choice(self.choices).render(scope)
+
+@lru_cache(maxsize=4096)
+def compile_template(text):
+	"""
+	Split a text into literal strings and tags. The result is cached, so it must not be modified.
+	"""
+	template = []
+	textIter = 0
+	for m in templateTagRegex.finditer(text):
+		if m.start() > textIter:
+			template.append(text[textIter:m.start()])
+		textIter = m.end()
+
+		tag = m.group(1).strip()
+		if tag.find('|') >= 0:
+			template.append(TemplateRandomTag(tag))
+		else:
+			template.append(TemplateTag(tag))
+
+	if textIter < len(text) or len(template) == 0:
+		template.append(text[textIter:])
+
+	return tuple(template)
+
 ################################################################################
 # Scope
 ################################################################################
@@ -126,17 +339,17 @@ class ExecutionBlockIf:
 		self.execute = e
 		self.terminated = False
 
-	async def execute_script(self, scope, command, commandline):
-		if command == "endif":
+	async def execute_script(self, scope, cmd):
+		if cmd.command == "endif":
 			self.terminated = True
 			return
 
-		if command == "else":
+		if cmd.command == "else":
 			self.execute = not self.execute
 			return
 
 		if self.execute:
-			await scope.shell.execute_command(scope, commandline)
+			await scope.shell.execute_compiled_command(scope, cmd)
 
 class ExecutionBlockFor:
 	def __init__(self, var, list):
@@ -145,18 +358,18 @@ class ExecutionBlockFor:
 		self.cmds = []
 		self.terminated = False
 
-	async def execute_script(self, scope, command, commandline):
-		if command == "endfor":
+	async def execute_script(self, scope, cmd):
+		if cmd.command == "endfor":
 			self.terminated = True
 			for i in self.list:
 				scope.vars[self.var] = i
 				for c in self.cmds:
-					await scope.shell.execute_command(scope, c)
+					await scope.shell.execute_compiled_command(scope, c)
 					if scope.abort:
 						return
 
 		elif len(self.list):
-			self.cmds.append(commandline)
+			self.cmds.append(cmd)
 
 class ExecutionScope:
 	def __init__(self, shell, server, prefixes):
@@ -168,24 +381,50 @@ class ExecutionScope:
 
 		self.permission = UserPermission.Member
 
-		self.iter = 0
-		self.vars = {}
+		self._budget = None
+		self._vars = None
 		self.session_vars = {}
 		self.blocks = []
 		self.abort = False
 		self.deletecmd = False
 		self.verbose = 2
 
-	async def execute_script(self, command, commandline):
+	@property
+	def vars(self):
+		"""
+		Variables of the scope. Global variables of the server are copied at the first access.
+		"""
+		if self._vars == None:
+			self._vars = self.shell.get_global_variables(self.server)
+		return self._vars
+
+	@vars.setter
+	def vars(self, value):
+		self._vars = value
+
+	@property
+	def budget(self):
+		"""
+		Resources used by the script. Scopes are not limited until they execute a script.
+		"""
+		if self._budget == None:
+			self._budget = ExecutionBudget()
+		return self._budget
+
+	@budget.setter
+	def budget(self, value):
+		self._budget = value
+
+	async def execute_script(self, cmd):
 		"""
 		Take care of conditions (if, for, ...). Return True if the command must not be executed
 		"""
 		if not len(self.blocks):
-			await self.shell.execute_command(self, commandline)
+			await self.shell.execute_compiled_command(self, cmd)
 			return
 
 		b = self.blocks[len(self.blocks)-1]
-		await b.execute_script(self, command, commandline)
+		await b.execute_script(self, cmd)
 		if b.terminated:
 			self.blocks.pop()
 
@@ -197,7 +436,7 @@ class ExecutionScope:
 
 		subScope.permission = self.permission
 
-		subScope.iter = self.iter
+		subScope.budget = self.budget
 		subScope.vars = self.vars
 		subScope.session_vars = self.session_vars
 		subScope.blocks = self.blocks
@@ -207,7 +446,6 @@ class ExecutionScope:
 		return subScope
 
 	def continue_from_subscope(self, subScope):
-		self.iter = subScope.iter
 		self.vars = subScope.vars
 		self.session_vars = subScope.session_vars
 		self.abort = subScope.abort
@@ -217,101 +455,610 @@ class ExecutionScope:
 		if not text:
 			return ""
 
-		p = re.compile("\{\{([^\}]+)\}\}")
-
-		formatedText = ""
-		textIter = 0
-		mi = p.finditer(text)
-		for m in mi:
-			formatedText = formatedText + text[textIter:m.start()]
-			textIter = m.end()
-
-			#Process tag
-			tag = m.group(1).strip()
-			tagOutput = m.group()
-
-			if tag.find('|') >= 0:
-				tag = random.choice(tag.split("|"))
-				tagOutput = tag
-
-			u = self.user
-			user_chk = re.fullmatch('([*@#]?user(?:_time|_avatar)?)=(.*)', tag)
-			if user_chk:
-				subUser = user_chk.group(2).strip()
-				if subUser in self.vars:
-					subUser = self.vars[subUser].strip()
-				u = self.shell.find_member(subUser, self.server)
-				tag = user_chk.group(1)
-
-			c = self.channel
-			channel_chk = re.fullmatch('([*#]?channel)=(.*)', tag)
-			if channel_chk:
-				subChan = channel_chk.group(2).strip()
-				if subChan in self.vars:
-					subChan = self.vars[subChan]
-				c = self.shell.find_channel(subChan, self.server)
-				tag = channel_chk.group(1)
-
-			r = None
-			role_chk = re.fullmatch('([*@]?role)=(.*)', tag)
-			if role_chk:
-				subRole = role_chk.group(2).strip()
-				if subRole in self.vars:
-					subRole = self.vars[subRole]
-				r = self.shell.find_role(subRole, self.server)
-				tag = role_chk.group(1)
-
-			if tag.lower() == "server" and self.server:
-				tagOutput = self.server.name
-			elif tag.lower() == "*server" and self.server:
-				tagOutput = self.server.id
-			elif tag.lower() == "n":
-				tagOutput = "\n"
-			elif tag.lower() == "now":
-				d = datetime.datetime.now(timezone('Europe/Paris'))
-				tagOutput = d.strftime("%Y-%m-%d %H:%M:%S")
-			elif tag.lower() == "channel" and c:
-				tagOutput = c.name
-			elif tag.lower() == "#channel" and c:
-				tagOutput = c.mention
-			elif tag.lower() == "*channel" and c:
-				tagOutput = c.id
-			elif tag.lower() == "role" and r:
-				tagOutput = r.name
-			elif tag.lower() == "@role" and r:
-				tagOutput = r.mention
-			elif tag.lower() == "*role" and r:
-				tagOutput = r.id
-			elif tag.lower() == "#user" and u:
-				tagOutput = u.name+"#"+u.discriminator
-			elif tag.lower() == "@user" and u:
-				tagOutput = u.mention
-			elif tag.lower() == "*user" and u:
-				tagOutput = u.id
-			elif tag.lower() == "user" and u:
-				tagOutput = u.display_name
-			elif tag.lower() == "user_time" and u:
-				tagOutput = str(u.created_at)
-			elif tag.lower() == "user_avatar" and u:
-				tagOutput = str(u.avatar_url.replace(".webp", ".png"))
-			elif tag[0] == "*" and tag[1:] in self.vars:
-				if len(self.vars[tag[1:]].strip()) == 0:
-					tagOutput = 0
-				else:
-					s = self.vars[tag[1:]].split("\n")
-					tagOutput = str(len(s))
-			elif tag[0] == "," and tag[1:] in self.vars:
-				s = self.vars[tag[1:]].split("\n")
-				tagOutput = ", ".join(s)
-			elif tag in self.vars:
-				tagOutput = self.vars[tag]
+		template = compile_template(text)
+		if len(template) == 1 and isinstance(template[0], str):
+			return template[0]
+
+		formatedText = []
+		for t in template:
+			if isinstance(t, str):
+				formatedText.append(t)
+			else:
+				formatedText.append(t.render(self))
+
+		return "".join(formatedText)
+
+################################################################################
+# Compiled scripts
+################################################################################
+
+class CompiledCommand:
+	"""
+	A command line parsed once: command name, option string and body lines
+	"""
+	def __init__(self, command, options, lines, commandline):
+		self.command = command
+		self.options = options
+		self.lines = lines
+		self.commandline = commandline
+
+class CompiledScript:
+	"""
+	A script split into commands, with the jump targets of if/else/for blocks
+	"""
+	def __init__(self, commands):
+		self.commands = commands
+
+		#Index of the next else/endif (resp. endfor) after each command. Blocks
+		#are not nested, exactly like ExecutionBlockIf and ExecutionBlockFor.
+		self.next_branch = [len(commands)]*len(commands)
+		self.next_endfor = [len(commands)]*len(commands)
+		branch = len(commands)
+		endfor = len(commands)
+		for i in range(len(commands)-1, -1, -1):
+			self.next_branch[i] = branch
+			self.next_endfor[i] = endfor
+			if commands[i].command in ["else", "endif"]:
+				branch = i
+			elif commands[i].command == "endfor":
+				endfor = i
+
+################################################################################
+# Regular expressions
+################################################################################
+
+def _regex_literals(items, literals):
+	run = ""
+	for op, av in items:
+		if op == sre_parse.LITERAL:
+			run = run+chr(av)
+			continue
+
+		literals.append(run)
+		run = ""
+		if op == sre_parse.SUBPATTERN:
+			if len(av) < 4 or not av[1] & sre_parse.SRE_FLAG_IGNORECASE:
+				_regex_literals(av[-1], literals)
+		elif op in [sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT] and av[0] >= 1:
+			_regex_literals(av[2], literals)
+	literals.append(run)
+
+def regex_required_literal(regex):
+	"""
+	Return the longest string that must appear in any text matched by the regex, or None if there is none.
+	Texts not containing this string can be rejected without running the regex.
+	"""
+	try:
+		pattern = sre_parse.parse(regex)
+	except:
+		return None
+
+	state = getattr(pattern, "state", None) or pattern.pattern
+	if state.flags & sre_parse.SRE_FLAG_IGNORECASE:
+		return None
+
+	literals = []
+	_regex_literals(pattern, literals)
+	literal = max(literals, key=len)
+	if len(literal) == 0:
+		return None
+	return literal
+
+################################################################################
+# Server settings
+################################################################################
+
+class ScriptLimits:
+	"""
+	Resources a script can use. None means the default value
+	"""
+	defaults = {"instructions": 256, "duration": 10, "output": 20000, "api_calls": 50}
+
+	def __init__(self, instructions=None, duration=None, output=None, api_calls=None):
+		self.instructions = instructions
+		self.duration = duration
+		self.output = output
+		self.api_calls = api_calls
+
+	def get(self, name):
+		value = getattr(self, name)
+		if value == None:
+			return ScriptLimits.defaults[name]
+		return value
+
+class ServerSettings:
+	"""
+	Settings of a server, kept in memory
+	"""
+	def __init__(self, bot_prefix, command_prefix=None, limits=None):
+		self.bot_prefix = bot_prefix
+		self.set_command_prefix(command_prefix)
+
+		self.limits = limits
+		if not self.limits:
+			self.limits = ScriptLimits()
+
+	def set_command_prefix(self, command_prefix):
+		self.command_prefix = command_prefix
+
+		self.prefixes = [self.bot_prefix]
+		if command_prefix != None:
+			self.prefixes.append(command_prefix)
+		self.prefixes_tuple = tuple(self.prefixes)
+
+	def match_prefix(self, text):
+		"""
+		Return True if the text starts with one of the command prefixes
+		"""
+		return text.startswith(self.prefixes_tuple)
+
+class ExecutionBudget:
+	"""
+	Resources used by a script. The budget is shared by a scope and its subscopes.
+	Without limits, nothing is counted: commands sent directly by members are not limited
+	"""
+	def __init__(self, limits=None):
+		self.limited = (limits != None)
+		if self.limited:
+			self.max_instructions = limits.get("instructions")
+			self.max_output = limits.get("output")
+			self.max_api_calls = limits.get("api_calls")
+			self.max_duration = limits.get("duration")
+			self.deadline = time.monotonic() + self.max_duration
+
+		self.instructions = 0
+		self.output = 0
+		self.api_calls = 0
+		self.depth = 0
+
+	max_depth = 16
+
+	def use_instruction(self):
+		if not self.limited:
+			return
+
+		self.instructions = self.instructions+1
+		if self.instructions > self.max_instructions:
+			raise TooLongExecutionError("instructions", self.max_instructions)
+		self.check_deadline()
+
+	def check_deadline(self):
+		if self.limited and time.monotonic() > self.deadline:
+			raise TooLongExecutionError("duration", self.max_duration)
+
+	def remaining_time(self):
+		"""
+		Seconds left before the deadline, usable as a timeout, or None without limits
+		"""
+		if not self.limited:
+			return None
+		return max(0.1, self.deadline-time.monotonic())
+
+	def enter_script(self):
+		self.depth = self.depth+1
+		if self.depth > ExecutionBudget.max_depth:
+			self.depth = self.depth-1
+			raise TooLongExecutionError("depth", ExecutionBudget.max_depth)
+
+	def leave_script(self):
+		self.depth = self.depth-1
+
+	def use_api_call(self):
+		"""
+		Count a request to Discord or to a website. Requests to Discord are counted by the profiler
+		"""
+		if not self.limited:
+			return
+
+		self.api_calls = self.api_calls+1
+		if self.api_calls > self.max_api_calls:
+			raise TooLongExecutionError("api_calls", self.max_api_calls)
+		self.check_deadline()
+
+	def use_output(self, text):
+		if not self.limited:
+			return
+
+		if text:
+			self.output = self.output+len(text)
+		if self.output > self.max_output:
+			raise TooLongExecutionError("output", self.max_output)
+
+################################################################################
+# Profiler
+################################################################################
+
+class ProfileStats:
+	"""
+	Timing histogram of a command or a script
+	"""
+	buckets = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+	def __init__(self):
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+		self.db_time = 0.0
+		self.http_time = 0.0
+		self.histogram = [0]*(len(ProfileStats.buckets)+1)
+
+	def add(self, duration, db_time, http_time):
+		self.count = self.count+1
+		self.total = self.total+duration
+		self.max = max(self.max, duration)
+		self.db_time = self.db_time+db_time
+		self.http_time = self.http_time+http_time
+
+		ms = duration*1000
+		i = 0
+		while i < len(ProfileStats.buckets) and ms > ProfileStats.buckets[i]:
+			i = i+1
+		self.histogram[i] = self.histogram[i]+1
+
+	def percentile(self, p):
+		"""
+		Return the upper bound of the bucket containing the percentile, in milliseconds
+		"""
+		target = self.count*p/100.0
+		counter = 0
+		for i in range(len(self.histogram)):
+			counter = counter+self.histogram[i]
+			if counter >= target and self.histogram[i] > 0:
+				if i < len(ProfileStats.buckets):
+					return min(ProfileStats.buckets[i], int(self.max*1000)+1)
+				break
+		return int(self.max*1000)+1
+
+	def to_dict(self):
+		return {"count": self.count, "total": self.total, "max": self.max, "db_time": self.db_time, "http_time": self.http_time, "p50": self.percentile(50), "p95": self.percentile(95), "p99": self.percentile(99), "histogram": dict(zip([str(b) for b in ProfileStats.buckets]+["inf"], self.histogram))}
+
+class ProfileFrame:
+	def __init__(self, parent, budget):
+		self.parent = parent
+		self.budget = budget
+		self.start = time.perf_counter()
+		self.db_time = 0.0
+		self.http_time = 0.0
+
+def current_task():
+	"""
+	Return the running asyncio task, or None outside of the event loop
+	"""
+	try:
+		if hasattr(asyncio, "current_task"):
+			return asyncio.current_task()
+		return asyncio.Task.current_task()
+	except RuntimeError:
+		return None
+
+class Profiler:
+	"""
+	Record the cost of commands and scripts, per server. The current frame is stored per asyncio task,
+	so database and HTTP time is given to the command that waited for it, and requests to Discord are
+	counted in the budget of that command
+	"""
+	def __init__(self):
+		self.stats = {}
+		self.frames = {}
+
+	def get_frame(self):
+		task = current_task()
+		if not task:
+			return None
+		return self.frames.get(task)
+
+	def start(self, budget=None):
+		task = current_task()
+		frame = ProfileFrame(self.frames.get(task), budget)
+		if task:
+			self.frames[task] = frame
+		return (frame, task)
+
+	def stop(self, started, sid, kind, name):
+		frame, task = started
+		if task:
+			if frame.parent:
+				self.frames[task] = frame.parent
 			else:
-				tagOutput = tag
-			formatedText = formatedText + str(tagOutput)
+				self.frames.pop(task, None)
+
+		key = (sid, kind, name)
+		stats = self.stats.get(key)
+		if not stats:
+			stats = ProfileStats()
+			self.stats[key] = stats
+		stats.add(time.perf_counter()-frame.start, frame.db_time, frame.http_time)
+
+	def add_db_time(self, duration, frame):
+		while frame:
+			frame.db_time = frame.db_time+duration
+			frame = frame.parent
+
+	def add_http_time(self, duration, frame):
+		while frame:
+			frame.http_time = frame.http_time+duration
+			frame = frame.parent
+
+	def wrap_http(self, request):
+		"""
+		Wrap the request method of discord HTTPClient
+		"""
+		async def profiled_request(*args, **kwargs):
+			frame = self.get_frame()
+			if frame and frame.budget:
+				frame.budget.use_api_call()
+			startTime = time.perf_counter()
+			try:
+				return await request(*args, **kwargs)
+			finally:
+				self.add_http_time(time.perf_counter()-startTime, frame)
+		return profiled_request
+
+	def get_server_stats(self, sid):
+		res = []
+		for key in self.stats:
+			if key[0] == sid:
+				res.append((key[1], key[2], self.stats[key]))
+		return res
+
+	def reset(self, sid=None):
+		if sid == None:
+			self.stats = {}
+		else:
+			for key in list(self.stats.keys()):
+				if key[0] == sid:
+					del self.stats[key]
+
+	def to_json(self, sid=None):
+		data = []
+		for key in self.stats:
+			if sid == None or key[0] == sid:
+				entry = self.stats[key].to_dict()
+				entry["server"] = key[0]
+				entry["kind"] = key[1]
+				entry["name"] = key[2]
+				data.append(entry)
+		return json.dumps(data, indent=1)
+
+class ProfiledCursor(sqlite3.Cursor):
+	def execute(self, *args, **kwargs):
+		startTime = time.perf_counter()
+		try:
+			return super().execute(*args, **kwargs)
+		finally:
+			self.connection.add_time(time.perf_counter()-startTime)
+
+	def executemany(self, *args, **kwargs):
+		startTime = time.perf_counter()
+		try:
+			return super().executemany(*args, **kwargs)
+		finally:
+			self.connection.add_time(time.perf_counter()-startTime)
+
+	def fetchall(self):
+		startTime = time.perf_counter()
+		try:
+			return super().fetchall()
+		finally:
+			self.connection.add_time(time.perf_counter()-startTime)
+
+class ProfiledConnection(sqlite3.Connection):
+	"""
+	SQLite connection reporting the time spent in queries to a profiler. Use it as factory of sqlite3.connect.
+	Connections used by worker threads receive the frame of the waiting command in `frame`
+	"""
+	profiler = None
+	frame = None
+
+	def add_time(self, duration):
+		if self.profiler:
+			frame = self.frame
+			if not frame:
+				frame = self.profiler.get_frame()
+			self.profiler.add_db_time(duration, frame)
 
-		formatedText = formatedText + text[textIter:]
+	def cursor(self, factory=ProfiledCursor):
+		return super().cursor(factory)
+
+	def execute(self, *args, **kwargs):
+		startTime = time.perf_counter()
+		try:
+			return super().execute(*args, **kwargs)
+		finally:
+			self.add_time(time.perf_counter()-startTime)
 
-		return formatedText
+	def executemany(self, *args, **kwargs):
+		startTime = time.perf_counter()
+		try:
+			return super().executemany(*args, **kwargs)
+		finally:
+			self.add_time(time.perf_counter()-startTime)
+
+################################################################################
+# Database
+################################################################################
+
+class Database:
+	"""
+	Asynchronous access to the SQLite database. Writes are serialized on a writer thread and reads use a pool
+	of WAL reader connections, so queries never block the event loop. In-memory databases can't be shared
+	between connections: their queries run directly on the main connection
+	"""
+	def __init__(self, filename=None, connection=None, num_readers=4, timeout=30, journal_delay=0.05):
+		self.filename = filename
+		self.timeout = timeout
+		self.profiler = None
+		self.local = threading.local()
+		self.writer = None
+		self.readers = None
+		self.journal = []
+		self.journal_delay = journal_delay
+		self.journal_handle = None
+		self.journal_task = None
+
+		if filename:
+			self.connection = self.connect()
+			self.writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+			self.readers = concurrent.futures.ThreadPoolExecutor(max_workers=num_readers, thread_name_prefix="db-reader")
+		else:
+			self.connection = connection
+
+	def connect(self):
+		"""
+		Open a connection in autocommit and WAL mode. Transactions are opened explicitly with BEGIN.
+		"""
+		connection = sqlite3.connect(self.filename, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES, factory=ProfiledConnection, isolation_level=None, timeout=self.timeout)
+		connection.execute("PRAGMA journal_mode=WAL")
+		connection.execute("PRAGMA synchronous=NORMAL")
+		connection.profiler = self.profiler
+		return connection
+
+	def set_profiler(self, profiler):
+		self.profiler = profiler
+		if isinstance(self.connection, ProfiledConnection):
+			self.connection.profiler = profiler
+
+	def get_thread_connection(self):
+		connection = getattr(self.local, "connection", None)
+		if not connection:
+			connection = self.connect()
+			self.local.connection = connection
+		return connection
+
+	async def run(self, executor, func, *args):
+		if not executor:
+			return func(self.connection, *args)
+
+		#Pass the profile frame to the thread so database time is given to the current command
+		frame = None
+		if self.profiler:
+			frame = self.profiler.get_frame()
+		loop = asyncio.get_event_loop()
+		return await loop.run_in_executor(executor, self.run_in_thread, frame, func, *args)
+
+	def run_in_thread(self, frame, func, *args):
+		connection = self.get_thread_connection()
+		connection.frame = frame
+		try:
+			return func(connection, *args)
+		finally:
+			connection.frame = None
+
+	def _execute(self, connection, sqlQuery, vars):
+		c = connection.cursor()
+		c.execute(sqlQuery, vars)
+		return c.lastrowid
+
+	def _executemany(self, connection, sqlQuery, rows):
+		if connection.in_transaction or connection.isolation_level != None:
+			connection.executemany(sqlQuery, rows)
+			return
+
+		connection.execute("BEGIN")
+		try:
+			connection.executemany(sqlQuery, rows)
+			connection.execute("COMMIT")
+		except:
+			connection.execute("ROLLBACK")
+			raise
+
+	def _fetchone(self, connection, sqlQuery, vars):
+		c = connection.cursor()
+		c.execute(sqlQuery, vars)
+		return c.fetchone()
+
+	def _fetchall(self, connection, sqlQuery, vars):
+		c = connection.cursor()
+		c.execute(sqlQuery, vars)
+		return c.fetchall()
+
+	def _execute_journal(self, connection, journal):
+		try:
+			connection.execute("BEGIN")
+			for sqlQuery, vars in journal:
+				connection.execute(sqlQuery, vars)
+			connection.execute("COMMIT")
+			return
+		except:
+			connection.execute("ROLLBACK")
+
+		#Apply the writes one by one so a bad write doesn't discard the others
+		for sqlQuery, vars in journal:
+			try:
+				connection.execute(sqlQuery, vars)
+			except:
+				print("Journal write failed: "+sqlQuery)
+				print(traceback.format_exc())
+
+	def write(self, sqlQuery, vars=[]):
+		"""
+		Queue a write query. Queued writes are committed together in one transaction after journal_delay,
+		in the order they were queued. Other queries of this object flush the journal first, but queries
+		made directly on the main connection don't: tables written here must be read with this object.
+		"""
+		if not self.writer:
+			self.connection.execute(sqlQuery, vars)
+			return
+
+		self.journal.append((sqlQuery, vars))
+		if not self.journal_handle:
+			self.journal_handle = asyncio.get_event_loop().call_later(self.journal_delay, self.start_flush)
+
+	def start_flush(self):
+		self.journal_handle = None
+		asyncio.ensure_future(self.flush())
+
+	async def flush(self):
+		"""
+		Commit the queued writes and wait until they are written
+		"""
+		if self.journal_handle:
+			self.journal_handle.cancel()
+			self.journal_handle = None
+
+		if len(self.journal) > 0:
+			journal = self.journal
+			self.journal = []
+			self.journal_task = asyncio.ensure_future(self.run(self.writer, self._execute_journal, journal))
+
+		#The writer thread runs tasks in order: waiting for the last flush waits for all of them
+		task = self.journal_task
+		if task:
+			await task
+			if self.journal_task == task:
+				self.journal_task = None
+
+	async def execute(self, sqlQuery, vars=[]):
+		"""
+		Execute a write query on the writer thread and return the last row id
+		"""
+		await self.flush()
+		return await self.run(self.writer, self._execute, sqlQuery, vars)
+
+	async def executemany(self, sqlQuery, rows):
+		"""
+		Execute a write query for each row, in one transaction
+		"""
+		await self.flush()
+		return await self.run(self.writer, self._executemany, sqlQuery, rows)
+
+	async def fetchone(self, sqlQuery, vars=[]):
+		await self.flush()
+		return await self.run(self.readers, self._fetchone, sqlQuery, vars)
+
+	async def fetchall(self, sqlQuery, vars=[]):
+		await self.flush()
+		return await self.run(self.readers, self._fetchall, sqlQuery, vars)
+
+	def close(self):
+		"""
+		Stop the threads. Call flush before to commit the queued writes.
+		"""
+		if self.writer:
+			if len(self.journal) > 0:
+				print("Database closed with "+str(len(self.journal))+" queued writes")
+			self.writer.shutdown()
+			self.readers.shutdown()
 
 ################################################################################
 # Shell
@@ -324,25 +1071,51 @@ class UserPermission:
 	Owner=3
 
 class Shell:
-	def __init__(self, client, client_human, dbprefix, dbcon):
+	def __init__(self, client, client_human, dbprefix, dbcon, db=None):
 		self.plugins = []
+		self.commands = {}
+		self.unregistered_command_plugins = []
+		self.help = None
+		self.variables = {}
+		self.settings = None
+		self.sql_queries = {}
+		self.profiler = Profiler()
+		self.scheduler = Scheduler()
+		self.notifications = NotificationQueue(client)
+		self.ban_logs = BanLogs(client)
+		self.resolver = EntityResolver()
+		#UPSERT (INSERT ... ON CONFLICT) is only supported since SQLite 3.24
+		self.use_upsert = (sqlite3.sqlite_version_info >= (3, 24, 0))
+		self.jobs = []
+		self.jobs_running = set()
+		self.job_semaphore = None
+		self.max_parallel_jobs = 8
 		self.client = client
 		self.client_human = client_human
 		self.dbprefix = dbprefix
 		self.dbcon = dbcon
+		if isinstance(dbcon, ProfiledConnection):
+			dbcon.profiler = self.profiler
+		self.db = db
+		if self.db == None:
+			self.db = Database(connection=dbcon)
+		self.db.set_profiler(self.profiler)
 
 	async def print_info(self, scope, msg):
 		if scope.verbose >= 2:
+			scope.budget.use_output(msg)
 			await self.client.send_message(scope.channel, msg)
 		return
 
 	async def print_debug(self, scope, msg):
 		if scope.verbose >= 3:
+			scope.budget.use_output(msg)
 			await self.client.send_message(scope.channel, ":large_blue_circle: "+msg)
 		return
 
 	async def print_success(self, scope, msg):
 		if scope.verbose >= 2:
+			scope.budget.use_output(msg)
 			await self.client.send_message(scope.channel, ":white_check_mark: "+msg)
 		return
 
@@ -368,14 +1141,129 @@ class Shell:
 		try:
 			instance = plugin(self)
 			self.plugins.append(instance)
+			self.register_commands(instance)
+			self.register_jobs(instance)
 			print("Plugin {0} loaded".format(plugin.name))
 		except:
 			print(traceback.format_exc())
 			print("Plugin {0} can't be loaded".format(plugin.name))
 
+	def register_commands(self, plugin):
+		"""
+		Add the commands of a plugin to the dispatch index. The first plugin registering a name keeps it.
+		"""
+		for name in plugin.cmds:
+			if name not in self.commands:
+				self.commands[name] = plugin.cmds[name]
+
+		if type(plugin).execute_unregistered_command != Plugin.execute_unregistered_command:
+			self.unregistered_command_plugins.append(plugin)
+
+		self.help = None
+
+	def register_jobs(self, plugin):
+		"""
+		Add the periodic jobs of a plugin. Plugins still using on_loop get a job running it every 5 seconds.
+		"""
+		jobs = list(plugin.jobs)
+		if type(plugin).on_loop != Plugin.on_loop:
+			jobs.append(PeriodicJob(plugin, "on_loop", 5, plugin.on_loop))
+
+		for job in jobs:
+			self.jobs.append(job)
+			if self.job_semaphore:
+				self.schedule_job(job)
+
+	def start_periodic_jobs(self):
+		"""
+		Schedule the periodic jobs once the client is ready. The first run of each server is spread over the interval.
+		"""
+		if self.job_semaphore:
+			return
+
+		self.job_semaphore = asyncio.Semaphore(self.max_parallel_jobs)
+		for job in self.jobs:
+			self.schedule_job(job)
+
+	def schedule_job(self, job):
+		if not job.per_server:
+			self.schedule_job_run(job, None, time.time()+random.uniform(0, job.interval))
+			return
+
+		for s in self.client.servers:
+			self.schedule_job_run(job, s.id, time.time()+random.uniform(0, job.interval))
+
+	def schedule_server_jobs(self, server):
+		"""
+		Schedule the periodic jobs of a server joined after start.
+		"""
+		if not self.job_semaphore:
+			return
+
+		for job in self.jobs:
+			if job.per_server:
+				self.schedule_job_run(job, server.id, time.time()+random.uniform(0, job.interval))
+
+	def schedule_job_run(self, job, sid, when):
+		self.scheduler.schedule(("job", job.plugin.name, job.name, sid), when, self.run_periodic_job, job, sid, when)
+
+	async def run_periodic_job(self, job, sid, due):
+		server = None
+		if sid != None:
+			server = self.client.get_server(sid)
+			if not server:
+				return
+
+		#Keep a fixed rate, unless the job is late by more than one interval
+		nextDue = due+job.interval
+		if nextDue < time.time():
+			nextDue = time.time()+job.interval
+		self.schedule_job_run(job, sid, nextDue)
+
+		if server and job.active and not job.active(server):
+			return
+
+		key = (job.plugin.name, job.name, sid)
+		if key in self.jobs_running:
+			return
+
+		self.jobs_running.add(key)
+		try:
+			async with self.job_semaphore:
+				if not server:
+					await job.func()
+				else:
+					scope = self.create_scope(server, [""])
+					scope.channel = self.get_default_channel(server)
+					scope.user = server.me
+					scope.permission = UserPermission.Script
+					await job.func(scope)
+		finally:
+			self.jobs_running.discard(key)
+
+	def get_help(self):
+		"""
+		Return the help page as a list of lines. It is built once after plugins are loaded.
+		"""
+		if self.help == None:
+			help = []
+			for p in self.plugins:
+				help.append("\n**"+p.name+"**\n\n")
+				for c in p.cmds:
+					desc = getattr(p.cmds[c], "description", None)
+					if desc == None:
+						desc = inspect.getdoc(p.cmds[c])
+					if desc:
+						help.append(" - `"+c+"` : "+desc+"\n")
+					else:
+						help.append(" - `"+c+"`\n")
+			self.help = help
+
+		return self.help
+
 	def find_command_and_options(self, commandline, prefixes):
 		for prefix in prefixes:
-			if commandline.find(prefix) == 0:
+			if commandline.startswith(prefix):
 				commandline = commandline[len(prefix):]
 				lines = commandline.split("\n")
 				command = lines[0].split(" ")[0:1][0].strip()
@@ -385,35 +1273,123 @@ class Shell:
 				return (command, options, lines[1:])
 		return None
 
+	def compile_command(self, commandline, prefixes):
+		parsedCommand = self.find_command_and_options(commandline, prefixes)
+		if not parsedCommand:
+			return None
+		return CompiledCommand(parsedCommand[0], parsedCommand[1], parsedCommand[2], commandline)
+
+	def compile_script(self, script, prefixes=[""]):
+		commands = []
+		for l in script.split("\n"):
+			l = l.strip()
+			cmd = self.compile_command(l, prefixes)
+			if cmd:
+				commands.append(cmd)
+		return CompiledScript(commands)
+
+	def get_server_settings(self, server):
+		"""
+		Return the settings of a server. Settings of all servers are read from the database at the first call.
+		"""
+		if self.settings == None:
+			self.settings = {}
+			with self.dbcon:
+				c = self.dbcon.cursor()
+				for row in c.execute("SELECT discord_sid, command_prefix, script_instructions, script_duration, script_output, script_api_calls FROM "+self.dbtable("servers")):
+					limits = ScriptLimits(row[2], row[3], row[4], row[5])
+					self.settings[str(row[0])] = ServerSettings(self.client.user.mention+" ", row[1], limits)
+
+		settings = self.settings.get(server.id)
+		if not settings:
+			settings = ServerSettings(self.client.user.mention+" ")
+			self.settings[server.id] = settings
+		return settings
+
+	async def set_command_prefix(self, server, prefix):
+		await self.set_sql_data_async("servers", {"command_prefix": prefix}, {"discord_sid": int(server.id)})
+		self.get_server_settings(server).set_command_prefix(prefix)
+
+	async def set_script_limits(self, server, limits):
+		await self.set_sql_data_async("servers", {"script_instructions": limits.instructions, "script_duration": limits.duration, "script_output": limits.output, "script_api_calls": limits.api_calls}, {"discord_sid": int(server.id)})
+		self.get_server_settings(server).limits = limits
+
+	def create_budget(self, server):
+		if not server:
+			return ExecutionBudget(ScriptLimits())
+		return ExecutionBudget(self.get_server_settings(server).limits)
+
 	def create_scope(self, server, prefixes):
-		scope = ExecutionScope(self, server, prefixes)
+		return ExecutionScope(self, server, prefixes)
 
-		with self.dbcon:
-			c = self.dbcon.cursor()
-			for row in c.execute("SELECT name, value FROM "+self.dbtable("variables")+" WHERE discord_sid = ?", [int(scope.server.id)]):
-				scope.vars[row[0]] = row[1]
+	def get_global_variables(self, server):
+		"""
+		Return a copy of the global variables of a server. They are read from the database only once.
+		"""
+		if not server:
+			return {}
+
+		variables = self.variables.get(server.id)
+		if variables == None:
+			variables = {}
+			with self.dbcon:
+				c = self.dbcon.cursor()
+				for row in c.execute("SELECT name, value FROM "+self.dbtable("variables")+" WHERE discord_sid = ?", [int(server.id)]):
+					variables[row[0]] = row[1]
+			self.variables[server.id] = variables
+
+		return dict(variables)
 
-		return scope
+	def set_global_variable(self, server, name, value):
+		"""
+		Set a global variable. The cache is loaded first, so it always includes the writes still queued.
+		"""
+		self.get_global_variables(server)
+		self.variables[server.id][name] = value
+		self.queue_set_sql_data("variables", {"value":value}, {"discord_sid": int(server.id), "name": name})
 
 	async def execute_command(self, scope, commandline):
-		try:
-			if scope.iter > 64:
-				raise TooLongExecutionError()
+		cmd = self.compile_command(commandline, scope.prefixes)
+		if not cmd:
+			return False
 
-			parsedCommand = self.find_command_and_options(commandline, scope.prefixes)
-			if not parsedCommand:
-				return False
+		return await self.execute_compiled_command(scope, cmd)
 
-			for p in self.plugins:
-				if await p.execute_command(scope, parsedCommand[0], parsedCommand[1], parsedCommand[2]):
-					scope.iter = scope.iter+1
+	async def execute_compiled_command(self, scope, cmd):
+		commandline = cmd.commandline
+		try:
+			scope.budget.use_instruction()
+
+			handler = self.commands.get(cmd.command)
+			if handler:
+				started = self.profiler.start(scope.budget)
+				try:
+					await handler(scope, cmd.command, cmd.options, cmd.lines)
+				finally:
+					self.profiler.stop(started, scope.server.id if scope.server else None, "command", cmd.command)
+				return True
+
+			for p in self.unregistered_command_plugins:
+				if await p.execute_unregistered_command(scope, cmd.command, cmd.options, cmd.lines):
 					return True
 
-			raise CommandNotFoundError(parsedCommand[0])
+			raise CommandNotFoundError(cmd.command)
 
 		except CommandNotFoundError as e:
 			await self.print_error(scope, "Command `"+e.command+"` not found.")
 			scope.abort = True
+		except TooLongExecutionError as e:
+			if e.resource == "instructions":
+				await self.print_error(scope, "Script stopped: more than "+str(e.limit)+" commands executed.")
+			elif e.resource == "duration":
+				await self.print_error(scope, "Script stopped: execution took more than "+str(e.limit)+" seconds.")
+			elif e.resource == "depth":
+				await self.print_error(scope, "Script stopped: more than "+str(e.limit)+" nested scripts.")
+			elif e.resource == "output":
+				await self.print_error(scope, "Script stopped: more than "+str(e.limit)+" characters sent.")
+			else:
+				await self.print_error(scope, "Script stopped: more than "+str(e.limit)+" Discord requests.")
+			scope.abort = True
 		except AdminPermissionError as e:
 			await self.print_permission(scope, "This command is restricted to administrators.");
 			scope.abort = True
@@ -430,7 +1406,7 @@ class Shell:
 			await self.print_error(scope, e.parameter+" must be a number.");
 			scope.abort = True
 		except IntegerError as e:
-			await self.print_error(scope, e.parameter+" must be a number.");
+			await self.print_error(scope, e.name+" must be a number.");
 			scope.abort = True
 		except RegexError as e:
 			await self.print_error(scope, "`"+e.regex+"` is not a valid regular expression.");
@@ -446,21 +1422,48 @@ class Shell:
 
 		return False
 
-	async def execute_script(self, scope, script):
-		lines = script.split("\n");
+	async def execute_script(self, scope, script, name=None):
+		"""
+		Execute a script. Named scripts (triggers) are recorded by the profiler.
+		"""
+		if not isinstance(script, CompiledScript):
+			script = self.compile_script(script, scope.prefixes)
 
-		for l in lines:
-			l = l.strip()
+		if not scope.budget.limited:
+			scope.budget = self.create_budget(scope.server)
 
-			parsedCommand = self.find_command_and_options(l, scope.prefixes)
-			if not parsedCommand:
-				continue
+		budget = scope.budget
+		budget.enter_script()
+		if name:
+			started = self.profiler.start()
+		try:
+			await self.execute_compiled_script(scope, script)
+		finally:
+			budget.leave_script()
+			if name:
+				self.profiler.stop(started, scope.server.id if scope.server else None, "script", name)
 
-			await scope.execute_script(parsedCommand[0], l)
+	async def execute_compiled_script(self, scope, script):
+		i = 0
+		while i < len(script.commands):
+			cmd = script.commands[i]
+
+			await scope.execute_script(cmd)
 
 			if scope.abort:
 				break
 
+			#Skip the lines that an inactive block would ignore anyway
+			b = None
+			if len(scope.blocks):
+				b = scope.blocks[len(scope.blocks)-1]
+			if b and not b.terminated and cmd.command in ["if", "else"] and isinstance(b, ExecutionBlockIf) and not b.execute:
+				i = script.next_branch[i]
+			elif b and not b.terminated and cmd.command == "for" and isinstance(b, ExecutionBlockFor) and not len(b.list):
+				i = script.next_endfor[i]
+			else:
+				i = i+1
+
 	async def send_message(self, channel, text, e=None):
 		if e:
 			return await self.client.send_message(channel, text, embed=e)
@@ -477,64 +1480,25 @@ class Shell:
 		if not chan_name:
 			return None
 
-		chan_name = chan_name.strip()
-
-		for c in server.channels:
-			if c.name == chan_name:
-				return c
-			elif c.id == chan_name:
-				return c
-			elif "<#"+c.id+">" == chan_name:
-				return c
-			elif "#"+c.id == chan_name:
-				return c
-		return None
+		return self.resolver.find("channels", server, chan_name.strip())
 
 	def find_member(self, member_name, server):
 		if not member_name:
 			return None
 
-		member_name = member_name.strip()
-
-		for m in server.members:
-			if "<@"+m.id+">" == member_name:
-				return m
-			if "<@!"+m.id+">" == member_name:
-				return m
-			elif m.name+"#"+m.discriminator == member_name:
-				return m
-			elif m.id == member_name:
-				return m
-
-		return None
+		return self.resolver.find("members", server, member_name.strip())
 
 	def find_role(self, role_name, server):
 		if not role_name:
 			return None
 
-		for r in server.roles:
-			if "<@&"+r.id+">" == role_name:
-				return r
-			elif r.id == role_name:
-				return r
-			elif r.name == role_name:
-				return r
-
-		return None
+		return self.resolver.find("roles", server, role_name)
 
 	def find_emoji(self, emoji_name, server):
 		if not emoji_name:
 			return None
 
-		for e in server.emojis:
-			if "<:"+e.name+":"+e.id+">" == emoji_name:
-				return e
-			elif e.id == emoji_name:
-				return e
-			elif e.name == emoji_name:
-				return e
-
-		return None
+		return self.resolver.find("emojis", server, emoji_name)
 
 	def get_default_channel(self, server):
 		for c in server.channels:
@@ -578,143 +1542,261 @@ class Shell:
 	def dbtable(self, name):
 		return self.dbprefix+name
 
-	def create_sql_table(self, tablename, fields):
+	def create_sql_table(self, tablename, fields, unique=[]):
+		"""
+		Create a table and add missing fields. Each item of unique is a list of fields forming a unique key, used by set_sql_data.
+		"""
 		sqlQuery = "CREATE TABLE IF NOT EXISTS "+self.dbtable(tablename)+" ("+", ".join(fields)+")"
 		self.dbcon.execute(sqlQuery);
 
+		columns = self.get_sql_columns(tablename)
 		for f in fields:
-			try:
+			if not f.split(" ")[0] in columns:
 				sqlQuery = "ALTER TABLE "+self.dbtable(tablename)+" ADD "+f
 				self.dbcon.execute(sqlQuery);
-			except sqlite3.OperationalError:
-				pass
 
-	def get_sql_data(self, tablename, fields, where):
-		sqlQuery = "SELECT "+", ".join(fields)+" FROM "+self.dbtable(tablename)+" "
-		vars = []
-		first = True
-		for w in where:
-			if first:
-				sqlQuery = sqlQuery+" WHERE "+w+" = ?"
-			else:
-				sqlQuery = sqlQuery+" AND "+w+" = ?"
-			vars.append(where[w])
-			first = False
+		for u in unique:
+			self.create_sql_unique_index(tablename, u)
+
+	def create_sql_unique_index(self, tablename, fields):
+		"""
+		Create a unique index on fields. Duplicated rows left by older versions are removed, keeping the first one.
+		"""
+		table = self.dbtable(tablename)
+		index = table+"_"+"_".join(fields)+"_unique"
+		try:
+			self.dbcon.execute("CREATE UNIQUE INDEX IF NOT EXISTS "+index+" ON "+table+" ("+", ".join(fields)+")")
+		except sqlite3.IntegrityError:
+			print("Remove duplicated rows of "+table+" on ("+", ".join(fields)+")")
+			self.dbcon.execute("DELETE FROM "+table+" WHERE rowid NOT IN (SELECT MIN(rowid) FROM "+table+" GROUP BY "+", ".join(fields)+")")
+			self.dbcon.execute("CREATE UNIQUE INDEX IF NOT EXISTS "+index+" ON "+table+" ("+", ".join(fields)+")")
+
+	def create_sql_index(self, tablename, fields):
+		table = self.dbtable(tablename)
+		index = table+"_"+"_".join(fields)+"_index"
+		self.dbcon.execute("CREATE INDEX IF NOT EXISTS "+index+" ON "+table+" ("+", ".join(fields)+")")
+
+	def get_sql_columns(self, tablename):
+		return [row[1] for row in self.dbcon.execute("PRAGMA table_info("+self.dbtable(tablename)+")")]
+
+	def rebuild_sql_table(self, tablename, fields, conversions={}):
+		"""
+		Recreate a table with new field declarations. Rows are copied, using conversions[name] as SQL expression of the converted fields.
+		"""
+		table = self.dbtable(tablename)
+		columns = [f.split(" ")[0] for f in fields]
+		oldColumns = self.get_sql_columns(tablename)
+		columns = [c for c in columns if c in oldColumns]
+		expressions = [conversions.get(c, c) for c in columns]
+
+		self.dbcon.execute("DROP TABLE IF EXISTS "+table+"_rebuild")
+		self.dbcon.execute("CREATE TABLE "+table+"_rebuild ("+", ".join(fields)+")")
+		self.dbcon.execute("INSERT INTO "+table+"_rebuild ("+", ".join(columns)+") SELECT "+", ".join(expressions)+" FROM "+table)
+		self.dbcon.execute("DROP TABLE "+table)
+		self.dbcon.execute("ALTER TABLE "+table+"_rebuild RENAME TO "+table)
+		self.sql_queries = {}
+
+	def sql_epoch(self, field):
+		"""
+		Return the SQL expression converting a datetime text field to an epoch timestamp.
+		"""
+		return "CAST(strftime('%s', substr("+field+", 1, 19)) AS INTEGER)"
+
+	def get_schema_version(self, name):
+		self.dbcon.execute("CREATE TABLE IF NOT EXISTS "+self.dbtable("schema_versions")+" (name TEXT PRIMARY KEY, version INTEGER)")
+		version = self.get_sql_data("schema_versions", ["version"], {"name": name})
+		if version:
+			return version[0]
+		return 0
+
+	def migrate_sql_schema(self, name, migrations):
+		"""
+		Apply the migrations of a plugin that are not applied yet. Each migration runs in its own transaction.
+		"""
+		version = self.get_schema_version(name)
+		while version < len(migrations):
+			print("Migrate schema "+name+" to version "+str(version+1))
+			self.dbcon.commit()
+			try:
+				self.dbcon.execute("BEGIN")
+				migrations[version]()
+				self.set_sql_data("schema_versions", {"version": version+1}, {"name": name})
+				self.dbcon.commit()
+			except:
+				self.dbcon.rollback()
+				raise
+			version = version+1
+
+	def get_sql_query(self, kind, tablename, fields=(), where=()):
+		"""
+		Return the SQL text of a query. Queries are built once per (kind, table, fields, where) so sqlite3 can reuse its prepared statements.
+		"""
+		key = (kind, tablename, tuple(fields), tuple(where))
+		sqlQuery = self.sql_queries.get(key)
+		if sqlQuery:
+			return sqlQuery
+
+		table = self.dbtable(tablename)
+		whereQuery = ""
+		if len(where) > 0:
+			whereQuery = " WHERE "+" AND ".join([w+" = ?" for w in where])
+
+		if kind == "select":
+			sqlQuery = "SELECT "+", ".join(fields)+" FROM "+table+whereQuery
+		elif kind == "update":
+			sqlQuery = "UPDATE "+table+" SET "+", ".join([f+" = ?" for f in fields])+whereQuery
+		elif kind == "insert":
+			columns = list(fields)+list(where)
+			sqlQuery = "INSERT INTO "+table+" ("+", ".join(columns)+") VALUES ("+", ".join(["?"]*len(columns))+")"
+		elif kind == "upsert":
+			columns = list(fields)+list(where)
+			sqlQuery = "INSERT INTO "+table+" ("+", ".join(columns)+") VALUES ("+", ".join(["?"]*len(columns))+")"
+			sqlQuery = sqlQuery+" ON CONFLICT ("+", ".join(where)+") DO UPDATE SET "+", ".join([f+" = excluded."+f for f in fields])
+		elif kind == "insert_missing":
+			#Insert only if the previous UPDATE of the connection changed nothing
+			columns = list(fields)+list(where)
+			sqlQuery = "INSERT INTO "+table+" ("+", ".join(columns)+") SELECT "+", ".join(["?"]*len(columns))+" WHERE changes() = 0"
+		elif kind == "delete":
+			sqlQuery = "DELETE FROM "+table+whereQuery
+		else:
+			raise ValueError("Unknown query kind: "+kind)
 
+		self.sql_queries[key] = sqlQuery
+		return sqlQuery
+
+	def get_sql_data(self, tablename, fields, where):
+		"""
+		Synchronous helpers run on the main connection and don't flush the journal of queued writes: they are meant for
+		startup (migrations, plugin loading). Use the asynchronous versions while the bot is running.
+		"""
+		sqlQuery = self.get_sql_query("select", tablename, fields, where)
 		c = self.dbcon.cursor()
-		c.execute(sqlQuery, vars)
+		c.execute(sqlQuery, list(where.values()))
 		r = c.fetchone()
 		if r:
 			return r
 
 		return None
 
-	def set_sql_data(self, tablename, fields, where, id="id"):
-		idFound = self.get_sql_data(tablename, [id], where)
-		if idFound:
-			sqlQuery = "UPDATE "+self.dbtable(tablename)+" "
-			vars = []
-			first = True
-			for f in fields:
-				if first:
-					sqlQuery = sqlQuery+" SET "+f+" = ?"
-				else:
-					sqlQuery = sqlQuery+", "+f+" = ?"
-				vars.append(fields[f])
-				first = False
-			sqlQuery = sqlQuery+" WHERE "+id+" = ?"
-			vars.append(idFound[0])
+	def set_sql_data(self, tablename, fields, where):
+		"""
+		Update the row matching where, or insert it. The fields of where must be a primary key or a unique key of the table.
+		"""
+		self.set_sql_data_many(tablename, fields.keys(), where.keys(), [list(fields.values())+list(where.values())])
 
-			self.dbcon.execute(sqlQuery, vars)
-		else:
-			sqlQuery = "INSERT INTO "+self.dbtable(tablename)+" ("
-			vars = []
-			first = True
-			for f in fields:
-				if not first:
-					sqlQuery = sqlQuery+", "
-				sqlQuery = sqlQuery+f
-				vars.append(fields[f])
-				first = False
-			for w in where:
-				if not first:
-					sqlQuery = sqlQuery+", "
-				sqlQuery = sqlQuery+w
-				vars.append(where[w])
-				first = False
-			sqlQuery = sqlQuery+") VALUES ("
-			first = True
-			for f in fields:
-				if not first:
-					sqlQuery = sqlQuery+", "
-				sqlQuery = sqlQuery+"?"
-				first = False
-			for w in where:
-				if not first:
-					sqlQuery = sqlQuery+", "
-				sqlQuery = sqlQuery+"?"
-				first = False
-			sqlQuery = sqlQuery+")"
-
-			self.dbcon.execute(sqlQuery, vars)
+	def set_sql_data_many(self, tablename, fields, where, rows):
+		"""
+		Bulk version of set_sql_data. Each row contains the values of fields followed by the values of where.
+		"""
+		if not self.use_upsert:
+			self.set_sql_data_without_key(self.dbcon, tablename, fields, where, rows)
+			return
+
+		try:
+			self.dbcon.executemany(self.get_sql_query("upsert", tablename, fields, where), rows)
+		except sqlite3.OperationalError as e:
+			if not "ON CONFLICT" in str(e):
+				raise
+			#No unique key on where: update first and insert the missing rows
+			self.set_sql_data_without_key(self.dbcon, tablename, fields, where, rows)
 
 	def update_sql_data(self, tablename, fields, where):
-		sqlQuery = "UPDATE "+self.dbtable(tablename)+" "
-		vars = []
-		first = True
-		for f in fields:
-			if first:
-				sqlQuery = sqlQuery+" SET "+f+" = ?"
-			else:
-				sqlQuery = sqlQuery+", "+f+" = ?"
-			vars.append(fields[f])
-			first = False
-		first = True
-		for w in where:
-			if first:
-				sqlQuery = sqlQuery+" WHERE "+w+" = ?"
-			else:
-				sqlQuery = sqlQuery+" AND "+w+" = ?"
-			vars.append(where[w])
-			first = False
+		self.dbcon.execute(self.get_sql_query("update", tablename, fields, where), list(fields.values())+list(where.values()))
 
-		self.dbcon.execute(sqlQuery, vars)
+	def update_sql_data_many(self, tablename, fields, where, rows):
+		"""
+		Bulk version of update_sql_data. Each row contains the values of fields followed by the values of where.
+		"""
+		self.dbcon.executemany(self.get_sql_query("update", tablename, fields, where), rows)
 
 	def add_sql_data(self, tablename, fields):
-		sqlQuery = "INSERT INTO "+self.dbtable(tablename)+" ("
-		vars = []
-		first = True
-		for f in fields:
-			if not first:
-				sqlQuery = sqlQuery+", "
-			sqlQuery = sqlQuery+f
-			vars.append(fields[f])
-			first = False
-		sqlQuery = sqlQuery+") VALUES ("
-		first = True
-		for f in fields:
-			if not first:
-				sqlQuery = sqlQuery+", "
-			sqlQuery = sqlQuery+"?"
-			first = False
-		sqlQuery = sqlQuery+")"
 		c = self.dbcon.cursor()
-		c.execute(sqlQuery, vars)
+		c.execute(self.get_sql_query("insert", tablename, fields), list(fields.values()))
 		return c.lastrowid
 
+	def add_sql_data_many(self, tablename, fields, rows):
+		"""
+		Bulk version of add_sql_data. Each row contains the values of fields.
+		"""
+		self.dbcon.executemany(self.get_sql_query("insert", tablename, fields), rows)
+
 	def delete_sql_data(self, tablename, where):
-		sqlQuery = "DELETE FROM "+self.dbtable(tablename)+" "
-		vars = []
-		first = True
-		for w in where:
-			if first:
-				sqlQuery = sqlQuery+" WHERE "+w+" = ?"
-			else:
-				sqlQuery = sqlQuery+" AND "+w+" = ?"
-			vars.append(where[w])
-			first = False
+		self.dbcon.execute(self.get_sql_query("delete", tablename, (), where), list(where.values()))
+
+	def delete_sql_data_many(self, tablename, where, rows):
+		"""
+		Bulk version of delete_sql_data. Each row contains the values of where.
+		"""
+		self.dbcon.executemany(self.get_sql_query("delete", tablename, (), where), rows)
+
+	async def get_sql_data_async(self, tablename, fields, where):
+		"""
+		Awaitable version of get_sql_data, running on a reader connection
+		"""
+		return await self.db.fetchone(self.get_sql_query("select", tablename, fields, where), list(where.values()))
+
+	async def set_sql_data_async(self, tablename, fields, where):
+		"""
+		Awaitable version of set_sql_data, running on the writer connection
+		"""
+		await self.set_sql_data_many_async(tablename, fields.keys(), where.keys(), [list(fields.values())+list(where.values())])
+
+	async def set_sql_data_many_async(self, tablename, fields, where, rows):
+		if not self.use_upsert:
+			await self.db.run(self.db.writer, self.set_sql_data_without_key, tablename, fields, where, rows)
+			return
+
+		try:
+			await self.db.executemany(self.get_sql_query("upsert", tablename, fields, where), rows)
+		except sqlite3.OperationalError as e:
+			if not "ON CONFLICT" in str(e):
+				raise
+			await self.db.run(self.db.writer, self.set_sql_data_without_key, tablename, fields, where, rows)
+
+	def set_sql_data_without_key(self, connection, tablename, fields, where, rows):
+		updateQuery = self.get_sql_query("update", tablename, fields, where)
+		insertQuery = self.get_sql_query("insert", tablename, fields, where)
+		for r in rows:
+			if connection.execute(updateQuery, r).rowcount == 0:
+				connection.execute(insertQuery, r)
+
+	async def update_sql_data_async(self, tablename, fields, where):
+		await self.db.execute(self.get_sql_query("update", tablename, fields, where), list(fields.values())+list(where.values()))
+
+	async def update_sql_data_many_async(self, tablename, fields, where, rows):
+		await self.db.executemany(self.get_sql_query("update", tablename, fields, where), rows)
+
+	async def add_sql_data_async(self, tablename, fields):
+		return await self.db.execute(self.get_sql_query("insert", tablename, fields), list(fields.values()))
+
+	async def add_sql_data_many_async(self, tablename, fields, rows):
+		await self.db.executemany(self.get_sql_query("insert", tablename, fields), rows)
+
+	async def delete_sql_data_async(self, tablename, where):
+		await self.db.execute(self.get_sql_query("delete", tablename, (), where), list(where.values()))
 
-		self.dbcon.execute(sqlQuery, vars)
+	async def delete_sql_data_many_async(self, tablename, where, rows):
+		await self.db.executemany(self.get_sql_query("delete", tablename, (), where), rows)
+
+	def queue_set_sql_data(self, tablename, fields, where):
+		"""
+		Write-behind version of set_sql_data. The fields of where must be a primary key or a unique key of the table.
+		"""
+		vars = list(fields.values())+list(where.values())
+		if self.use_upsert:
+			self.db.write(self.get_sql_query("upsert", tablename, fields, where), vars)
+		else:
+			self.db.write(self.get_sql_query("update", tablename, fields, where), vars)
+			self.db.write(self.get_sql_query("insert_missing", tablename, fields, where), vars)
+
+	def queue_update_sql_data(self, tablename, fields, where):
+		self.db.write(self.get_sql_query("update", tablename, fields, where), list(fields.values())+list(where.values()))
+
+	def queue_add_sql_data(self, tablename, fields):
+		self.db.write(self.get_sql_query("insert", tablename, fields), list(fields.values()))
+
+	def queue_delete_sql_data(self, tablename, where):
+		self.db.write(self.get_sql_query("delete", tablename, (), where), list(where.values()))
 
 ################################################################################
 # Plugin
@@ -728,6 +1810,8 @@ class Plugin:
 	def __init__(self, shell):
 		self.shell = shell
 		self.cmds = {}
+		self.parsers = {}
+		self.jobs = []
 
 	async def on_loop(self, scope):
 		return
@@ -740,7 +1824,6 @@ class Plugin:
 
 	async def execute_command(self, scope, command, options, lines):
 		if command in self.cmds:
-			scope.iter = scope.iter+1
 			await self.cmds[command](scope, command, options, lines)
 			return True
 		return await self.execute_unregistered_command(scope, command, options, lines)
@@ -760,32 +1843,49 @@ class Plugin:
 	async def on_message(self, scope, message, command_found):
 		return False
 
+	async def on_member_update(self, before, after):
+		return False
+
 	async def on_reaction(self, scope, reaction):
 		return False
 
+	async def on_raw_reaction(self, scope, message_id, emoji):
+		"""
+		Called for every reaction added in a server, even on messages that are not in the cache of the client
+		"""
+		return False
+
+	async def on_ready(self):
+		"""
+		Called when the client is connected, and again after each reconnection
+		"""
+		pass
+
+	async def on_server_remove(self, server):
+		"""
+		Called when the bot leaves a server or is removed from it
+		"""
+		pass
+
 	def add_command(self, name, cmd):
 		self.cmds[name] = cmd
+		self.parsers[name] = create_parser(name, cmd)
 
-	async def parse_options(self, scope, parser, options):
-		isValid = False
+	def add_periodic_job(self, name, interval, func, active=None, per_server=True):
+		"""
+		Call func every interval seconds, with a scope of each server where active(server) is true, or without parameter if per_server is false
+		"""
+		self.jobs.append(PeriodicJob(self, name, interval, func, active, per_server))
 
-		argParseOutput = io.StringIO()
-		argParseError = io.StringIO()
+	async def parse_options(self, scope, parser, options):
 		try:
-			with RedirectOutput(argParseOutput, argParseError):
-				args = parser.parse_args(shlex.split(options))
-				return args
-		except:
-			if argParseOutput.getvalue():
-				await self.shell.print_info(scope, argParseOutput.getvalue())
-			if argParseError.getvalue():
-				text = argParseError.getvalue()
-				if text.find(parser.prog+": error:") >= 0:
-					parts = text.split(parser.prog+": error: ")
-					await self.shell.print_error(scope, parts[1]+"\n"+parts[0])
-				else:
-					await self.shell.print_error(scope, argParseError.getvalue())
-			pass
+			return parser.parse_args(split_options(options))
+		except OptionsHelp as e:
+			await self.shell.print_info(scope, e.text)
+		except OptionsError as e:
+			await self.shell.print_error(scope, e.text)
+		except ValueError as e:
+			await self.shell.print_error(scope, str(e)+".")
 
 		return None
 
@@ -823,6 +1923,7 @@ class MessageStream:
 	async def flush(self):
 		if self.monospace:
 			self.text = self.text+"\n```"
+		self.scope.budget.use_output(self.text)
 		await self.scope.shell.client.send_message(self.scope.channel, self.text)
 		if self.monospace:
 			self.text = "```\n"
@@ -853,3 +1954,510 @@ class MessageStream:
 
 	async def finish(self):
 		await self.flush()
+
+################################################################################
+# Event queues
+################################################################################
+
+class ServerEventQueues:
+	"""
+	Run events of each server in order. Different servers are served concurrently by a bounded
+	number of workers. When the queue of a server is full, new events of this server are dropped
+	"""
+	def __init__(self, loop, num_workers=8, max_queue_size=100):
+		self.loop = loop
+		self.num_workers = num_workers
+		self.max_queue_size = max_queue_size
+
+		self.queues = {}
+		self.ready = None
+		self.workers = []
+
+		self.processed = 0
+		self.dropped = 0
+		self.dropped_by_server = {}
+		self.max_length = 0
+
+	def start(self):
+		self.ready = asyncio.Queue()
+		for i in range(self.num_workers):
+			self.workers.append(self.loop.create_task(self.run_worker()))
+
+	def push(self, sid, name, coro_func, *args, **kwargs):
+		if not self.ready:
+			self.start()
+
+		queue = self.queues.get(sid)
+		if queue == None:
+			queue = collections.deque()
+			self.queues[sid] = queue
+		elif len(queue) >= self.max_queue_size:
+			self.dropped = self.dropped+1
+			self.dropped_by_server[sid] = self.dropped_by_server.get(sid, 0)+1
+			if self.dropped_by_server[sid] % 100 == 1:
+				print("Event queue of server {0} is full: {1} events dropped ({2})".format(sid, self.dropped_by_server[sid], name))
+			return False
+
+		queue.append((name, coro_func, args, kwargs))
+		self.max_length = max(self.max_length, len(queue))
+
+		#A server is in the ready queue only when no worker is processing it
+		if len(queue) == 1:
+			self.ready.put_nowait(sid)
+		return True
+
+	async def run_worker(self):
+		while True:
+			sid = await self.ready.get()
+			queue = self.queues[sid]
+			name, coro_func, args, kwargs = queue[0]
+			try:
+				await coro_func(*args, **kwargs)
+			except asyncio.CancelledError:
+				raise
+			except:
+				print(traceback.format_exc())
+			self.processed = self.processed+1
+
+			queue.popleft()
+			if len(queue):
+				self.ready.put_nowait(sid)
+			else:
+				del self.queues[sid]
+
+	def get_server_stats(self, sid):
+		queue = self.queues.get(sid)
+		pending = 0
+		if queue:
+			pending = len(queue)
+		return {"pending": pending, "dropped": self.dropped_by_server.get(sid, 0)}
+
+	def get_stats(self):
+		pending = 0
+		for sid in self.queues:
+			pending = pending+len(self.queues[sid])
+		return {"processed": self.processed, "dropped": self.dropped, "pending": pending, "max_length": self.max_length, "servers": len(self.queues)}
+
+################################################################################
+# Scheduler
+################################################################################
+
+class PeriodicJob:
+	"""
+	A job of a plugin, called by the Shell every interval seconds
+	"""
+	def __init__(self, plugin, name, interval, func, active=None, per_server=True):
+		self.plugin = plugin
+		self.name = name
+		self.interval = interval
+		self.func = func
+		self.active = active
+		self.per_server = per_server
+
+class Scheduler:
+	"""
+	Call coroutine functions at given epoch times. Entries are kept in a heap and a single task
+	sleeps until the next one is due. Scheduling a key again replaces its previous entry
+	"""
+	def __init__(self, max_sleep=60):
+		self.max_sleep = max_sleep
+		self.heap = []
+		self.entries = {}
+		self.counter = 0
+		self.task = None
+		self.wakeup = None
+
+	def start(self):
+		if not self.task:
+			self.wakeup = asyncio.Event()
+			self.task = asyncio.ensure_future(self.run())
+
+	def schedule(self, key, when, coro_func, *args):
+		self.cancel(key)
+
+		self.counter = self.counter+1
+		entry = [when, self.counter, key, coro_func, args]
+		self.entries[key] = entry
+		heapq.heappush(self.heap, entry)
+
+		self.start()
+		if self.heap[0] is entry:
+			self.wakeup.set()
+
+	def cancel(self, key):
+		entry = self.entries.pop(key, None)
+		if entry:
+			#Removed lazily from the heap
+			entry[3] = None
+
+	def get_time(self, key):
+		entry = self.entries.get(key)
+		if entry:
+			return entry[0]
+		return None
+
+	def __len__(self):
+		return len(self.entries)
+
+	async def run(self):
+		while True:
+			while len(self.heap) > 0 and self.heap[0][3] == None:
+				heapq.heappop(self.heap)
+
+			if len(self.heap) == 0:
+				delay = self.max_sleep
+			else:
+				delay = min(self.heap[0][0]-time.time(), self.max_sleep)
+
+			if delay > 0:
+				self.wakeup.clear()
+				try:
+					await asyncio.wait_for(self.wakeup.wait(), delay)
+				except asyncio.TimeoutError:
+					pass
+				continue
+
+			entry = heapq.heappop(self.heap)
+			del self.entries[entry[2]]
+			asyncio.ensure_future(self.call(entry))
+
+	async def call(self, entry):
+		try:
+			await entry[3](*entry[4])
+		except asyncio.CancelledError:
+			raise
+		except:
+			print(traceback.format_exc())
+
+################################################################################
+# Notifications
+################################################################################
+
+class NotificationQueue:
+	"""
+	Send private messages in the background, with a few workers limited to rate messages every per seconds.
+	Texts for the same user within digest_delay seconds are sent as a single message.
+	"""
+	def __init__(self, client, num_workers=2, digest_delay=3, rate=5, per=5):
+		self.client = client
+		self.num_workers = num_workers
+		self.digest_delay = digest_delay
+		self.rate = rate
+		self.per = per
+		self.pending = {}
+		self.send_times = collections.deque()
+		self.queue = None
+		self.workers = []
+
+	def start(self):
+		if not self.queue:
+			self.queue = asyncio.Queue()
+			self.workers = [asyncio.ensure_future(self.run_worker()) for i in range(self.num_workers)]
+
+	def notify(self, user, text, key=None):
+		"""
+		Queue a private message. A text with the same key as a pending one replaces it.
+		"""
+		self.start()
+
+		if user.id not in self.pending:
+			self.pending[user.id] = (user, collections.OrderedDict())
+			asyncio.get_event_loop().call_later(self.digest_delay, self.queue.put_nowait, user.id)
+
+		if key == None:
+			key = object()
+		self.pending[user.id][1][key] = text
+
+	def __len__(self):
+		return len(self.pending)
+
+	async def wait_rate_limit(self):
+		while len(self.send_times) >= self.rate:
+			delay = self.send_times[0]+self.per-time.time()
+			if delay > 0:
+				await asyncio.sleep(delay)
+			else:
+				self.send_times.popleft()
+		self.send_times.append(time.time())
+
+	async def run_worker(self):
+		while True:
+			uid = await self.queue.get()
+			user, texts = self.pending.pop(uid)
+
+			await self.wait_rate_limit()
+			try:
+				await self.client.send_message(user, "\n\n".join(texts.values()))
+			except discord.Forbidden:
+				#The user doesn't accept private messages
+				pass
+			except:
+				print(traceback.format_exc())
+
+################################################################################
+# Audit logs
+################################################################################
+
+class RecentSet:
+	"""
+	Set of keys added less than duration seconds ago
+	"""
+	def __init__(self, duration):
+		self.duration = duration
+		self.times = collections.OrderedDict()
+
+	def purge(self):
+		limit = time.time()-self.duration
+		while len(self.times) > 0 and next(iter(self.times.values())) < limit:
+			self.times.popitem(last=False)
+
+	def add(self, key):
+		self.purge()
+		self.times.pop(key, None)
+		self.times[key] = time.time()
+
+	def __contains__(self, key):
+		self.purge()
+		return key in self.times
+
+	def __len__(self):
+		self.purge()
+		return len(self.times)
+
+class BanLogs:
+	"""
+	Ban entries of the audit logs. All the bans waiting for their entry on a server share the same fetches,
+	retried with an exponential backoff. The last entries of each server are kept for cache_duration seconds.
+	"""
+	def __init__(self, client, limit=10, first_delay=0.5, max_delay=5, timeout=60, cache_duration=30):
+		self.client = client
+		self.limit = limit
+		self.first_delay = first_delay
+		self.max_delay = max_delay
+		self.timeout = timeout
+		self.cache_duration = cache_duration
+		self.entries = {}
+		self.fetch_times = {}
+		self.waiting = {}
+		self.tasks = {}
+
+	def get_entry_time(self, entry):
+		return discord.utils.snowflake_time(entry.id).replace(tzinfo=datetime.timezone.utc).timestamp()
+
+	def find_entry(self, sid, uid, since):
+		for e in self.entries.get(sid, []):
+			if e.target and e.target.id == uid and self.get_entry_time(e) >= since:
+				return e
+		return None
+
+	async def fetch(self, server, limit):
+		self.entries[server.id] = await self.client.get_ban_logs(server, limit=limit)
+		self.fetch_times[server.id] = time.time()
+
+	async def get_last_bans(self, server, limit):
+		if time.time()-self.fetch_times.get(server.id, 0) > self.cache_duration:
+			await self.fetch(server, max(limit, self.limit))
+		return self.entries[server.id][:limit]
+
+	async def find(self, server, user_id, since):
+		"""
+		Return the entry of a ban of a user done after since, or None if it is not found before timeout seconds
+		"""
+		entry = self.find_entry(server.id, user_id, since)
+		if entry:
+			return entry
+
+		future = asyncio.get_event_loop().create_future()
+		self.waiting.setdefault(server.id, []).append((user_id, since, future))
+		if server.id not in self.tasks:
+			self.tasks[server.id] = asyncio.ensure_future(self.poll(server))
+
+		try:
+			return await asyncio.wait_for(future, self.timeout)
+		except asyncio.TimeoutError:
+			return None
+
+	async def poll(self, server):
+		delay = self.first_delay
+		try:
+			while True:
+				waiting = [w for w in self.waiting.get(server.id, []) if not w[2].done()]
+				self.waiting[server.id] = waiting
+				if len(waiting) == 0:
+					return
+
+				try:
+					await self.fetch(server, min(max(self.limit, len(waiting)), 100))
+				except:
+					print(traceback.format_exc())
+
+				for w in waiting:
+					entry = self.find_entry(server.id, w[0], w[1])
+					if entry and not w[2].done():
+						w[2].set_result(entry)
+
+				await asyncio.sleep(delay)
+				delay = min(delay*2, self.max_delay)
+		finally:
+			del self.tasks[server.id]
+
+################################################################################
+# Entity resolver
+################################################################################
+
+class EntityIndex:
+	"""
+	Ids of the entities of a server indexed by name. A name shared by several entities resolves to the first one added.
+	"""
+	def __init__(self):
+		self.names = {}
+		self.index = {}
+		self.shadowed = {}
+
+	def __len__(self):
+		return len(self.names)
+
+	def add(self, id, name):
+		if id in self.names:
+			self.remove(id)
+
+		self.names[id] = name
+		if name in self.index:
+			self.shadowed.setdefault(name, []).append(id)
+		else:
+			self.index[name] = id
+
+	def remove(self, id):
+		if id not in self.names:
+			return
+
+		name = self.names.pop(id)
+		shadowed = self.shadowed.pop(name, [])
+		if self.index[name] == id:
+			if len(shadowed) > 0:
+				self.index[name] = shadowed.pop(0)
+			else:
+				del self.index[name]
+		else:
+			shadowed = [i for i in shadowed if i != id]
+
+		if len(shadowed) > 0:
+			self.shadowed[name] = shadowed
+
+	def update(self, id, name):
+		if self.names.get(id) != name:
+			self.add(id, name)
+
+	def get(self, name):
+		return self.index.get(name)
+
+class EntityResolver:
+	"""
+	Find members, channels, roles and emojis of a server from an id, a mention or a name.
+	Indexes only keep ids: entities are always taken from the server, so objects replaced on reconnection are never returned.
+	Indexes are built on first use and kept up to date by the events of the client.
+	"""
+	def __init__(self):
+		self.indexes = {}
+		self.kinds = {
+			"members": (lambda s: s.members, lambda s, id: s.get_member(id), lambda m: m.name+"#"+m.discriminator, re.compile("<@!?(?P<mention>[0-9]+)>|(?P<id>[0-9]+)")),
+			"channels": (lambda s: s.channels, lambda s, id: s.get_channel(id), lambda c: c.name, re.compile("<#(?P<mention>[0-9]+)>|#?(?P<id>[0-9]+)")),
+			"roles": (lambda s: s.roles, lambda s, id: discord.utils.get(s.roles, id=id), lambda r: r.name, re.compile("<@&(?P<mention>[0-9]+)>|(?P<id>[0-9]+)")),
+			"emojis": (lambda s: s.emojis, lambda s, id: discord.utils.get(s.emojis, id=id), lambda e: e.name, re.compile("<:(?P<name>[^:]*):(?P<mention>[0-9]+)>|(?P<id>[0-9]+)"))
+		}
+
+	def get_index(self, kind, server):
+		collection = self.kinds[kind][0](server)
+		index = self.indexes.get((kind, server.id))
+
+		#Members received by chunks don't dispatch events: a different size means the index is outdated
+		if index == None or len(index) != len(collection):
+			getName = self.kinds[kind][2]
+			index = EntityIndex()
+			for e in collection:
+				index.add(e.id, getName(e))
+			self.indexes[(kind, server.id)] = index
+
+		return index
+
+	def find(self, kind, server, text):
+		getById = self.kinds[kind][1]
+		getName = self.kinds[kind][2]
+
+		res = self.kinds[kind][3].fullmatch(text)
+		if res:
+			entity = getById(server, res.group("mention") or res.group("id"))
+			#Emoji mentions also contain the name of the emoji
+			if entity and res.groupdict().get("name") in [None, getName(entity)]:
+				return entity
+
+		for attempt in range(2):
+			id = self.get_index(kind, server).get(text)
+			if id == None:
+				return None
+
+			entity = getById(server, id)
+			if entity and getName(entity) == text:
+				return entity
+
+			#Removed or renamed without event: the index is built again
+			self.indexes.pop((kind, server.id), None)
+
+		return None
+
+	def add(self, kind, server, entity):
+		index = self.indexes.get((kind, server.id))
+		if index:
+			index.add(entity.id, self.kinds[kind][2](entity))
+
+	def remove(self, kind, server, entity):
+		index = self.indexes.get((kind, server.id))
+		if index:
+			index.remove(entity.id)
+
+	def update(self, kind, server, entity):
+		index = self.indexes.get((kind, server.id))
+		if index:
+			index.update(entity.id, self.kinds[kind][2](entity))
+
+	def clear(self, server=None):
+		if server == None:
+			self.indexes = {}
+		else:
+			for kind in self.kinds:
+				self.indexes.pop((kind, server.id), None)
+
+	def handle_event(self, event, args):
+		"""
+		Update the indexes from an event dispatched by the client
+		"""
+		if event == "member_join":
+			self.add("members", args[0].server, args[0])
+		elif event == "member_remove":
+			self.remove("members", args[0].server, args[0])
+		elif event == "member_update":
+			self.update("members", args[1].server, args[1])
+		elif event in ["channel_create", "channel_delete", "channel_update"]:
+			channel = args[-1]
+			if channel.is_private:
+				return
+			if event == "channel_create":
+				self.add("channels", channel.server, channel)
+			elif event == "channel_delete":
+				self.remove("channels", channel.server, channel)
+			else:
+				self.update("channels", channel.server, channel)
+		elif event == "server_role_create":
+			self.add("roles", args[0].server, args[0])
+		elif event == "server_role_delete":
+			self.remove("roles", args[0].server, args[0])
+		elif event == "server_role_update":
+			self.update("roles", args[1].server, args[1])
+		elif event == "server_emojis_update":
+			for e in list(args[0])+list(args[1]):
+				self.indexes.pop(("emojis", e.server.id), None)
+		elif event == "ready":
+			#Servers are received again after a reconnection
+			self.clear()
+		elif event in ["server_available", "server_join", "server_remove"]:
+			self.clear(args[0])